@@ -9,6 +9,7 @@ from rich.console import Console
 import re
 import tempfile
 import yaml
+from ai_scripts.lib.cache import add_cache_argument, with_cache
 from ai_scripts.lib.dict import remove_none_values
 
 from ai_scripts.lib.logging import (
@@ -48,6 +49,7 @@ def main():
         action=argparse.BooleanOptionalAction,
         help="Open an editor to chat",
     )
+    add_cache_argument(parser)
     args = parser.parse_args()
     user_prompt: str = args.prompt or ""
     system_prompt: str = args.system or ""
@@ -80,10 +82,13 @@ def main():
         chat = parse_chat(md)
         metadata = parse_metadata(md)
         model_name = metadata.get("model")
-        model = (
-            Models.get_by_name(model_name)
-            if model_name
-            else Models.get_from_env_or_default()
+        model = with_cache(
+            (
+                Models.get_by_name(model_name)
+                if model_name
+                else Models.get_from_env_or_default()
+            ),
+            args.cache,
         )
         last_msg = last_item(chat)
         if last_msg is not None and last_msg["role"] == "user":
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+import argparse
+import math
+from typing import Dict, List
+
+TIME_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="ai-scripts",
+        description="Manage the ai scripts",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    daemon_parser = subparsers.add_parser(
+        "daemon",
+        help="Run a daemon that keeps the model clients warm. "
+        "All other scripts use it automatically if it is running.",
+    )
+    daemon_parser.add_argument(
+        "--preload",
+        nargs="*",
+        default=[],
+        help="Names or abbreviations of models that should be loaded on startup",
+    )
+    subparsers.add_parser(
+        "hedging",
+        help="Show how often each model won the hedged requests (e.g. MODEL=C3H,MS)",
+    )
+    models_parser = subparsers.add_parser("models", help="List the available models")
+    models_parser.add_argument(
+        "--latency",
+        action="store_true",
+        help="Show the recent time to first token and throughput of the models",
+    )
+    stats_parser = subparsers.add_parser(
+        "stats", help="Report the performance of the recent model calls"
+    )
+    stats_parser.add_argument(
+        "--since",
+        type=time_window,
+        default="24h",
+        help="Time window, e.g. 30m, 24h or 7d. Defaults to 24h.",
+    )
+    stats_parser.add_argument(
+        "--by",
+        choices=["model", "command"],
+        nargs="*",
+        default=["model", "command"],
+        help="How the calls are grouped. Defaults to both.",
+    )
+    args = parser.parse_args()
+
+    match args.command:
+        case "daemon":
+            from ai_scripts.lib.daemon import serve
+
+            serve(preload=args.preload)
+        case "hedging":
+            print_hedge_stats()
+        case "models":
+            print_models(args.latency)
+        case "stats":
+            print_stats(args.since, args.by)
+
+
+def time_window(value: str) -> float:
+    """Parses a time window like 30m, 24h or 7d into seconds"""
+    try:
+        seconds = float(value[:-1]) * TIME_UNITS[value[-1:]]
+    except (KeyError, ValueError):
+        seconds = math.nan
+    if not 0 < seconds < math.inf:
+        raise argparse.ArgumentTypeError(
+            f'invalid time window "{value}", use e.g. 30m, 24h or 7d'
+        )
+    return seconds
+
+
+def print_stats(since_s: float, groupings: List[str]):
+    import time
+
+    from ai_scripts.lib.telemetry import Call, Telemetry, percentile
+
+    start = time.time() - since_s
+    calls = Telemetry.from_env().calls(since=start)
+    if len(calls) == 0:
+        started_at = time.strftime("%Y-%m-%d %H:%M", time.localtime(start))
+        print(f"No model calls recorded since {started_at}")
+        return
+    for grouping in groupings:
+        groups: Dict[str, List[Call]] = {}
+        for call in calls:
+            groups.setdefault(getattr(call, grouping), []).append(call)
+        print(
+            f"{grouping:<40} {'calls':>6} {'errors':>6} {'ttft p50':>9} "
+            f"{'p95':>7} {'p99':>7} {'tok/s p50':>9} {'tokens in/out':>15}"
+        )
+        for name, group in sorted(groups.items(), key=lambda g: -len(g[1])):
+            ttfts = [c.ttft_s for c in group if c.ttft_s is not None]
+            throughputs = [c.tokens_per_s for c in group if c.tokens_per_s]
+            errors = sum(1 for c in group if c.error is not None)
+            tokens_in = sum(c.prompt_tokens or 0 for c in group)
+            tokens_out = sum(c.completion_tokens or 0 for c in group)
+            columns = [
+                format_ms(percentile(ttfts, q)) if ttfts else "-"
+                for q in [0.5, 0.95, 0.99]
+            ]
+            tokens_per_s = f"{percentile(throughputs, 0.5):.0f}" if throughputs else "-"
+            print(
+                f"{name:<40} {len(group):>6} {errors:>6} {columns[0]:>9} "
+                f"{columns[1]:>7} {columns[2]:>7} {tokens_per_s:>9} "
+                f"{f'{tokens_in}/{tokens_out}':>15}"
+            )
+        print()
+
+
+def format_ms(seconds: float) -> str:
+    return f"{seconds * 1000:.0f}ms"
+
+
+def print_models(latency: bool):
+    from ai_scripts.lib.model import Models
+
+    if not latency:
+        for model in Models:
+            descriptor = model.value
+            print(
+                f"{descriptor.abbr or '':<5} {descriptor.name:<40} {descriptor.provider}"
+            )
+        return
+
+    from ai_scripts.lib.latency import recent_summaries
+
+    summaries = recent_summaries()
+    if len(summaries) == 0:
+        print("No requests recorded in the last hours")
+        return
+    print(
+        f"{'model':<40} {'samples':>7} {'errors':>6} "
+        f"{'ttft p50':>9} {'ttft p95':>9} {'tokens/s':>9}"
+    )
+    for summary in sorted(summaries.values(), key=lambda s: s.ttft_p50_s):
+        tokens_per_s = (
+            "-" if summary.tokens_per_s is None else f"{summary.tokens_per_s:.0f}"
+        )
+        print(
+            f"{summary.model:<40} {summary.samples:>7} {summary.errors:>6} "
+            f"{summary.ttft_p50_s * 1000:>7.0f}ms {summary.ttft_p95_s * 1000:>7.0f}ms "
+            f"{tokens_per_s:>9}"
+        )
+
+
+def print_hedge_stats():
+    from ai_scripts.lib.hedging import HedgeStats
+
+    rows = HedgeStats.from_env().summary()
+    if len(rows) == 0:
+        print("No hedged requests recorded yet")
+        return
+    totals = {}
+    for models, _, wins, _, _ in rows:
+        totals[models] = totals.get(models, 0) + wins
+    print(
+        f"{'models':<40} {'winner':<40} {'wins':>10} {'hedged':>7} {'first token':>12}"
+    )
+    for models, winner, wins, hedged_wins, first_token_s in rows:
+        share = f"{wins} ({wins / totals[models]:.0%})"
+        print(
+            f"{models:<40} {winner:<40} {share:>10} {hedged_wins:>7} "
+            f"{first_token_s * 1000:>10.0f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 from dataclasses import dataclass, field
-from typing import List
+from typing import Dict, List, Optional
 import os
 import re
-import json
 from pathlib import Path
 import argparse
+from concurrent.futures import Future, ThreadPoolExecutor
+from ai_scripts.lib.cache import add_cache_argument, with_cache
 from ai_scripts.lib.env import is_debbuging
 
 from ai_scripts.lib.logging import (
@@ -18,9 +19,19 @@ from ai_scripts.lib.logging import (
 )
 from ai_scripts.lib.agent import Agent
 from ai_scripts.lib.model import Models
-from ai_scripts.lib.fs import grep_keyword
+from ai_scripts.lib.fs import FileHits, search_keywords
+from ai_scripts.lib.index import update_index
+from ai_scripts.lib.ranking import format_windows, pack_windows, rank_hits
+from ai_scripts.lib.retrieval import rank_files
 from ai_scripts.lib.sh import run_cmd
-from ai_scripts.lib.tokenizing import limit_tokens, number_of_tokens
+from ai_scripts.lib.string import StringArrayParser
+from ai_scripts.lib.tracing import is_tracing, span, text_args, tracing
+from ai_scripts.lib.tokenizing import (
+    TokenCounter,
+    limit_tokens,
+    number_of_tokens,
+    token_encoding,
+)
 
 # TOTAL TOKENS WITH MIXTRAL ARE 32K
 TOKEN_LIMIT_FILES = 5000
@@ -28,6 +39,12 @@ TOKEN_LIMIT_README = 5000
 TOKEN_LIMIT_SEARCH = 10000
 TOKEN_LIMIT_FILE_CONTENT = 10000
 
+# Number of files that are ranked as relevant with local retrieval
+RETRIEVAL_FILES = 5
+
+# Matching lines per keyword and file, that are ranked for the search result
+SEARCH_MAX_COUNT = 32
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -38,9 +55,39 @@ def main():
         "question",
         help="The question that should be answered",
     )
+    parser.add_argument(
+        "--reindex",
+        action="store_true",
+        help="Rebuild the search index of the workspace from scratch",
+    )
+    parser.add_argument(
+        "--retrieval",
+        choices=["local", "llm", "hybrid"],
+        default="local",
+        help=(
+            "How to find the relevant files. "
+            "local: Rank the files by their similarity to the question (default). "
+            "llm: Ask the model. "
+            "hybrid: Ask the model and add the best ranked files."
+        ),
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help=(
+            "Write a trace of the stages, commands, file reads and model calls to "
+            "the file (Chrome trace format, open it in https://ui.perfetto.dev)"
+        ),
+    )
+    add_cache_argument(parser)
     args = parser.parse_args()
+    with tracing(args.trace):
+        ask_workspace(args)
+
+
+def ask_workspace(args: argparse.Namespace):
     prompt = args.question
-    model = Models.get_from_env_or_default(Models.MIXTRAL_8_7B.value)
+    model = with_cache(Models.get_from_env_or_default(Models.MIXTRAL_8_7B), args.cache)
     content = Content(prompt=prompt)
 
     keyword_agent = Agent(
@@ -80,63 +127,113 @@ def main():
         top_p=0.8,
     )
 
-    print_step("Add file paths to context")
-    files = run_cmd(
-        ["eza", "-R", "--git-ignore", "--icons=never", "-I", "node_modules"]
-    )
-    content.add_context("FILES", files, TOKEN_LIMIT_FILES)
-    content.dbg_log()
+    # Stages that don't depend on each other run concurrently, while the
+    # context is still added in the same order
+    with ThreadPoolExecutor() as executor:
+        tree_future = executor.submit(
+            run_cmd,
+            ["eza", "-R", "--git-ignore", "--icons=never", "-I", "node_modules"],
+        )
+        readme_future = executor.submit(read_readme)
+        index_future = executor.submit(update_index, args.reindex)
+        executor.submit(token_encoding)
 
-    print_step("Get relevant keywords")
-    answer = keyword_agent.complete(str(content))
-    keywords = re.sub(r""""'`""", "", answer)
-    keywords = re.split(r"[_\-\s]+", keywords)[:10]
-    print_step(f"Search for keywords: [bright_cyan]{' '.join(keywords)}[/bright_cyan]")
-    search = ""
-    for i, keyword in enumerate(keywords):
-        already_used_tokens_search = number_of_tokens(search)
-        if already_used_tokens_search >= TOKEN_LIMIT_SEARCH:
-            print_status(
-                f'Skiping keywords "{" ".join([k for k in keywords[i:]])}" as token limit of {TOKEN_LIMIT_SEARCH} was reached'
+        print_step("Add file paths to context")
+        content.add_context("FILES", tree_future.result(), TOKEN_LIMIT_FILES)
+        content.dbg_log()
+
+        print_step("Get relevant keywords")
+        # With the index, every keyword is searched as soon as it is complete.
+        # Otherwise all keywords are searched together in a single traversal.
+        searches: Dict[str, Future[Dict[str, List[FileHits]]]] = {}
+        answer = ""
+        for token in keyword_agent.stream(str(content)):
+            answer += token
+            if not index_future.done() or index_future.result() is None:
+                continue
+            # The last keyword might not be complete yet
+            for keyword in parse_keywords(answer)[:-1]:
+                if keyword not in searches:
+                    searches[keyword] = executor.submit(
+                        search_keywords,
+                        [keyword],
+                        index_future.result(),
+                        max_count=SEARCH_MAX_COUNT,
+                    )
+        keywords = parse_keywords(answer)
+        print_step(
+            f"Search for keywords: [bright_cyan]{' '.join(keywords)}[/bright_cyan]"
+        )
+        index = index_future.result()
+        retrieval = args.retrieval
+        if retrieval != "llm" and index is None:
+            print_status("Search index is not available, the model selects the files")
+            retrieval = "llm"
+        ranked_files_future = None
+        if retrieval in ("local", "hybrid"):
+            ranked_files_future = executor.submit(
+                rank_files, index, f"{prompt} {' '.join(keywords)}", RETRIEVAL_FILES
             )
-            break
-        search += limit_tokens(
-            grep_keyword(keyword),
-            min(3000, TOKEN_LIMIT_SEARCH - already_used_tokens_search),
+        remaining_hits = search_keywords(
+            [k for k in keywords if k not in searches],
+            index,
+            max_count=SEARCH_MAX_COUNT,
         )
-    content.add_context("SEARCH RESULT RELEVANT KEYWORDS", search, TOKEN_LIMIT_SEARCH)
-    content.dbg_log()
+        hits = {
+            k: searches[k].result()[k] if k in searches else remaining_hits[k]
+            for k in keywords
+        }
+        content.add_context(
+            "SEARCH RESULT RELEVANT KEYWORDS", search_context(hits), TOKEN_LIMIT_SEARCH
+        )
+        content.dbg_log()
 
-    readme_path = Path("./README.md")
-    if readme_path.exists():
-        print_step("Add README.md to context")
-        readme_content = readme_path.read_text()
-        content.add_context("README", readme_content, TOKEN_LIMIT_README)
-
-    print_step("Get relevant files")
-    answer = file_paths_agent.complete(str(content))
-    try:
-        file_paths = json.loads(answer)
-    except Exception as e:
-        print_status(f"No valid JSON list of files provided: {e}")
-        print(render_markdown(answer))
-        return
-    print_step(f"Look into files: [bright_cyan]{' '.join(file_paths)}[/bright_cyan]")
-    files = []
-    for file_path in file_paths:
-        if os.path.splitext(file_path)[1] in ("svg", "csv"):
-            print_status(f"Ignore {file_path}")
-            continue
-        file_path = Path(file_path)
-        if file_path.exists():
-            try:
+        readme_content = readme_future.result()
+        if readme_content is not None:
+            print_step("Add README.md to context")
+            content.add_context("README", readme_content, TOKEN_LIMIT_README)
+
+        print_step("Get relevant files")
+        # Every file is read as soon as its path is complete
+        file_paths: List[str] = []
+        reads: Dict[str, Future[Optional[str]]] = {}
+
+        def add_file_path(file_path: str):
+            file_paths.append(file_path)
+            if file_path not in reads:
+                reads[file_path] = executor.submit(read_file, file_path)
+
+        if retrieval in ("llm", "hybrid"):
+            parser = StringArrayParser()
+            answer = ""
+            for token in file_paths_agent.stream(str(content)):
+                answer += token
+                for file_path in parser.push(token):
+                    add_file_path(file_path)
+            if not parser.found:
+                print_status("No JSON list of files provided")
+                # Answered directly, unless the model only stands in for the index
+                if args.retrieval == "llm":
+                    print(render_markdown(answer))
+                    return
+            elif not parser.completed:
+                print_status("Incomplete JSON list of files provided")
+        if ranked_files_future is not None:
+            known_paths = {Path(p) for p in file_paths}
+            for file_path in ranked_files_future.result():
+                if Path(file_path) not in known_paths:
+                    add_file_path(file_path)
+        print_step(
+            f"Look into files: [bright_cyan]{' '.join(file_paths)}[/bright_cyan]"
+        )
+        files = []
+        for file_path in file_paths:
+            file_content = reads[file_path].result()
+            if file_content is not None:
                 file_content = limit_tokens(
-                    file_path.read_text(),
-                    TOKEN_LIMIT_FILE_CONTENT // len(file_paths),
+                    file_content, TOKEN_LIMIT_FILE_CONTENT // len(file_paths)
                 )
-                files.append(f"=> CONTENT {file_path}:\n{file_content}")
-            except Exception:
-                print_error(f"Failed to read {file_path}")
+                files.append(f"=> CONTENT {Path(file_path)}:\n{file_content}")
     files_context = "\n\n------------------\n\n".join(files)
     content.add_context(
         "CONTENT OF SOME RELEVANT FILES", files_context, TOKEN_LIMIT_FILE_CONTENT
@@ -149,13 +246,58 @@ def main():
     print_stream(answer, render_markdown)
 
 
+def parse_keywords(answer: str) -> List[str]:
+    keywords = re.sub(r""""'`""", "", answer)
+    return re.split(r"[_\-\s]+", keywords)[:10]
+
+
+def search_context(hits: Dict[str, List[FileHits]]) -> str:
+    windows = rank_hits(hits)
+    selected_windows = pack_windows(windows, TOKEN_LIMIT_SEARCH)
+    if len(selected_windows) < len(windows):
+        print_status(
+            f"Selected {len(selected_windows)} of {len(windows)} search results as token limit of {TOKEN_LIMIT_SEARCH} was reached"
+        )
+    return format_windows(selected_windows)
+
+
+def read_readme() -> Optional[str]:
+    readme_path = Path("./README.md")
+    if readme_path.exists():
+        return readme_path.read_text()
+    return None
+
+
+def read_file(file_path: str) -> Optional[str]:
+    if os.path.splitext(file_path)[1] in ("svg", "csv"):
+        print_status(f"Ignore {file_path}")
+        return None
+    path = Path(file_path)
+    if not path.exists():
+        return None
+    with span(f"Read {file_path}", "file") as args:
+        try:
+            text = path.read_text()
+        except Exception:
+            print_error(f"Failed to read {path}")
+            return None
+        if is_tracing():
+            args.update(text_args("output", text))
+        return text
+
+
 @dataclass
 class Content:
     prompt: str
     context: List[str] = field(default_factory=list)
+    tokens: TokenCounter = field(default_factory=TokenCounter)
 
     def add_context(self, prefix: str, value: str, token_limit: int):
-        limited_value = limit_tokens(value, token_limit)
+        with span(f"Add {prefix}", "context") as args:
+            tokens = self.tokens.count
+            limited_value = self.tokens.add_limited(value, token_limit)
+            args["tokens"] = self.tokens.count - tokens
+            args["bytes"] = len(limited_value.encode("utf-8"))
         if len(limited_value) < len(value):
             print(
                 f"- Limited context to {token_limit} (From {number_of_tokens(value)})"
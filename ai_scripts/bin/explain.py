@@ -1,15 +1,34 @@
 #!/usr/bin/env python3
+import argparse
 import sys
+from typing import List, Tuple
 
+from ai_scripts.lib.cache import add_cache_argument, with_cache
 from ai_scripts.lib.logging import print_stream, render_markdown
 from ai_scripts.lib.agent import Agent
 from ai_scripts.lib.model import Models
 
+# Options of explain, every other argument is part of the explained command
+OPTIONS = ["-h", "--help", "--cache", "--no-cache"]
+
 
 def main():
-    prompt = " ".join(sys.argv[1:])
+    parser = argparse.ArgumentParser(
+        prog="explain",
+        description="Explain a cli command and its options",
+    )
+    add_cache_argument(parser)
+    parser.add_argument(
+        "command",
+        help="The command that should be explained. "
+        "Options of explain are only read before it, `--` ends them explicitly.",
+        nargs="*",
+    )
+    options, command = split_options(sys.argv[1:])
+    args = parser.parse_args(options)
+    prompt = " ".join(command)
     answer = Agent(
-        model=Models.get_from_env_or_default(),
+        model=with_cache(Models.get_from_env_or_default(), args.cache),
         system_prompt=(
             "You are an AI working as a shell expert. "
             "You are prompted with a shell command and "
@@ -43,5 +62,18 @@ def main():
     print_stream(answer, render_markdown)
 
 
+def split_options(argv: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    Splits the arguments into the leading options of explain and the command, which
+    can start with a dash (e.g. `explain -l`) or contain `--cache` itself
+    """
+    for i, arg in enumerate(argv):
+        if arg == "--":
+            return argv[:i], argv[i + 1 :]
+        if arg not in OPTIONS:
+            return argv[:i], argv[i:]
+    return argv, []
+
+
 if __name__ == "__main__":
     main()
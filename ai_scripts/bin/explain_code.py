@@ -2,9 +2,9 @@
 import argparse
 from typing import Optional
 
-import pyperclip
-
+from ai_scripts.lib.cache import add_cache_argument, with_cache
 from ai_scripts.lib.logging import print_stream, render_markdown
+from ai_scripts.lib import clipboard
 from ai_scripts.lib.agent import Agent
 from ai_scripts.lib.model import Models
 
@@ -23,17 +23,17 @@ def main():
         "code",
         help="The code that should be explained. Defaults to code in clipboard.",
         nargs="?",
-        default=pyperclip.paste(),
     )
+    add_cache_argument(parser)
     args = parser.parse_args()
-    code: str = args.code
+    code: str = args.code or clipboard.paste()
     prompt: Optional[str] = args.prompt
     message = ""
     if prompt is not None:
         message += f"{prompt}\n\n"
     message += f"```\n{code}\n```"
     answer = Agent(
-        model=Models.get_from_env_or_default(),
+        model=with_cache(Models.get_from_env_or_default(), args.cache),
         system_prompt=(
             "You are a helpful AI working as an expert programmer. "
             "You are prompted with some code and you will explain what each line does by adding comments to the code.\n"
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import argparse
 
+from ai_scripts.lib.cache import add_cache_argument, with_cache
 from ai_scripts.lib.logging import (
     print_stream,
     render_markdown,
@@ -25,6 +26,7 @@ def main():
         action="store_true",
         default=False,
     )
+    add_cache_argument(parser)
     args = parser.parse_args()
     prompt: str = args.prompt
     summary: bool = args.summary
@@ -33,7 +35,7 @@ def main():
         return txt if summary else fallback
 
     answer = Agent(
-        model=Models.get_from_env_or_default(),
+        model=with_cache(Models.get_from_env_or_default(), args.cache),
         system_prompt=(
             "You are an AI working as a coding and documentation expert. \n"
             "You are prompted with a programming library or method or any other tool "
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 import argparse
 import os
-import pyperclip
 
+from ai_scripts.lib.cache import add_cache_argument, with_cache
 from ai_scripts.lib.logging import print_stream, render_syntax
+from ai_scripts.lib import clipboard
 from ai_scripts.lib.agent import Agent
 from ai_scripts.lib.model import Models
 
@@ -18,11 +19,12 @@ def main():
         "task",
         help="The task that should be executed by the shell script",
     )
+    add_cache_argument(parser)
     args = parser.parse_args()
     prompt = args.task
     shell = os.getenv("SHELL") or "sh"
     answer = Agent(
-        model=Models.get_from_env_or_default(),
+        model=with_cache(Models.get_from_env_or_default(), args.cache),
         system_prompt=(
             "You are an AI working as a shell. You are prompted with a task and "
             "you are ONLY responding with a shell command to execute that task "
@@ -33,7 +35,7 @@ def main():
         top_p=0.8,
     ).stream(f"How {prompt}")
     answer = print_stream(answer, lambda s: render_syntax(s, "shell"))
-    pyperclip.copy(answer)
+    clipboard.copy(answer)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 import argparse
-import pyperclip
 
+from ai_scripts.lib.cache import add_cache_argument, with_cache
 from ai_scripts.lib.logging import (
     print_stream_and_extract_code,
 )
+from ai_scripts.lib import clipboard
 from ai_scripts.lib.agent import Agent
 from ai_scripts.lib.model import Models
 
@@ -22,11 +23,12 @@ def main():
         "prompt",
         help="The prompt that describes what should be implemented",
     )
+    add_cache_argument(parser)
     args = parser.parse_args()
     language = args.language
     prompt = args.prompt
     answer = Agent(
-        model=Models.get_from_env_or_default(),
+        model=with_cache(Models.get_from_env_or_default(), args.cache),
         system_prompt=(
             "You are an AI working as a coding expert."
             "You are prompted with a desription and a language and you are ONLY responding with the code that implements that task.\n"
@@ -81,7 +83,7 @@ def main():
         presence_penalty=1,
     ).stream(f"language: {language}\n" f"prompt:\n{prompt}\n")
     answer = print_stream_and_extract_code(answer, language)
-    pyperclip.copy(answer)
+    clipboard.copy(answer)
 
 
 if __name__ == "__main__":
@@ -4,8 +4,8 @@ import subprocess
 from enum import Enum
 from pathlib import Path
 
-import pyperclip
-
+from ai_scripts.lib.cache import add_cache_argument, with_cache
+from ai_scripts.lib import clipboard
 from ai_scripts.lib.agent import Agent
 from ai_scripts.lib.logging import (
     print_error,
@@ -32,7 +32,7 @@ def main():
         "code",
         help="The code that should be changed",
         nargs="?",
-        default=pyperclip.paste(),
+        default="",
     )
     parser.add_argument(
         "-l",
@@ -53,6 +53,7 @@ def main():
         choices=list(Format),
         default=Format.CODE,
     )
+    add_cache_argument(parser)
     args = parser.parse_args()
     language: str = args.language
     prompt: str = args.prompt
@@ -62,6 +63,8 @@ def main():
 
     if file != "":
         code = Path(file).read_text()
+    elif code == "":
+        code = clipboard.paste()
 
     if code.strip() == "":
         print_error(
@@ -126,7 +129,7 @@ def main():
         message += f"language: {language}\n"
     message += f"code:\n{code}"
     answer = Agent(
-        model=Models.get_from_env_or_default(),
+        model=with_cache(Models.get_from_env_or_default(), args.cache),
         system_prompt=(
             "You are an AI working as a coding expert."
             f"You are prompted with a prompt and a code snippet and you are ONLY responding {format_prompt}\n"
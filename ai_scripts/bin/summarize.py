@@ -1,11 +1,25 @@
 #!/usr/bin/env python3
 import argparse
 import sys
-from bs4 import BeautifulSoup
+from typing import List
 
-from ai_scripts.lib.logging import print_stream, render_markdown
+from ai_scripts.lib.batch import add_batch_arguments, run_batch
+from ai_scripts.lib.cache import add_cache_argument, with_cache
+from ai_scripts.lib.html import read_chunks, read_text
+from ai_scripts.lib.logging import print_status, print_stream, render_markdown
 from ai_scripts.lib.agent import Agent
 from ai_scripts.lib.model import Models
+from ai_scripts.lib.tokenizing import limit_tokens, number_of_tokens, split_chunks
+
+# Tokens of the context that are left for the summary of a chunk
+ANSWER_TOKENS = 2000
+# Upper bound of the system prompts and the message format
+PROMPT_TOKENS = 100
+# Share of the context that is filled, as the tokens are counted with the GPT-4
+# tokenizer and other models can need more tokens for the same text
+CONTEXT_USAGE = 0.8
+# Reading the input stops after this number of tokens
+MAX_INPUT_TOKENS = 100_000
 
 
 def main():
@@ -17,19 +31,110 @@ def main():
         nargs="?",
         help="The text that should be summarized",
     )
+    parser.add_argument(
+        "--chunk-tokens",
+        type=int,
+        help="Longer texts are summarized in chunks of this size and then combined. "
+        "Defaults to what fits into the context of the model, with the prompt and the summary.",
+    )
+    parser.add_argument(
+        "--max-input-tokens",
+        type=int,
+        default=MAX_INPUT_TOKENS,
+        help=f"Only the beginning of longer texts is summarized. Defaults to {MAX_INPUT_TOKENS}.",
+    )
+    add_cache_argument(parser)
+    add_batch_arguments(parser)
     args = parser.parse_args()
-    text_or_html = args.text or sys.stdin.read()
-    text = BeautifulSoup(text_or_html, 'html.parser').get_text()
-    answer = Agent(
-        model=Models.get_from_env_or_default(Models.MIXTRAL_8_7B.value),
+    model = with_cache(Models.get_from_env_or_default(Models.MIXTRAL_8_7B), args.cache)
+    agent = Agent(
+        model=model,
         system_prompt=(
             "You are an helpful AI assistance and professional summarizer. "
             "You are given a text and summarize it to its key points in a structured format."
         ),
         top_p=0.3,
-    ).stream(f"{text}")
+    )
+    if args.batch is not None:
+        run_batch(agent, args, prepare=lambda t: read_text([t], args.max_input_tokens))
+        return
+    chunks = [args.text] if args.text else read_chunks(sys.stdin)
+    text = read_text(chunks, args.max_input_tokens)
+    chunk_tokens = args.chunk_tokens or default_chunk_tokens(model.name)
+    if number_of_tokens(text) > chunk_tokens:
+        chunk_agent = Agent(
+            model=model,
+            system_prompt=(
+                "You are an helpful AI assistance and professional summarizer. "
+                "You are given a part of a longer text and summarize it to its key points in a structured format."
+            ),
+            top_p=0.3,
+        )
+        summaries = map_summaries(
+            chunk_agent, text, chunk_tokens, max(args.concurrency, 1)
+        )
+        agent = Agent(
+            model=model,
+            system_prompt=(
+                "You are an helpful AI assistance and professional summarizer. "
+                "You are given the summaries of consecutive parts of a text, separated by ---. "
+                "Combine them into a single summary of the key points of the whole text in a structured format."
+            ),
+            top_p=0.3,
+        )
+        text = "\n\n---\n\n".join(summaries)
+        # The summaries stop being summarized again if they don't get shorter
+        if number_of_tokens(text) > chunk_tokens:
+            print_status(
+                f"The summaries exceed {chunk_tokens} tokens, only the beginning is combined"
+            )
+            text = limit_tokens(text, chunk_tokens)
+    answer = agent.stream(f"{text}")
     print_stream(answer, render_markdown)
 
 
+def default_chunk_tokens(model_name: str) -> int:
+    """Largest chunk that fits into the context together with the prompt and the summary"""
+    context_tokens = Models.context_tokens(model_name)
+    # Small contexts (e.g. of ollama) can't spare the full answer budget
+    answer_tokens = min(ANSWER_TOKENS, context_tokens // 4)
+    return int(context_tokens * CONTEXT_USAGE) - answer_tokens - PROMPT_TOKENS
+
+
+def map_summaries(
+    agent: Agent, text: str, chunk_tokens: int, concurrency: int
+) -> List[str]:
+    """
+    Summarizes the chunks of the text in parallel. The summaries are summarized
+    again until all of them fit into a single chunk.
+    """
+    import asyncio
+
+    async def summarize_chunks(chunks: List[str]) -> List[str]:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def summarize_chunk(chunk: str) -> str:
+            async with semaphore:
+                return await agent.acomplete(chunk)
+
+        return await asyncio.gather(*(summarize_chunk(c) for c in chunks))
+
+    async def summarize_levels() -> List[str]:
+        chunks = split_chunks(text, chunk_tokens)
+        while True:
+            print_status(f"Summarizing {len(chunks)} chunks")
+            summaries = await summarize_chunks(chunks)
+            combined = "\n\n".join(summaries)
+            next_chunks = split_chunks(combined, chunk_tokens)
+            # Stop if the summaries don't get shorter, to not loop forever
+            if len(next_chunks) <= 1 or len(next_chunks) >= len(chunks):
+                return summaries
+            chunks = next_chunks
+
+    # A single event loop for all levels, as the async clients of the SDKs keep
+    # their connections bound to the loop that opened them
+    return asyncio.run(summarize_levels())
+
+
 if __name__ == "__main__":
     main()
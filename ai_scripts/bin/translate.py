@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 import argparse
 
-import pyperclip
-
+from ai_scripts.lib.batch import add_batch_arguments, run_batch
+from ai_scripts.lib.cache import add_cache_argument, with_cache
 from ai_scripts.lib.logging import print_stream, render_markdown
+from ai_scripts.lib import clipboard
 from ai_scripts.lib.agent import Agent
 from ai_scripts.lib.model import Models
 
@@ -23,11 +24,12 @@ def main():
         nargs="?",
         help="The text that should be summarized",
     )
+    add_cache_argument(parser)
+    add_batch_arguments(parser)
     args = parser.parse_args()
     language = args.language
-    text = args.text or pyperclip.paste()
-    answer = Agent(
-        model=Models.get_from_env_or_default(),
+    agent = Agent(
+        model=with_cache(Models.get_from_env_or_default(), args.cache),
         system_prompt=(
             "You are an helpful AI assistance and professional translater.\n"
             f"You are given a text and translate it to {language}.\n"
@@ -35,7 +37,12 @@ def main():
             "ONLY OUTPUT THE TRANSLATED TEXT, NO FURTHER DESCRIPTION OR NOTES"
         ),
         top_p=0.3,
-    ).stream(f"{text}")
+    )
+    if args.batch is not None:
+        run_batch(agent, args)
+        return
+    text = args.text or clipboard.paste()
+    answer = agent.stream(f"{text}")
     print_stream(answer, render_markdown)
 
 
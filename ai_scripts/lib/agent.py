@@ -1,7 +1,6 @@
-from typing import Iterable, List, Unpack
+from typing import AsyncIterator, Iterable, List, Unpack
 
-from openai.types.chat import ChatCompletionMessageParam
-from ai_scripts.lib.model import ChatOptions, Model
+from ai_scripts.lib.model import ChatOptions, Message, Model
 
 
 class Agent:
@@ -24,7 +23,19 @@ class Agent:
             **self.options,
         )
 
-    def _messages(self, user_prompt: str) -> List[ChatCompletionMessageParam]:
+    async def acomplete(self, user_prompt: str) -> str:
+        return await self.model.acomplete(
+            messages=self._messages(user_prompt),
+            **self.options,
+        )
+
+    def astream(self, user_prompt: str) -> AsyncIterator[str]:
+        return self.model.astream(
+            messages=self._messages(user_prompt),
+            **self.options,
+        )
+
+    def _messages(self, user_prompt: str) -> List[Message]:
         return [
             {"role": "system", "content": self.system_prompt},
             {"role": "user", "content": user_prompt},
@@ -0,0 +1,170 @@
+import argparse
+from dataclasses import dataclass
+import glob
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from ai_scripts.lib.agent import Agent
+from ai_scripts.lib.logging import print_error, print_status
+
+DEFAULT_CONCURRENCY = 8
+
+
+@dataclass
+class BatchItem:
+    id: str
+    # Items of files are read when they are processed
+    text: Optional[str] = None
+    path: Optional[Path] = None
+
+    def read(self) -> str:
+        if self.text is not None:
+            return self.text
+        assert self.path is not None
+        return self.path.read_text()
+
+
+@dataclass
+class BatchResult:
+    item: BatchItem
+    output: Optional[str] = None
+    error: Optional[str] = None
+
+
+def add_batch_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--batch",
+        nargs="*",
+        metavar="FILE",
+        help=(
+            "Process multiple files or globs. Without files, NDJSON is read from stdin, "
+            'one string or {"id": ..., "text": ...} object per line.'
+        ),
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=int(os.getenv("AI_SCRIPTS_CONCURRENCY") or DEFAULT_CONCURRENCY),
+        help=f"Maximum number of parallel requests. Defaults to {DEFAULT_CONCURRENCY}.",
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=Path,
+        help="Write the output for each file of the batch into this directory instead of NDJSON to stdout",
+    )
+
+
+def run_batch(
+    agent: Agent,
+    args: argparse.Namespace,
+    prepare: Callable[[str], str] = lambda s: s,
+):
+    """
+    Runs the agent for every item of the batch, with at most `args.concurrency`
+    requests at the same time. Results are written in input order, either as NDJSON
+    to stdout or into `args.output_dir`.
+    """
+    import asyncio
+
+    items = read_items(args.batch)
+    results = asyncio.run(
+        _run(agent, items, prepare, max(args.concurrency, 1), args.output_dir)
+    )
+    failed = [r for r in results if r.error is not None]
+    for result in failed:
+        print_error(f"{result.item.id}: {result.error}")
+    print_status(f"Processed {len(results) - len(failed)} of {len(results)} items")
+    if len(failed) > 0:
+        sys.exit(1)
+
+
+def read_items(patterns: List[str]) -> List[BatchItem]:
+    if len(patterns) == 0:
+        return _read_ndjson()
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        paths.extend(matches if glob.has_magic(pattern) else [pattern])
+    return [BatchItem(path, path=Path(path)) for path in dict.fromkeys(paths)]
+
+
+def _read_ndjson() -> List[BatchItem]:
+    items = []
+    for i, line in enumerate(sys.stdin):
+        if line.strip() == "":
+            continue
+        value = json.loads(line)
+        if isinstance(value, str):
+            items.append(BatchItem(str(i + 1), value))
+        else:
+            items.append(BatchItem(str(value.get("id", i + 1)), value["text"]))
+    return items
+
+
+async def _run(
+    agent: Agent,
+    items: List[BatchItem],
+    prepare: Callable[[str], str],
+    concurrency: int,
+    output_dir: Optional[Path],
+) -> List[BatchResult]:
+    import asyncio
+    from rich.console import Console
+    from rich.progress import Progress
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def process(item: BatchItem) -> BatchResult:
+        async with semaphore:
+            try:
+                output = await agent.acomplete(prepare(item.read()))
+                return BatchResult(item, output=output)
+            except Exception as e:
+                return BatchResult(item, error=str(e) or type(e).__name__)
+
+    tasks = [asyncio.create_task(process(item)) for item in items]
+    progress = None
+    if sys.stderr.isatty():
+        progress = Progress(console=Console(stderr=True), transient=True)
+        task_id = progress.add_task("Processing", total=len(items))
+        for task in tasks:
+            task.add_done_callback(lambda _: progress.advance(task_id))
+        progress.start()
+    results = []
+    try:
+        # Await in input order, so finished results can be written right away
+        for task in tasks:
+            result = await task
+            _write_result(result, output_dir)
+            results.append(result)
+    finally:
+        if progress is not None:
+            progress.stop()
+    return results
+
+
+def _write_result(result: BatchResult, output_dir: Optional[Path]):
+    if output_dir is not None and result.item.path is not None:
+        if result.output is None:
+            return
+        path = output_dir / _relative_output_path(result.item.path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(result.output)
+        return
+    if result.error is not None:
+        line = {"id": result.item.id, "error": result.error}
+    else:
+        line = {"id": result.item.id, "output": result.output}
+    sys.stdout.write(json.dumps(line, ensure_ascii=False) + "\n")
+    sys.stdout.flush()
+
+
+def _relative_output_path(path: Path) -> Path:
+    # Keeps the folder structure, without escaping the output directory
+    path = Path(os.path.relpath(path.resolve()))
+    if path.parts[0] == "..":
+        return Path(path.name)
+    return path
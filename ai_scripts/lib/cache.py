@@ -0,0 +1,212 @@
+import argparse
+from contextlib import closing
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, AsyncIterator, Iterable, List, Optional
+
+from ai_scripts.lib.env import cache_dir
+from ai_scripts.lib.logging import print_status
+from ai_scripts.lib.model import ChatOptions, Message, Model
+
+if TYPE_CHECKING:
+    import sqlite3
+
+DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60
+DEFAULT_MAX_SIZE_MB = 100
+# Answers are only cached by default if the sampling is (nearly) deterministic
+DETERMINISTIC_THRESHOLD = 0.3
+
+
+class ResponseCache:
+    """Content addressed store of model responses, evicted by age and size (LRU)"""
+
+    def __init__(self, path: Path, ttl_seconds: float, max_size_bytes: int) -> None:
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_size_bytes = max_size_bytes
+
+    @classmethod
+    def from_env(cls) -> "ResponseCache":
+        ttl = os.getenv("AI_SCRIPTS_CACHE_TTL")
+        max_size_mb = os.getenv("AI_SCRIPTS_CACHE_MAX_MB")
+        return cls(
+            cache_dir() / "responses.sqlite",
+            ttl_seconds=float(ttl) if ttl else DEFAULT_TTL_SECONDS,
+            max_size_bytes=int(float(max_size_mb or DEFAULT_MAX_SIZE_MB) * 1024 * 1024),
+        )
+
+    def get(self, key: str) -> Optional[List[str]]:
+        """Returns the cached chunks, or None if they are missing or unreadable"""
+        import sqlite3
+
+        try:
+            with closing(self._connect()) as conn, conn:
+                now = time.time()
+                row = conn.execute(
+                    "SELECT chunks FROM responses WHERE key = ? AND created_at >= ?",
+                    (key, now - self.ttl_seconds),
+                ).fetchone()
+                if row is None:
+                    return None
+                conn.execute(
+                    "UPDATE responses SET used_at = ? WHERE key = ?", (now, key)
+                )
+                return json.loads(row[0])
+        except (sqlite3.Error, OSError) as e:
+            # The cache is not worth failing the request (e.g. if it is locked)
+            print_status(f"Failed to read the response cache: {e}")
+            return None
+
+    def put(self, key: str, model: str, chunks: List[str]):
+        import sqlite3
+
+        value = json.dumps(chunks)
+        try:
+            with closing(self._connect()) as conn, conn:
+                now = time.time()
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, model, value, len(value), now, now),
+                )
+                self._evict(conn, now)
+        except (sqlite3.Error, OSError) as e:
+            print_status(f"Failed to write the response cache: {e}")
+
+    def _evict(self, conn: "sqlite3.Connection", now: float):
+        conn.execute(
+            "DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,)
+        )
+        size = 0
+        rows = conn.execute("SELECT key, size FROM responses ORDER BY used_at DESC")
+        evicted = []
+        for key, entry_size in rows:
+            size += entry_size
+            if size > self.max_size_bytes:
+                evicted.append((key,))
+        conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def _connect(self) -> "sqlite3.Connection":
+        import sqlite3
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, "
+            "model TEXT NOT NULL, "
+            "chunks TEXT NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, "
+            "used_at REAL NOT NULL)"
+        )
+        return conn
+
+
+class CachedModel(Model):
+    """
+    Serves repeated requests from the response cache. Cached streams are replayed
+    chunk by chunk, so they can be rendered like a live answer.
+    """
+
+    def __init__(self, model: Model, cache: ResponseCache, force: bool = False):
+        self.model = model
+        self.cache = cache
+        self.force = force
+        self.name = model.name
+        self.abbr = model.abbr
+
+    def _complete(self, messages, **kwargs) -> str:
+        if not self._is_cacheable(kwargs):
+            return self.model._complete(messages, **kwargs)
+        key = self._key(messages, kwargs)
+        chunks = self.cache.get(key)
+        if chunks is None:
+            answer = self.model._complete(messages, **kwargs)
+            self.cache.put(key, self.name, [answer])
+            return answer
+        return "".join(chunks)
+
+    def _stream(self, messages, **kwargs) -> Iterable[str]:
+        if not self._is_cacheable(kwargs):
+            return self.model._stream(messages, **kwargs)
+        key = self._key(messages, kwargs)
+        chunks = self.cache.get(key)
+        if chunks is None:
+            return self._record(key, self.model._stream(messages, **kwargs))
+        return iter(chunks)
+
+    def _record(self, key: str, stream: Iterable[str]) -> Iterable[str]:
+        chunks = []
+        for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+        # Only reached if the stream was fully consumed
+        self.cache.put(key, self.name, chunks)
+
+    async def _acomplete(self, messages, **kwargs) -> str:
+        if not self._is_cacheable(kwargs):
+            return await self.model._acomplete(messages, **kwargs)
+        key = self._key(messages, kwargs)
+        chunks = self.cache.get(key)
+        if chunks is None:
+            answer = await self.model._acomplete(messages, **kwargs)
+            self.cache.put(key, self.name, [answer])
+            return answer
+        return "".join(chunks)
+
+    async def _astream(self, messages, **kwargs) -> AsyncIterator[str]:
+        if not self._is_cacheable(kwargs):
+            async for chunk in self.model._astream(messages, **kwargs):
+                yield chunk
+            return
+        key = self._key(messages, kwargs)
+        chunks = self.cache.get(key)
+        if chunks is not None:
+            for chunk in chunks:
+                yield chunk
+            return
+        chunks = []
+        async for chunk in self.model._astream(messages, **kwargs):
+            chunks.append(chunk)
+            yield chunk
+        # Only reached if the stream was fully consumed
+        self.cache.put(key, self.name, chunks)
+
+    def _is_cacheable(self, options: ChatOptions) -> bool:
+        if self.force:
+            return True
+        temperature = options.get("temperature")
+        top_p = options.get("top_p")
+        return (temperature is not None and temperature <= DETERMINISTIC_THRESHOLD) or (
+            top_p is not None and top_p <= DETERMINISTIC_THRESHOLD
+        )
+
+    def _key(self, messages: List[Message], options: ChatOptions) -> str:
+        request = json.dumps(
+            {"model": self.name, "messages": messages, "options": options},
+            sort_keys=True,
+        )
+        return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+
+def with_cache(model: Model, enabled: Optional[bool] = None) -> Model:
+    """
+    Wraps the model with the response cache.
+    If `enabled` is None only deterministic requests are cached, True forces caching
+    of all requests and False disables the cache.
+    """
+    if enabled is False or os.getenv("AI_SCRIPTS_CACHE") == "0":
+        return model
+    return CachedModel(model, ResponseCache.from_env(), force=enabled is True)
+
+
+def add_cache_argument(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--cache",
+        default=None,
+        action=argparse.BooleanOptionalAction,
+        help="Cache the answers. By default only answers with a low temperature or top_p are cached.",
+    )
@@ -0,0 +1,10 @@
+def copy(text: str):
+    import pyperclip
+
+    pyperclip.copy(text)
+
+
+def paste() -> str:
+    import pyperclip
+
+    return pyperclip.paste()
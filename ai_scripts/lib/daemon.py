@@ -0,0 +1,226 @@
+import json
+import os
+import socket
+import socketserver
+import tempfile
+from pathlib import Path
+from typing import AsyncIterator, Iterable, List, Optional
+
+from ai_scripts.lib.logging import print_error, print_status, print_step
+from ai_scripts.lib.model import ChatOptions, Message, Model, ModelDescriptor, Models
+from ai_scripts.lib.telemetry import command_name, current_command
+
+# Complete answers are sent as a single line
+MAX_LINE_BYTES = 64 * 1024 * 1024
+
+_serving = False
+
+
+class DaemonError(Exception):
+    pass
+
+
+def socket_path() -> Path:
+    path = os.getenv("AI_SCRIPTS_SOCKET")
+    if path:
+        return Path(path)
+    runtime_dir = os.getenv("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return Path(runtime_dir) / f"ai-scripts-{os.getuid()}.sock"
+    return _private_dir() / "daemon.sock"
+
+
+def _private_dir() -> Path:
+    """Directory in the shared temporary directory, only accessible by the user"""
+    return Path(tempfile.gettempdir()) / f"ai-scripts-{os.getuid()}"
+
+
+def owned_socket_path() -> Path:
+    """
+    Returns the path of the socket, if it belongs to the current user. Otherwise
+    another user could receive all requests, so a PermissionError is raised.
+    """
+    path = socket_path()
+    if os.stat(path).st_uid != os.getuid():
+        raise PermissionError(f"{path} belongs to another user")
+    return path
+
+
+def is_available() -> bool:
+    """Whether requests should be send to a running daemon"""
+    if _serving or os.getenv("AI_SCRIPTS_DAEMON") == "0":
+        return False
+    try:
+        owned_socket_path()
+        return True
+    except PermissionError as e:
+        print_error(f"Ignoring the daemon: {e}")
+        return False
+    except OSError:
+        return False
+
+
+class RemoteModel(Model):
+    """
+    Forwards the requests to the daemon. Falls back to the local model if the
+    daemon cannot be reached.
+    """
+
+    def __init__(self, descriptor: ModelDescriptor) -> None:
+        self.descriptor = descriptor
+        self.name = descriptor.name
+        self.abbr = descriptor.abbr
+
+    def _complete(self, messages, **kwargs) -> str:
+        return "".join(self._request(messages, kwargs, stream=False))
+
+    def _stream(self, messages, **kwargs) -> Iterable[str]:
+        return self._request(messages, kwargs, stream=True)
+
+    async def _acomplete(self, messages, **kwargs) -> str:
+        chunks = [c async for c in self._arequest(messages, kwargs, stream=False)]
+        return "".join(chunks)
+
+    async def _astream(self, messages, **kwargs) -> AsyncIterator[str]:
+        async for token in self._arequest(messages, kwargs, stream=True):
+            yield token
+
+    def _request(
+        self, messages: List[Message], options: ChatOptions, stream: bool
+    ) -> Iterable[str]:
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(str(owned_socket_path()))
+        except (FileNotFoundError, ConnectionRefusedError, PermissionError):
+            local_model = self.descriptor.load_local()
+            if stream:
+                yield from local_model._stream(messages, **options)
+            else:
+                yield local_model._complete(messages, **options)
+            return
+        with sock, sock.makefile("rwb") as file:
+            request = {
+                "model": self.name,
+                "messages": messages,
+                "options": options,
+                "stream": stream,
+                "command": command_name(),
+            }
+            file.write(json.dumps(request).encode("utf-8") + b"\n")
+            file.flush()
+            for line in file:
+                response = json.loads(line)
+                if "error" in response:
+                    raise DaemonError(response["error"])
+                if response.get("done"):
+                    return
+                yield response["token"]
+        raise DaemonError("Connection to the daemon closed unexpectedly")
+
+    async def _arequest(
+        self, messages: List[Message], options: ChatOptions, stream: bool
+    ) -> AsyncIterator[str]:
+        import asyncio
+
+        try:
+            reader, writer = await asyncio.open_unix_connection(
+                str(owned_socket_path()), limit=MAX_LINE_BYTES
+            )
+        except (FileNotFoundError, ConnectionRefusedError, PermissionError):
+            local_model = self.descriptor.load_local()
+            if stream:
+                async for token in local_model._astream(messages, **options):
+                    yield token
+            else:
+                yield await local_model._acomplete(messages, **options)
+            return
+        try:
+            request = {
+                "model": self.name,
+                "messages": messages,
+                "options": options,
+                "stream": stream,
+                "command": command_name(),
+            }
+            writer.write(json.dumps(request).encode("utf-8") + b"\n")
+            await writer.drain()
+            async for line in reader:
+                response = json.loads(line)
+                if "error" in response:
+                    raise DaemonError(response["error"])
+                if response.get("done"):
+                    return
+                yield response["token"]
+        finally:
+            writer.close()
+        raise DaemonError("Connection to the daemon closed unexpectedly")
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            model = Models.get_by_name(request["model"])
+            messages: List[Message] = request["messages"]
+            options: ChatOptions = request["options"]
+            current_command.set(request.get("command"))
+            if request["stream"]:
+                for token in model.stream(messages, **options):
+                    self._send({"token": token})
+            else:
+                self._send({"token": model.complete(messages, **options)})
+            self._send({"done": True})
+        except BrokenPipeError:
+            # The client was cancelled
+            pass
+        except Exception as e:
+            print_error(f"Request failed: {e}")
+            self._send({"error": str(e)})
+
+    def _send(self, response: dict):
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(preload: Optional[List[str]] = None):
+    """Runs the daemon in the foreground until it is interrupted"""
+    global _serving
+    _serving = True
+
+    from ai_scripts.lib.tokenizing import token_encoding
+
+    print_step("Warm up")
+    token_encoding()
+    for name in preload or []:
+        Models.get_by_name(name)
+        print_status(f"Loaded {name}")
+
+    path = socket_path()
+    if path.parent == _private_dir():
+        path.parent.mkdir(mode=0o700, exist_ok=True)
+        stat = path.parent.stat()
+        if stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+            print_error(f"{path.parent} must only be accessible by the current user")
+            return
+    if path.exists():
+        try:
+            socket.socket(socket.AF_UNIX, socket.SOCK_STREAM).connect(str(path))
+            print_error(f"Daemon is already running on {path}")
+            return
+        except ConnectionRefusedError:
+            # Left over from a daemon that wasn't shut down cleanly
+            path.unlink()
+
+    with Server(str(path), RequestHandler) as server:
+        path.chmod(0o600)
+        print_step(f"Listening on {path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            path.unlink(missing_ok=True)
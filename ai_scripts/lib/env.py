@@ -1,5 +1,15 @@
 import os
+from pathlib import Path
 
 
 def is_debbuging() -> bool:
     return os.getenv("DEBUG") == "1"
+
+
+def cache_dir() -> Path:
+    """Directory for files that can be recreated at any time"""
+    path = os.getenv("AI_SCRIPTS_CACHE_DIR")
+    if path:
+        return Path(path)
+    xdg_cache_home = os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(xdg_cache_home) / "ai-scripts"
@@ -1,41 +1,235 @@
+from contextlib import closing
+from dataclasses import dataclass, field
+import json
+import re
 from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Literal, Optional
 
-from ai_scripts.lib.sh import run_cmd
+from ai_scripts.lib.sh import stream_cmd
+from ai_scripts.lib.tracing import span
+
+if TYPE_CHECKING:
+    from ai_scripts.lib.index import WorkspaceIndex
+
+# Maximum number of matching lines per keyword and file
+MAX_COUNT = 8
+# Reading the output of the search tools stops once every keyword has matches in
+# this number of files
+MAX_FILES = 100
+MAX_COLUMNS = 100
+
+git_grep_line_regex = re.compile(r"^(\d+)([:=-])(.*)$")
+
+
+@dataclass
+class SearchLine:
+    number: int
+    text: str
+    kind: Literal["match", "context", "function"]
+
+
+@dataclass
+class FileHits:
+    path: str
+    lines: List[SearchLine] = field(default_factory=list)
 
 
 def grep_keyword(keyword: str) -> str:
-    if Path("./.git").exists():
-        return run_cmd(
-            [
-                "git",
-                "grep",
-                "--max-count=8",
-                "--show-function",
-                "--heading",
-                "--line-number",
-                "--break",
-                "--ignore-case",
-                "--context=1",
-                keyword,
-                "--",
-                ":!.*",
-            ]
-        )
+    return format_hits(search_keywords([keyword])[keyword])
+
+
+def search_keywords(
+    keywords: List[str],
+    index: Optional["WorkspaceIndex"] = None,
+    max_count: int = MAX_COUNT,
+    max_files: int = MAX_FILES,
+) -> Dict[str, List[FileHits]]:
+    """
+    Searches all keywords in a single traversal of the workspace and returns the
+    hits for each keyword. The search index is used if it is given and usable.
+    Only the first `max_files` files with matches are returned for each keyword.
+    """
+    patterns = list(dict.fromkeys(k for k in keywords if k != ""))
+    hits: Dict[str, List[FileHits]] = {k: [] for k in keywords}
+    if len(patterns) == 0:
+        return hits
+    is_git = Path("./.git").exists()
+    if is_git:
+        ignore_case = {k: True for k in patterns}
     else:
+        # Equivalent to --smart-case for each keyword
+        ignore_case = {k: k.lower() == k for k in patterns}
+    with span(f"Search {' '.join(patterns)}", "search") as args:
+        files = None
+        if index is not None:
+            from ai_scripts.lib.index import search_index
+
+            files = search_index(index, patterns, ignore_case, max_count, max_files)
+        args["index"] = files is not None
+        if files is not None:
+            args["files"] = _add_hits(hits, files, ignore_case, max_count, max_files)
+            return hits
+        # The tools can only limit the matches of all keywords combined, so they
+        # get a limit for all of them and the limit per keyword is applied
+        # afterwards. A frequent keyword can still use up the matches of a file.
+        tool_max_count = max_count * len(patterns)
         # Fallback to ripgrep if it isn't a git repository
-        result = run_cmd(
-            [
-                "rg",
-                "--max-count=8",
-                "--heading",
-                "--line-number",
-                "--smart-case",
-                "--context=1",
-                "--max-columns=100",
-                "--max-columns-preview",
-                keyword,
-                ".",
-            ]
-        )
-        result.replace("[... omitted end of long line]", "[...]")
-        return result
+        if is_git:
+            search = _git_grep(patterns, tool_max_count)
+        else:
+            search = _ripgrep(patterns, tool_max_count)
+        # Closing the search stops the tool, if its output isn't read to the end
+        with closing(search):
+            args["files"] = _add_hits(hits, search, ignore_case, max_count, max_files)
+    return hits
+
+
+def format_hits(hits: List[FileHits]) -> str:
+    """Formats the hits like `git grep --heading --break --line-number`"""
+    result = []
+    for file in hits:
+        lines = [file.path]
+        previous_number = None
+        for line in file.lines:
+            if previous_number is not None and line.number > previous_number + 1:
+                lines.append("--")
+            separator = {"match": ":", "context": "-", "function": "="}[line.kind]
+            lines.append(f"{line.number}{separator}{line.text}")
+            previous_number = line.number
+        result.append("\n".join(lines) + "\n")
+    return "\n".join(result)
+
+
+def _add_hits(
+    hits: Dict[str, List[FileHits]],
+    files: Iterable[FileHits],
+    ignore_case: Dict[str, bool],
+    max_count: int,
+    max_files: int,
+) -> int:
+    """
+    Adds the hits of each keyword in the files to `hits` and returns the number of
+    files that were read, which stops once every keyword has `max_files` files
+    """
+    n_files = 0
+    for file in files:
+        n_files += 1
+        for keyword in ignore_case:
+            if len(hits[keyword]) == max_files:
+                continue
+            file_hits = _keyword_hits(keyword, file, ignore_case[keyword], max_count)
+            if len(file_hits.lines) > 0:
+                hits[keyword].append(file_hits)
+        if all(len(hits[keyword]) == max_files for keyword in ignore_case):
+            break
+    return n_files
+
+
+def _keyword_hits(
+    keyword: str, file: FileHits, ignore_case: bool, max_count: int
+) -> FileHits:
+    keyword_cmp = keyword.lower() if ignore_case else keyword
+    by_number = {line.number: line for line in file.lines}
+    selected: Dict[int, SearchLine] = {}
+    function_line = None
+    previous = None
+    count = 0
+    for line in file.lines:
+        starts_hunk = previous is None or line.number > previous.number + 1
+        if starts_hunk and previous is not None and previous.kind != "function":
+            # The function line is only valid for the hunk following it
+            function_line = None
+        previous = line
+        if line.kind == "function":
+            function_line = line
+            continue
+        text = line.text.lower() if ignore_case else line.text
+        if line.kind != "match" or keyword_cmp not in text:
+            continue
+        if function_line is not None:
+            selected[function_line.number] = function_line
+        for number in (line.number - 1, line.number + 1):
+            context = by_number.get(number)
+            if context is not None and context.kind != "function":
+                selected.setdefault(number, SearchLine(number, context.text, "context"))
+        selected[line.number] = line
+        count += 1
+        if count >= max_count:
+            break
+    return FileHits(file.path, [selected[n] for n in sorted(selected)])
+
+
+def _git_grep(keywords: List[str], max_count: int) -> Iterator[FileHits]:
+    output = stream_cmd(
+        [
+            "git",
+            "grep",
+            f"--max-count={max_count}",
+            "--show-function",
+            "--heading",
+            "--line-number",
+            "--break",
+            "--ignore-case",
+            "--fixed-strings",
+            "-I",
+            "--context=1",
+            *[arg for keyword in keywords for arg in ("-e", keyword)],
+            "--",
+            ":!.*",
+        ]
+    )
+    file = None
+    with closing(output):
+        for line in output:
+            if line == "":
+                if file is not None:
+                    yield file
+                file = None
+            elif file is None:
+                file = FileHits(line)
+            elif line != "--":
+                match = git_grep_line_regex.match(line)
+                if match is not None:
+                    number, separator, text = match.groups()
+                    kind = {":": "match", "-": "context", "=": "function"}[separator]
+                    file.lines.append(SearchLine(int(number), text, kind))
+    if file is not None:
+        yield file
+
+
+def _ripgrep(keywords: List[str], max_count: int) -> Iterator[FileHits]:
+    output = stream_cmd(
+        [
+            "rg",
+            "--json",
+            f"--max-count={max_count}",
+            "--ignore-case",
+            "--fixed-strings",
+            "--context=1",
+            *[arg for keyword in keywords for arg in ("-e", keyword)],
+            ".",
+        ]
+    )
+    # The events of a file are written together, from "begin" to "end"
+    file = None
+    with closing(output):
+        for event_json in output:
+            event = json.loads(event_json)
+            if event["type"] == "end":
+                if file is not None and len(file.lines) > 0:
+                    yield file
+                file = None
+            if event["type"] not in ("match", "context"):
+                continue
+            data = event["data"]
+            path = data["path"].get("text")
+            text = data["lines"].get("text")
+            if path is None or text is None:
+                # Not valid UTF-8
+                continue
+            text = text.rstrip("\n").removesuffix("\r")
+            if len(text) > MAX_COLUMNS:
+                text = f"{text[:MAX_COLUMNS]} [...]"
+            if file is None:
+                file = FileHits(path)
+            file.lines.append(SearchLine(data["line_number"], text, event["type"]))
@@ -0,0 +1,242 @@
+from contextlib import closing
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, AsyncIterator, Iterable, List, Optional, Tuple
+
+from ai_scripts.lib.env import cache_dir
+from ai_scripts.lib.model import Model
+
+if TYPE_CHECKING:
+    import sqlite3
+
+# Time to wait for the first token of a model, before the next one is started
+DEFAULT_HEDGE_DELAY_MS = 1000
+
+# Marks the end of a stream in the queue of tokens
+_END = object()
+
+
+class HedgeStats:
+    """Records which model of a hedged request produced the first token"""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    @classmethod
+    def from_env(cls) -> "HedgeStats":
+        return cls(cache_dir() / "hedging.sqlite")
+
+    def record(self, models: str, winner: str, hedged: bool, first_token_s: float):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT INTO hedges VALUES (?, ?, ?, ?, ?)",
+                (models, winner, hedged, first_token_s, time.time()),
+            )
+
+    def summary(self) -> List[Tuple[str, str, int, int, float]]:
+        """Returns (models, winner, wins, hedged wins, average first token time)"""
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                "SELECT models, winner, COUNT(*), SUM(hedged), AVG(first_token_s) "
+                "FROM hedges GROUP BY models, winner ORDER BY models, COUNT(*) DESC"
+            ).fetchall()
+
+    def _connect(self) -> "sqlite3.Connection":
+        import sqlite3
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS hedges ("
+            "models TEXT NOT NULL, "
+            "winner TEXT NOT NULL, "
+            "hedged INTEGER NOT NULL, "
+            "first_token_s REAL NOT NULL, "
+            "created_at REAL NOT NULL)"
+        )
+        return conn
+
+
+class HedgedModel(Model):
+    """
+    Sends the request to the first model and, if it didn't produce a token after
+    `delay_s`, also to the next one. The stream of the model with the first token is
+    used and the other requests are cancelled.
+    """
+
+    def __init__(
+        self, models: List[Model], delay_s: float, stats: Optional[HedgeStats]
+    ) -> None:
+        self.models = models
+        self.delay_s = delay_s
+        self.stats = stats
+        self.name = ",".join(m.name for m in models)
+        self.abbr = None
+
+    def _complete(self, messages, **kwargs) -> str:
+        # Streaming reveals which model is the fastest to answer
+        return "".join(self._stream(messages, **kwargs))
+
+    def _stream(self, messages, **kwargs) -> Iterable[str]:
+        tokens: "queue.Queue[Tuple[int, object]]" = queue.Queue()
+        # Set once a model won, to stop the others after their next token. Requests
+        # that are still waiting for their first token can't be interrupted.
+        cancelled = threading.Event()
+        done = threading.Event()
+        winner: Optional[int] = None
+
+        def run(i: int):
+            try:
+                stream = iter(self.models[i]._stream(messages, **kwargs))
+                try:
+                    for token in stream:
+                        if done.is_set() or (cancelled.is_set() and winner != i):
+                            break
+                        tokens.put((i, token))
+                finally:
+                    close = getattr(stream, "close", None)
+                    if close is not None:
+                        close()
+                tokens.put((i, _END))
+            except Exception as e:
+                tokens.put((i, e))
+
+        def start_next():
+            nonlocal started
+            threading.Thread(target=run, args=(started,), daemon=True).start()
+            started += 1
+
+        start = time.monotonic()
+        started = 0
+        failed = 0
+        first_token: Optional[Tuple[int, bool, float]] = None
+        start_next()
+        try:
+            while True:
+                timeout = None
+                if winner is None and started < len(self.models):
+                    timeout = max(start + started * self.delay_s - time.monotonic(), 0)
+                try:
+                    i, item = tokens.get(timeout=timeout)
+                except queue.Empty:
+                    start_next()
+                    continue
+                if winner is not None and i != winner:
+                    continue
+                if winner is None and isinstance(item, Exception):
+                    # Give the other models a chance, if the request failed early
+                    failed += 1
+                    if failed == len(self.models):
+                        raise item
+                    if failed == started:
+                        start_next()
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                if item is not _END and item == "" and winner is None:
+                    continue
+                if winner is None:
+                    winner = i
+                    cancelled.set()
+                    first_token = (i, started > 1, time.monotonic() - start)
+                if item is _END:
+                    return
+                yield str(item)
+        finally:
+            done.set()
+            # Recorded at the end, so writing the stats doesn't delay the tokens
+            if first_token is not None:
+                self._record(*first_token)
+
+    async def _acomplete(self, messages, **kwargs) -> str:
+        return "".join([t async for t in self._astream(messages, **kwargs)])
+
+    async def _astream(self, messages, **kwargs) -> AsyncIterator[str]:
+        import asyncio
+
+        tokens: "asyncio.Queue[Tuple[int, object]]" = asyncio.Queue()
+        tasks: List[asyncio.Task] = []
+
+        async def run(i: int):
+            try:
+                async for token in self.models[i]._astream(messages, **kwargs):
+                    await tokens.put((i, token))
+                await tokens.put((i, _END))
+            except Exception as e:
+                await tokens.put((i, e))
+
+        def start_next():
+            tasks.append(asyncio.create_task(run(len(tasks))))
+
+        start = time.monotonic()
+        winner: Optional[int] = None
+        failed = 0
+        start_next()
+        try:
+            while True:
+                timeout = None
+                if winner is None and len(tasks) < len(self.models):
+                    timeout = max(
+                        start + len(tasks) * self.delay_s - time.monotonic(), 0
+                    )
+                try:
+                    i, item = await asyncio.wait_for(tokens.get(), timeout)
+                except asyncio.TimeoutError:
+                    start_next()
+                    continue
+                if winner is not None and i != winner:
+                    continue
+                if winner is None and isinstance(item, Exception):
+                    failed += 1
+                    if failed == len(self.models):
+                        raise item
+                    if failed == len(tasks):
+                        start_next()
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                if item is not _END and item == "" and winner is None:
+                    continue
+                if winner is None:
+                    winner = i
+                    for j, task in enumerate(tasks):
+                        if j != i:
+                            task.cancel()
+                    # Written in a thread, so neither the tokens nor the event loop
+                    # wait for the stats (asyncio.run waits for it at the end)
+                    asyncio.get_running_loop().run_in_executor(
+                        None,
+                        self._record,
+                        i,
+                        len(tasks) > 1,
+                        time.monotonic() - start,
+                    )
+                if item is _END:
+                    return
+                yield str(item)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _record(self, winner: int, hedged: bool, first_token_s: float):
+        if self.stats is None:
+            return
+        try:
+            self.stats.record(
+                self.name, self.models[winner].name, hedged, first_token_s
+            )
+        except Exception:
+            # Stats are not worth failing the request
+            pass
+
+
+def hedged_model(models: List[Model]) -> Model:
+    delay_ms = os.getenv("AI_SCRIPTS_HEDGE_DELAY_MS")
+    return HedgedModel(
+        models,
+        delay_s=float(delay_ms or DEFAULT_HEDGE_DELAY_MS) / 1000,
+        stats=HedgeStats.from_env(),
+    )
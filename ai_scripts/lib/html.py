@@ -0,0 +1,160 @@
+from html.parser import HTMLParser
+import re
+from typing import IO, Iterable, List, Optional
+
+from ai_scripts.lib.tokenizing import TokenCounter
+
+# Size of the blocks emitted by the extractor, in characters
+BLOCK_CHARS = 4096
+MAX_BLOCK_CHARS = 4 * BLOCK_CHARS
+# Size of the chunks read from a stream
+READ_CHARS = 64 * 1024
+
+# Content of these elements is not part of the text
+SKIPPED_TAGS = {"script", "style", "nav", "noscript", "template", "svg", "iframe"}
+# Elements that start a new paragraph
+BLOCK_TAGS = {
+    "address",
+    "article",
+    "aside",
+    "blockquote",
+    "br",
+    "dd",
+    "div",
+    "dl",
+    "dt",
+    "figcaption",
+    "figure",
+    "footer",
+    "form",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "header",
+    "hr",
+    "li",
+    "main",
+    "ol",
+    "p",
+    "pre",
+    "section",
+    "table",
+    "td",
+    "th",
+    "title",
+    "tr",
+    "ul",
+}
+
+blank_lines_regex = re.compile(r"\n\s*\n\s*")
+trailing_spaces_regex = re.compile(r"[ \t\r\f\v]+\n")
+
+
+class TextExtractor(HTMLParser):
+    """
+    Extracts the text of a HTML document (or plain text) that is pushed in chunks.
+    The text is returned in blocks of bounded size as soon as they are complete,
+    so large documents never need to be held in memory.
+    """
+
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self._parts: List[str] = []
+        self._text = ""
+        self._skip_depth = 0
+        self._blocks: List[str] = []
+
+    def push(self, chunk: str) -> List[str]:
+        """Adds the chunk and returns the blocks that are complete"""
+        self.feed(chunk)
+        return self._take_blocks(final=False)
+
+    def finish(self) -> List[str]:
+        """Returns the remaining blocks"""
+        self.close()
+        return self._take_blocks(final=True)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self._parts.append("\n\n")
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self._skip_depth = max(self._skip_depth - 1, 0)
+        elif tag in BLOCK_TAGS:
+            self._parts.append("\n\n")
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in BLOCK_TAGS:
+            self._parts.append("\n\n")
+
+    def handle_data(self, data):
+        if self._skip_depth == 0:
+            self._parts.append(data)
+
+    def _take_blocks(self, final: bool) -> List[str]:
+        self._text = "".join(self._parts)
+        while len(self._text) > MAX_BLOCK_CHARS:
+            self._cut(self._split_position(self._text[:MAX_BLOCK_CHARS]))
+        if final:
+            self._cut(len(self._text))
+        elif len(self._text) >= BLOCK_CHARS:
+            # Wait for a paragraph to end, unless the block would get too small
+            end = self._text.rfind("\n\n")
+            if end >= BLOCK_CHARS // 2:
+                self._cut(end)
+        self._parts = [self._text]
+        blocks = self._blocks
+        self._blocks = []
+        return blocks
+
+    def _split_position(self, text: str) -> int:
+        for separator in ["\n\n", "\n", " "]:
+            position = text.rfind(separator)
+            if position > 0:
+                return position
+        return len(text)
+
+    def _cut(self, position: int):
+        block = normalize_whitespace(self._text[:position])
+        self._text = self._text[position:]
+        if block != "":
+            self._blocks.append(block)
+
+
+def normalize_whitespace(text: str) -> str:
+    text = trailing_spaces_regex.sub("\n", text)
+    return blank_lines_regex.sub("\n\n", text).strip()
+
+
+def extract_text_blocks(chunks: Iterable[str]) -> Iterable[str]:
+    extractor = TextExtractor()
+    for chunk in chunks:
+        yield from extractor.push(chunk)
+    yield from extractor.finish()
+
+
+def read_text(chunks: Iterable[str], token_limit: Optional[int] = None) -> str:
+    """
+    Extracts the text of the HTML or plain text chunks. Stops reading once the text
+    reaches the token limit.
+    """
+    counter = TokenCounter()
+    blocks = []
+    for block in extract_text_blocks(chunks):
+        if token_limit is None:
+            blocks.append(block)
+            continue
+        blocks.append(counter.add_limited(block, token_limit - counter.count))
+        if counter.count >= token_limit:
+            break
+    return "\n\n".join(blocks)
+
+
+def read_chunks(file: IO[str]) -> Iterable[str]:
+    return iter(lambda: file.read(READ_CHARS), "")
@@ -0,0 +1,508 @@
+from contextlib import closing, contextmanager
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from ai_scripts.lib.env import cache_dir
+from ai_scripts.lib.fs import MAX_COLUMNS, FileHits, SearchLine
+from ai_scripts.lib.logging import print_status
+from ai_scripts.lib.sh import run_cmd
+from ai_scripts.lib.tracing import span
+
+if TYPE_CHECKING:
+    import sqlite3
+
+# Increase if the format of the index changes, to rebuild existing indexes
+INDEX_VERSION = "4"
+
+# Files are split into chunks of lines for the retrieval of relevant files
+CHUNK_LINES = 50
+
+# If a keyword has more postings per indexed file, reading them is slower than
+# searching the files directly
+MAX_POSTINGS_PER_FILE = 2.0
+
+# Above this number of changed files, the whole vocabulary is loaded into memory
+BULK_UPDATE_FILES = 100
+# Page cache of bulk updates
+BULK_CACHE_KB = 128 * 1024
+
+# Updates of more files (e.g. the first build) run in the background, and searches
+# fall back to `git grep`/`rg` until they are done
+FOREGROUND_UPDATE_FILES = 100
+
+CREATE_INDEXES_SQL = (
+    "CREATE INDEX postings_file ON postings (file_id);"
+    "CREATE INDEX chunks_file ON chunks (file_id);"
+)
+DROP_INDEXES_SQL = "DROP INDEX postings_file; DROP INDEX chunks_file;"
+
+# Every keyword match lies within one of these terms
+term_regex = re.compile(r"[^\W_]+")
+# Boundaries of the parts of a camel case term, e.g. `get|Response|Cache`
+camel_case_regex = re.compile(r"(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])")
+# Default of git for the lines shown by `--show-function`, without a diff driver
+function_line_regex = re.compile(r"[A-Za-z_$]")
+
+
+class WorkspaceIndex:
+    """
+    Inverted index (term -> file/line postings) of the current workspace. Only the
+    files with hits are read to answer a search.
+    Files are only re-indexed if their git blob hash or modification time changed.
+    """
+
+    def __init__(self, path: Path, use_git: bool) -> None:
+        self.path = path
+        self.use_git = use_git
+
+    @classmethod
+    def for_workspace(cls) -> "WorkspaceIndex":
+        if Path("./.git").exists():
+            git_dir = run_cmd(["git", "rev-parse", "--git-dir"]).strip()
+            return cls(Path(git_dir) / "ai-scripts" / "index.sqlite", use_git=True)
+        workspace_hash = hashlib.sha1(str(Path.cwd()).encode("utf-8")).hexdigest()
+        return cls(cache_dir() / "index" / f"{workspace_hash}.sqlite", use_git=False)
+
+    def update(self, max_files: Optional[int] = None) -> Optional[int]:
+        """
+        Re-indexes all changed files and returns their number. Nothing is updated
+        and None is returned if more than `max_files` files changed.
+        """
+        versions = self._file_versions()
+        with closing(self._connect()) as conn, conn:
+            indexed = dict(conn.execute("SELECT path, version FROM files"))
+            changed = [p for p, v in versions.items() if indexed.get(p) != v]
+            removed = [p for p in indexed if p not in versions]
+            if max_files is not None and len(changed) + len(removed) > max_files:
+                return None
+            for path in removed + changed:
+                self._remove_file(conn, path)
+            is_bulk = len(changed) > BULK_UPDATE_FILES
+            if is_bulk:
+                # Inserting is faster without indexes, which are recreated afterwards
+                conn.executescript(DROP_INDEXES_SQL)
+                # The postings are inserted in file order, but clustered by term
+                conn.execute(f"PRAGMA cache_size = -{BULK_CACHE_KB}")
+                terms = TermIds(conn, dict(conn.execute("SELECT term, id FROM terms")))
+            else:
+                terms = TermIds(conn)
+            for path in changed:
+                self._add_file(conn, terms, path, versions[path])
+            if is_bulk:
+                conn.executescript(CREATE_INDEXES_SQL)
+        return len(changed) + len(removed)
+
+    def rebuild(self):
+        self.path.unlink(missing_ok=True)
+        self.update()
+
+    @contextmanager
+    def lock(self) -> Iterator[bool]:
+        """
+        Yields whether the lock for updating the index was acquired, which fails
+        while another process updates it
+        """
+        import fcntl
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path.with_suffix(".lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            # Released when the file is closed
+            yield True
+
+    def search(
+        self,
+        keywords: List[str],
+        ignore_case: Dict[str, bool],
+        max_count: int,
+        max_files: int,
+    ) -> Optional[List[FileHits]]:
+        """
+        Returns all lines that might contain one of the keywords (and their context),
+        or None if the keywords cannot be served from the index or are too common.
+        Keywords are found anywhere within a term, like with `git grep`.
+        """
+        if any(term_regex.fullmatch(k) is None for k in keywords):
+            return None
+        candidates: Dict[str, Set[int]] = {}
+        with closing(self._connect()) as conn:
+            n_files = conn.execute("SELECT count(*) FROM files").fetchone()[0]
+            max_postings = int(n_files * MAX_POSTINGS_PER_FILE)
+            # The vocabulary is small compared to the postings, so it is scanned
+            # for the terms containing the keyword
+            term_ids = [
+                [
+                    term_id
+                    for term_id, in conn.execute(
+                        "SELECT id FROM terms WHERE instr(term, ?) > 0", (k.lower(),)
+                    )
+                ]
+                for k in keywords
+            ]
+            for ids in term_ids:
+                # Only counted up to the limit, so common keywords are cheap as well
+                n_postings = conn.execute(
+                    "SELECT count(*) FROM ("
+                    "  SELECT 1 FROM json_each(?) t "
+                    "  CROSS JOIN postings p ON p.term_id = t.value LIMIT ?"
+                    ")",
+                    (json.dumps(ids), max_postings + 1),
+                ).fetchone()[0]
+                if n_postings > max_postings:
+                    return None
+            for keyword, ids in zip(keywords, term_ids):
+                rows = conn.execute(
+                    "SELECT f.path, p.lines FROM json_each(?) t "
+                    "CROSS JOIN postings p ON p.term_id = t.value "
+                    "JOIN files f ON f.id = p.file_id",
+                    (json.dumps(ids),),
+                )
+                # If the case is ignored, every candidate is a match and only the
+                # first ones are needed (the lines of a posting are sorted)
+                limit = max_count if ignore_case[keyword] else None
+                keyword_lines: Dict[str, Set[int]] = {}
+                for path, lines in rows:
+                    numbers = lines.split(",", limit or -1)[:limit]
+                    keyword_lines.setdefault(path, set()).update(map(int, numbers))
+                paths = sorted(keyword_lines)
+                if ignore_case[keyword]:
+                    # Like the live search, which is sorted by path as well
+                    paths = paths[:max_files]
+                for path in paths:
+                    numbers = keyword_lines[path]
+                    if limit is not None:
+                        numbers = set(sorted(numbers)[:limit])
+                    candidates.setdefault(path, set()).update(numbers)
+        return self._file_hits(candidates)
+
+    def term_postings(self, terms: List[str]) -> List[Tuple[str, str, List[int]]]:
+        """Returns the term, path and line numbers of every posting of the terms"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT t.term, f.path, p.lines FROM terms t "
+                "CROSS JOIN postings p ON p.term_id = t.id "
+                "JOIN files f ON f.id = p.file_id "
+                f"WHERE t.term IN ({', '.join('?' for _ in terms)})",
+                terms,
+            )
+            return [
+                (term, path, [int(n) for n in lines.split(",")])
+                for term, path, lines in rows
+            ]
+
+    def chunk_lengths(self, terms: List[str]) -> Dict[Tuple[str, int], int]:
+        """
+        Returns the number of terms of every chunk containing one of the terms,
+        by path and chunk number.
+        """
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT f.path, c.chunk, c.length FROM chunks c "
+                "JOIN files f ON f.id = c.file_id "
+                "WHERE c.file_id IN ("
+                "  SELECT p.file_id FROM terms t "
+                "  CROSS JOIN postings p ON p.term_id = t.id "
+                f" WHERE t.term IN ({', '.join('?' for _ in terms)})"
+                ")",
+                terms,
+            )
+            return {(path, chunk): length for path, chunk, length in rows}
+
+    def number_of_chunks(self) -> int:
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT count(*) FROM chunks").fetchone()[0]
+
+    def _file_hits(self, candidates: Dict[str, Set[int]]) -> List[FileHits]:
+        """Reads the candidate lines and their context from the files"""
+        files = []
+        for path, numbers in sorted(candidates.items()):
+            text = _read_text(path)
+            if text is None:
+                continue
+            lines = _split_lines(text)
+            numbers = {n for n in numbers if n <= len(lines)}
+            if self.use_git:
+                files.append(FileHits(path, _git_grep_lines(lines, numbers)))
+                continue
+            file = FileHits(f"./{path}")
+            selected = set()
+            for number in numbers:
+                selected.update((number - 1, number, number + 1))
+            for number in sorted(n for n in selected if 0 < n <= len(lines)):
+                line = lines[number - 1]
+                if len(line) > MAX_COLUMNS:
+                    # Same as the ripgrep fallback
+                    line = f"{line[:MAX_COLUMNS]} [...]"
+                kind = "match" if number in numbers else "context"
+                file.lines.append(SearchLine(number, line, kind))
+            files.append(file)
+        return files
+
+    def _file_versions(self) -> Dict[str, str]:
+        if not self.use_git:
+            return _stat_versions(run_cmd(["rg", "--files"]).splitlines())
+        versions: Dict[str, str] = {}
+        for entry in run_cmd(["git", "ls-files", "--stage", "-z"]).split("\0"):
+            if entry == "":
+                continue
+            info, path = entry.split("\t", 1)
+            mode, blob_hash, _ = info.split(" ")
+            # Same files as searched by git grep (no dotfiles, symlinks or submodules)
+            if not path.startswith(".") and mode.startswith("100"):
+                versions[path] = blob_hash
+        # Files with unstaged changes don't match their blob hash
+        modified = run_cmd(["git", "diff", "--name-only", "-z"]).split("\0")
+        modified_versions = _stat_versions(p for p in modified if p in versions)
+        for path in modified:
+            if path in versions:
+                versions[path] = modified_versions.get(path, "deleted")
+        return {p: v for p, v in versions.items() if v != "deleted"}
+
+    def _add_file(
+        self, conn: "sqlite3.Connection", terms: "TermIds", path: str, version: str
+    ):
+        cursor = conn.execute(
+            "INSERT INTO files (path, version) VALUES (?, ?)", (path, version)
+        )
+        file_id = cursor.lastrowid
+        text = _read_text(path)
+        if text is None:
+            return
+        lines = _split_lines(text)
+        postings: Dict[str, List[str]] = {}
+        chunk_lengths: Dict[int, int] = {}
+        for number, line in enumerate(lines, start=1):
+            line_terms = term_regex.findall(line)
+            chunk = (number - 1) // CHUNK_LINES
+            chunk_lengths[chunk] = chunk_lengths.get(chunk, 0) + len(line_terms)
+            for term in set(_search_terms(line_terms)):
+                postings.setdefault(term, []).append(str(number))
+        conn.executemany(
+            "INSERT INTO postings (term_id, file_id, lines) VALUES (?, ?, ?)",
+            ((terms.get(t), file_id, ",".join(lines)) for t, lines in postings.items()),
+        )
+        conn.executemany(
+            "INSERT INTO chunks (file_id, chunk, length) VALUES (?, ?, ?)",
+            ((file_id, chunk, length) for chunk, length in chunk_lengths.items()),
+        )
+
+    def _remove_file(self, conn: "sqlite3.Connection", path: str):
+        row = conn.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None:
+            conn.execute("DELETE FROM postings WHERE file_id = ?", row)
+            conn.execute("DELETE FROM chunks WHERE file_id = ?", row)
+            conn.execute("DELETE FROM files WHERE id = ?", row)
+
+    def _connect(self) -> "sqlite3.Connection":
+        import sqlite3
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if str(version) != INDEX_VERSION:
+            conn.executescript(
+                "DROP TABLE IF EXISTS postings;"
+                "DROP TABLE IF EXISTS chunks;"
+                "DROP TABLE IF EXISTS lines;"
+                "DROP TABLE IF EXISTS terms;"
+                "DROP TABLE IF EXISTS files;"
+                "CREATE TABLE files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, version TEXT);"
+                "CREATE TABLE terms (id INTEGER PRIMARY KEY, term TEXT UNIQUE);"
+                # Clustered by term, so the postings of a term are read together
+                "CREATE TABLE postings (term_id INTEGER, file_id INTEGER, lines TEXT, "
+                "PRIMARY KEY (term_id, file_id)) WITHOUT ROWID;"
+                "CREATE TABLE chunks (file_id INTEGER, chunk INTEGER, length INTEGER);"
+                f"{CREATE_INDEXES_SQL}"
+                f"PRAGMA user_version = {INDEX_VERSION};"
+            )
+        return conn
+
+
+class TermIds:
+    """Ids of the terms in the index, which are created on demand"""
+
+    def __init__(
+        self, conn: "sqlite3.Connection", known: Optional[Dict[str, int]] = None
+    ) -> None:
+        self._conn = conn
+        self._ids: Dict[str, int] = known or {}
+        # If all terms are known, there is no need to look them up
+        self._is_complete = known is not None
+
+    def get(self, term: str) -> int:
+        term_id = self._ids.get(term)
+        if term_id is not None:
+            return term_id
+        row = None
+        if not self._is_complete:
+            row = self._conn.execute(
+                "SELECT id FROM terms WHERE term = ?", (term,)
+            ).fetchone()
+        if row is None:
+            row = (
+                self._conn.execute(
+                    "INSERT INTO terms (term) VALUES (?)", (term,)
+                ).lastrowid,
+            )
+        self._ids[term] = row[0]
+        return row[0]
+
+
+def update_index(reindex: bool = False) -> Optional[WorkspaceIndex]:
+    """
+    Updates the index of the workspace, or returns None if it isn't usable. Large
+    updates are started in the background, and None is returned until they are done.
+    """
+    if os.getenv("AI_SCRIPTS_INDEX") == "0":
+        return None
+    try:
+        with span("Update search index", "index") as args:
+            index = WorkspaceIndex.for_workspace()
+            with index.lock() as is_locked:
+                if not is_locked:
+                    print_status("Search index is being updated in the background")
+                    return None
+                if reindex:
+                    print_status("Rebuild search index")
+                    index.rebuild()
+                    return index
+                n_changed = index.update(max_files=FOREGROUND_UPDATE_FILES)
+            args["changed_files"] = n_changed
+            if n_changed is None:
+                _update_in_background()
+                print_status("Search index is being updated in the background")
+                return None
+            if n_changed > 0:
+                print_status(f"Updated search index ({n_changed} changed files)")
+        return index
+    except Exception as e:
+        print_status(f"Search index is not available: {e}")
+        return None
+
+
+def _update_in_background():
+    # A separate session, so the update isn't stopped with the current command
+    subprocess.Popen(
+        [sys.executable, "-m", "ai_scripts.lib.index"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def search_index(
+    index: WorkspaceIndex,
+    keywords: List[str],
+    ignore_case: Dict[str, bool],
+    max_count: int,
+    max_files: int,
+) -> Optional[List[FileHits]]:
+    """
+    Searches the keywords in the index, which has to be updated already, or returns
+    None if it isn't usable
+    """
+    try:
+        return index.search(keywords, ignore_case, max_count, max_files)
+    except Exception as e:
+        print_status(f"Search index is not available: {e}")
+        return None
+
+
+def _git_grep_lines(lines: List[str], matches: Set[int]) -> List[SearchLine]:
+    """
+    The lines of the matches like `git grep --show-function --context=1`. The
+    function line is the closest one before the match that isn't shown already.
+    """
+    result = []
+    last_shown = 0
+    for number in sorted(matches):
+        start = max(number - 1, last_shown + 1)
+        function_number = next(
+            (
+                n
+                for n in range(number - 1, last_shown, -1)
+                if function_line_regex.match(lines[n - 1])
+            ),
+            None,
+        )
+        if function_number is not None and function_number < start:
+            result.append(
+                SearchLine(function_number, lines[function_number - 1], "function")
+            )
+        for context in range(start, number):
+            kind = "function" if context == function_number else "context"
+            result.append(SearchLine(context, lines[context - 1], kind))
+        result.append(SearchLine(number, lines[number - 1], "match"))
+        last_shown = number
+        after = number + 1
+        if after <= len(lines) and after not in matches:
+            result.append(SearchLine(after, lines[after - 1], "context"))
+            last_shown = after
+    return result
+
+
+def _search_terms(terms: Iterable[str]) -> Iterable[str]:
+    """
+    The lowercase terms and the suffixes starting at each of their camel case
+    parts, so e.g. `cache` is found in `getResponseCache`
+    """
+    for term in terms:
+        lower = term.lower()
+        yield lower
+        if lower != term:
+            parts = camel_case_regex.split(term)
+            for i in range(1, len(parts)):
+                yield "".join(parts[i:]).lower()
+
+
+def _stat_versions(paths: Iterable[str]) -> Dict[str, str]:
+    versions = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            versions[path] = f"{stat.st_mtime_ns}:{stat.st_size}"
+        except OSError:
+            pass
+    return versions
+
+
+def _split_lines(text: str) -> List[str]:
+    """Splits the text only at line feeds, so the line numbers match git grep"""
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return [line.removesuffix("\r") for line in lines]
+
+
+def _read_text(path: str) -> Optional[str]:
+    """Reads the file if it is a text file (like `git grep -I`)"""
+    try:
+        content = Path(path).read_bytes()
+    except OSError:
+        return None
+    if b"\0" in content[:8000]:
+        return None
+    return content.decode("utf-8", errors="replace")
+
+
+def main():
+    """Updates the index of the current workspace, started by `update_index`"""
+    index = WorkspaceIndex.for_workspace()
+    with index.lock() as is_locked:
+        if is_locked:
+            index.update()
+
+
+if __name__ == "__main__":
+    main()
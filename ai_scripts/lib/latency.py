@@ -0,0 +1,132 @@
+from dataclasses import dataclass
+import os
+import random
+import statistics
+import time
+from typing import Callable, Dict, List, Optional
+
+from ai_scripts.lib.env import is_debbuging
+from ai_scripts.lib.logging import print_status
+from ai_scripts.lib.model import ModelDescriptor
+from ai_scripts.lib.telemetry import Call, Telemetry, percentile
+
+# Only recent requests reflect the current state of a provider
+RECENT_SECONDS = 3 * 60 * 60
+RECENT_SAMPLES = 20
+# Models need this many recent samples before their latency is trusted
+MIN_SAMPLES = 3
+# Time to first token that is assumed for failed requests
+FAILED_TTFT_S = 30.0
+# Share of routed requests that go to a random model, to keep the stats up to date
+EXPLORE_RATE = 0.05
+# Models considered by `auto:<policy>`, if AI_SCRIPTS_AUTO_MODELS isn't set
+DEFAULT_AUTO_MODELS = ["G4", "M8", "MS", "C3H"]
+API_KEY_VARIABLES = {
+    "openai": "OPENAI_API_KEY",
+    "togetherai": "TOGETHER_API_KEY",
+    "mistralai": "MISTRAL_API_KEY",
+    "anthropic": "ANTHROPIC_API_KEY",
+}
+
+
+@dataclass
+class LatencySummary:
+    model: str
+    samples: int
+    errors: int
+    ttft_p50_s: float
+    ttft_p95_s: float
+    # None if no request was streamed
+    tokens_per_s: Optional[float]
+
+
+def recent_summaries() -> Dict[str, LatencySummary]:
+    """Time to first token and throughput of the recent calls per model"""
+    calls: Dict[str, List[Call]] = {}
+    for call in Telemetry.from_env().calls(since=time.time() - RECENT_SECONDS):
+        model_calls = calls.setdefault(call.model, [])
+        if len(model_calls) < RECENT_SAMPLES:
+            model_calls.append(call)
+    return {model: _summarize(model, c) for model, c in calls.items()}
+
+
+def _summarize(model: str, calls: List[Call]) -> LatencySummary:
+    ttfts = []
+    throughputs = []
+    errors = 0
+    for call in calls:
+        if call.error is not None:
+            errors += 1
+            ttfts.append(FAILED_TTFT_S)
+            continue
+        ttfts.append(call.duration_s if call.ttft_s is None else call.ttft_s)
+        tokens_per_s = call.tokens_per_s
+        if tokens_per_s is not None:
+            throughputs.append(tokens_per_s)
+    return LatencySummary(
+        model,
+        samples=len(calls),
+        errors=errors,
+        ttft_p50_s=percentile(ttfts, 0.5),
+        ttft_p95_s=percentile(ttfts, 0.95),
+        tokens_per_s=statistics.median(throughputs) if throughputs else None,
+    )
+
+
+def _score_fast(summary: LatencySummary) -> float:
+    return (summary.ttft_p50_s + summary.ttft_p95_s) / 2
+
+
+def _score_throughput(summary: LatencySummary) -> float:
+    return -(summary.tokens_per_s or 0)
+
+
+# Lower scores are better
+ROUTING_POLICIES: Dict[str, Callable[[LatencySummary], float]] = {
+    "fast": _score_fast,
+    "throughput": _score_throughput,
+}
+
+
+def auto_candidates() -> List[ModelDescriptor]:
+    """Models considered by the routing, in order of preference"""
+    from ai_scripts.lib.model import Models
+
+    names = os.getenv("AI_SCRIPTS_AUTO_MODELS")
+    candidates = []
+    for name in names.split(",") if names else DEFAULT_AUTO_MODELS:
+        descriptor = Models.get_descriptor_by_name(name.strip())
+        if descriptor is None:
+            raise ValueError(f'Unknown model "{name}" in AI_SCRIPTS_AUTO_MODELS')
+        if names or os.getenv(API_KEY_VARIABLES.get(descriptor.provider, ""), ""):
+            candidates.append(descriptor)
+    if len(candidates) == 0:
+        raise ValueError("No models for the routing. Set AI_SCRIPTS_AUTO_MODELS.")
+    return candidates
+
+
+def route(policy: str) -> ModelDescriptor:
+    """
+    Picks the model with the best recent stats according to the policy. Models
+    without enough samples get the median score, so they are tried eventually.
+    """
+    score = ROUTING_POLICIES.get(policy)
+    if score is None:
+        raise ValueError(
+            f'Unknown routing policy "{policy}". '
+            f"Use one of {', '.join(ROUTING_POLICIES)}."
+        )
+    candidates = auto_candidates()
+    if random.random() < EXPLORE_RATE:
+        return random.choice(candidates)
+    summaries = recent_summaries()
+    scores: Dict[str, float] = {}
+    for descriptor in candidates:
+        summary = summaries.get(descriptor.name)
+        if summary is not None and summary.samples >= MIN_SAMPLES:
+            scores[descriptor.name] = score(summary)
+    default_score = statistics.median(scores.values()) if scores else 0
+    best = min(candidates, key=lambda d: scores.get(d.name, default_score))
+    if is_debbuging():
+        print_status(f"Routed auto:{policy} to {best.name}")
+    return best
@@ -1,12 +1,15 @@
+import os
 import sys
-from typing import Callable, Iterable
+import threading
+from typing import TYPE_CHECKING, AsyncIterable, Callable, Iterable, Optional
 from rich import print
-from rich.console import RenderableType
-from rich.live import Live
-from rich.markdown import Markdown
-from rich.syntax import Syntax
 
-from ai_scripts.lib.string import extract_first_code_snippet_from_markdown
+from ai_scripts.lib.string import CodeExtractor
+from ai_scripts.lib.tracing import is_tracing, trace_step
+
+if TYPE_CHECKING:
+    from rich.console import RenderableType
+    from rich.live import Live
 
 COLOR_GRAY_1 = "grey74"
 COLOR_GRAY_2 = "grey54"
@@ -14,9 +17,15 @@ COLOR_RED = "bright_red"
 
 CODE_THEME = "dracula"
 
+DEFAULT_REFRESH_PER_SECOND = 20
+
 
 def print_step(msg: str):
     print(f"[{COLOR_GRAY_1}]> {msg}[/]", file=sys.stderr)
+    if is_tracing():
+        from rich.markup import render
+
+        trace_step(render(msg).plain)
 
 
 def print_status(msg: str):
@@ -27,68 +36,180 @@ def print_error(msg: str):
     print(f"[{COLOR_RED}]- ERROR: {msg}[/]", file=sys.stderr)
 
 
-def render_syntax(text: str, language: str) -> RenderableType:
+def render_syntax(text: str, language: str) -> "RenderableType":
+    from rich.syntax import Syntax
+
     return Syntax(text, language, theme=CODE_THEME, background_color="default")
 
 
-def render_markdown(text: str) -> RenderableType:
+def render_markdown(text: str) -> "RenderableType":
+    from rich.markdown import Markdown
+
     return Markdown(text, code_theme=CODE_THEME, inline_code_theme=CODE_THEME)
 
 
 def print_stream(
     stream: Iterable[str],
-    render: Callable[[str], RenderableType] = lambda s: s,
+    render: Callable[[str], "RenderableType"] = lambda s: s,
     postprocess: Callable[[str], str] = lambda s: s,
     cancel: Callable[[str], bool] = lambda _: False,
     prefix="",
+    refresh_per_second: Optional[float] = None,
 ) -> str:
-    buffer = prefix.lstrip()
-    if sys.stdout.isatty():
-        with Live() as live:
-            for token in stream:
-                buffer += token
-                rendered_buffer = postprocess(buffer)
-                rendered_buffer = limit_lines(rendered_buffer, live.console.height)
-                # First render the output on every update
-                live.update(render(rendered_buffer))
-                if cancel(buffer):
-                    break
-            live.update("")
-            buffer = postprocess(buffer)
-            # Then render buffer normally, so text wrapping works like you would expect
-            live.console.print(render(buffer))
-    else:
-        buffer_post = postprocess(buffer)
-        print(buffer_post, end="")
+    with StreamPrinter(
+        render, postprocess, cancel, prefix, refresh_per_second
+    ) as printer:
         for token in stream:
-            new_buffer = buffer + token
-            new_buffer_post = postprocess(new_buffer)
-            print(new_buffer_post.removeprefix(buffer_post), end="")
-            buffer = new_buffer
-            buffer_post = new_buffer_post
-            if cancel(buffer):
+            if printer.push(token):
+                break
+    return printer.result()
+
+
+async def aprint_stream(
+    stream: AsyncIterable[str],
+    render: Callable[[str], "RenderableType"] = lambda s: s,
+    postprocess: Callable[[str], str] = lambda s: s,
+    cancel: Callable[[str], bool] = lambda _: False,
+    prefix="",
+    refresh_per_second: Optional[float] = None,
+) -> str:
+    """Like `print_stream`, but for streams of the async API"""
+    with StreamPrinter(
+        render, postprocess, cancel, prefix, refresh_per_second
+    ) as printer:
+        async for token in stream:
+            if printer.push(token):
                 break
-    return postprocess(buffer)
+    return printer.result()
+
+
+class StreamPrinter:
+    """Prints a stream token by token. Shared by `print_stream` and `aprint_stream`."""
+
+    def __init__(
+        self,
+        render: Callable[[str], "RenderableType"],
+        postprocess: Callable[[str], str],
+        cancel: Callable[[str], bool],
+        prefix: str,
+        refresh_per_second: Optional[float],
+    ) -> None:
+        self.render = render
+        self.postprocess = postprocess
+        self.cancel = cancel
+        self.refresh_per_second = refresh_per_second
+        self.buffer = prefix.lstrip()
+        self.buffer_post = ""
+        self.done = False
+        self.live: Optional["Live"] = None
+
+    def __enter__(self) -> "StreamPrinter":
+        if sys.stdout.isatty():
+            from rich import get_console
+            from rich.live import Live
+
+            console = get_console()
+
+            def get_renderable() -> "RenderableType":
+                # Called from the refresh thread of Live, so rendering happens at a
+                # bounded frame rate independent of how fast the tokens arrive
+                if self.done:
+                    return ""
+                rendered_buffer = self.postprocess(self.buffer)
+                rendered_buffer = limit_lines(rendered_buffer, console.height)
+                return self.render(rendered_buffer)
+
+            self.live = Live(
+                console=console,
+                get_renderable=get_renderable,
+                refresh_per_second=self.refresh_per_second
+                or default_refresh_per_second(),
+            )
+            self.live.__enter__()
+        else:
+            self.buffer_post = self.postprocess(self.buffer)
+            write_stdout(self.buffer_post)
+        return self
+
+    def push(self, token: str) -> bool:
+        """Adds the token and returns True if the stream should be cancelled"""
+        if self.live is not None:
+            self.buffer += token
+        else:
+            new_buffer = self.buffer + token
+            new_buffer_post = self.postprocess(new_buffer)
+            write_stdout(new_buffer_post.removeprefix(self.buffer_post))
+            self.buffer = new_buffer
+            self.buffer_post = new_buffer_post
+        return self.cancel(self.buffer)
+
+    def __exit__(self, *exc_info) -> None:
+        if self.live is None:
+            return
+        try:
+            if exc_info[0] is None:
+                self.done = True
+                self.live.refresh()
+                # Then render buffer normally, so text wrapping works like you would expect
+                self.live.console.print(self.render(self.postprocess(self.buffer)))
+        finally:
+            self.live.__exit__(*exc_info)
+
+    def result(self) -> str:
+        return self.postprocess(self.buffer)
 
 
 def print_stream_and_extract_code(stream: Iterable[str], expected_language: str) -> str:
-    global language
-    language = expected_language
+    extractor = CodeExtractor()
+    if not sys.stdout.isatty():
+        for token in stream:
+            write_stdout(extractor.push(token))
+            if extractor.completed:
+                break
+        write_stdout(extractor.finish())
+        return extractor.code
+
+    # The extractor is only used on this thread. The refresh thread of Live renders a
+    # snapshot instead, which is renewed after each frame that showed it, as
+    # copying the code of an unfinished block for every token would be quadratic.
+    snapshot = extractor.extract()
+    is_shown = threading.Event()
 
-    def postprocess(s: str):
-        global language
-        md = extract_first_code_snippet_from_markdown(s)
-        language = md.language or expected_language
-        return md.code
+    def extract(stream: Iterable[str]) -> Iterable[str]:
+        nonlocal snapshot
+        for token in stream:
+            extractor.push(token)
+            if is_shown.is_set() or extractor.completed:
+                is_shown.clear()
+                snapshot = extractor.extract()
+            yield token
+        snapshot = extractor.extract()
 
-    def cancel(s: str):
-        md = extract_first_code_snippet_from_markdown(s)
-        return md.completed
+    def postprocess(_: str) -> str:
+        is_shown.set()
+        return snapshot.code
 
     def render(s: str):
-        return render_syntax(s, language)
+        return render_syntax(s, snapshot.language or expected_language)
+
+    return print_stream(
+        extract(stream),
+        render=render,
+        postprocess=postprocess,
+        cancel=lambda _: extractor.completed,
+    )
+
+
+def write_stdout(text: str):
+    """Writes the text as is, without interpreting markup or wrapping lines"""
+    if text != "":
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
 
-    return print_stream(stream, render=render, postprocess=postprocess, cancel=cancel)
+def default_refresh_per_second() -> float:
+    fps = os.getenv("AI_SCRIPTS_FPS")
+    return float(fps) if fps else DEFAULT_REFRESH_PER_SECOND
 
 
 def limit_lines(text: str, n_lines: int) -> str:
@@ -1,6 +1,13 @@
+from contextvars import ContextVar
+from dataclasses import dataclass
 from enum import Enum
+from functools import partial
 import os
 from typing import (
+    TYPE_CHECKING,
+    AsyncIterator,
+    Callable,
+    Dict,
     Iterable,
     List,
     Literal,
@@ -11,15 +18,8 @@ from typing import (
     TypedDict,
     Unpack,
 )
-from langchain_core.language_models import LanguageModelInput
-from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_community.chat_models import ChatOllama
-from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
-from langchain_anthropic import ChatAnthropic
-
-from openai import OpenAI
-from openai.types.chat import ChatCompletionMessageParam
 from ai_scripts.lib.env import is_debbuging
+from ai_scripts.lib.tracing import is_tracing, span, text_args, trace_stream
 
 from ai_scripts.lib.logging import (
     COLOR_GRAY_1,
@@ -29,6 +29,14 @@ from ai_scripts.lib.logging import (
     print,
 )
 
+# Provider SDKs are slow to import, so they are only imported once a model is used
+if TYPE_CHECKING:
+    from langchain_core.language_models import LanguageModelInput
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import BaseMessage
+    from openai import AsyncOpenAI, OpenAI, Stream
+    from openai.types.chat import ChatCompletionChunk, ChatCompletionMessageParam
+
 
 class Message(TypedDict):
     content: Required[str]
@@ -42,6 +50,29 @@ class ChatOptions(TypedDict):
     presence_penalty: NotRequired[float]
 
 
+@dataclass
+class Usage:
+    """Number of tokens of a request, as reported by the provider"""
+
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+# Usage of the request that is currently executed, set by the telemetry
+current_usage: ContextVar[Optional[Usage]] = ContextVar("current_usage", default=None)
+
+
+def report_usage(prompt_tokens: Optional[int], completion_tokens: Optional[int]):
+    usage = current_usage.get()
+    if usage is not None:
+        usage.prompt_tokens += prompt_tokens or 0
+        usage.completion_tokens += completion_tokens or 0
+
+
+def _input_args(messages: List[Message]) -> Dict[str, int]:
+    return text_args("input", "".join(m["content"] for m in messages))
+
+
 class Model(Protocol):
     name: str
     abbr: Optional[str]
@@ -52,11 +83,12 @@ class Model(Protocol):
         **kwargs: Unpack[ChatOptions],
     ) -> str:
         if is_debbuging():
-            print_divider()
-            print_status(f"Using {self.name}")
-            print_messages(messages)
-            print_divider()
-            print()
+            print_request(f"Using {self.name}", messages)
+        if is_tracing():
+            with span(self.name, "model", **_input_args(messages)) as args:
+                answer = self._complete(messages, **kwargs)
+                args.update(text_args("output", answer))
+            return answer
         return self._complete(messages, **kwargs)
 
     def stream(
@@ -65,13 +97,34 @@ class Model(Protocol):
         **kwargs: Unpack[ChatOptions],
     ) -> Iterable[str]:
         if is_debbuging():
-            print_divider()
-            print_status(f"Using {self.name} (stream)")
-            print_messages(messages)
-            print_divider()
-            print()
+            print_request(f"Using {self.name} (stream)", messages)
+        if is_tracing():
+            return trace_stream(
+                self.name,
+                "model",
+                self._stream(messages, **kwargs),
+                **_input_args(messages),
+            )
         return self._stream(messages, **kwargs)
 
+    async def acomplete(
+        self,
+        messages: List[Message],
+        **kwargs: Unpack[ChatOptions],
+    ) -> str:
+        if is_debbuging():
+            print_request(f"Using {self.name} (async)", messages)
+        return await self._acomplete(messages, **kwargs)
+
+    def astream(
+        self,
+        messages: List[Message],
+        **kwargs: Unpack[ChatOptions],
+    ) -> AsyncIterator[str]:
+        if is_debbuging():
+            print_request(f"Using {self.name} (async stream)", messages)
+        return self._astream(messages, **kwargs)
+
     def _complete(
         self,
         messages: List[Message],
@@ -86,12 +139,44 @@ class Model(Protocol):
     ) -> Iterable[str]:
         ...
 
+    async def _acomplete(
+        self,
+        messages: List[Message],
+        **kwargs: Unpack[ChatOptions],
+    ) -> str:
+        # Models without native async support are called in a thread
+        import asyncio
+
+        return await asyncio.to_thread(self._complete, messages, **kwargs)
+
+    async def _astream(
+        self,
+        messages: List[Message],
+        **kwargs: Unpack[ChatOptions],
+    ) -> AsyncIterator[str]:
+        import asyncio
+
+        stream = iter(await asyncio.to_thread(self._stream, messages, **kwargs))
+        end = object()
+        while (token := await asyncio.to_thread(next, stream, end)) is not end:
+            yield token
+
 
 class OpenAICompatibleModel(Model):
-    def __init__(self, name: str, abbr: Optional[str], client: OpenAI) -> None:
+    def __init__(
+        self,
+        name: str,
+        abbr: Optional[str],
+        client: "OpenAI",
+        async_client: "AsyncOpenAI",
+        stream_usage: bool = False,
+    ) -> None:
         self.client = client
+        self.async_client = async_client
         self.name = name
         self.abbr = abbr
+        # Not all OpenAI compatible APIs support the usage in streams
+        self.stream_options = {"include_usage": True} if stream_usage else None
 
     def _complete(self, messages, **kwargs):
         answer = self.client.chat.completions.create(
@@ -100,6 +185,8 @@ class OpenAICompatibleModel(Model):
             stream=False,
             **kwargs,
         )
+        if answer.usage is not None:
+            report_usage(answer.usage.prompt_tokens, answer.usage.completion_tokens)
         return answer.choices[0].message.content or ""
 
     def _stream(self, messages, **kwargs):
@@ -107,18 +194,61 @@ class OpenAICompatibleModel(Model):
             model=self.name,
             messages=self._map_messages(messages),
             stream=True,
+            **self._stream_kwargs(),
             **kwargs,
         )
-        return (
-            chunk.choices[0].delta.content
-            for chunk in stream
-            if chunk.choices[0].delta.content is not None
+        return self._tokens(stream)
+
+    def _tokens(self, stream: "Stream[ChatCompletionChunk]") -> Iterable[str]:
+        # Closing the generator closes the connection, e.g. if the stream is cancelled
+        with stream:
+            for chunk in stream:
+                token = self._token(chunk)
+                if token is not None:
+                    yield token
+
+    async def _acomplete(self, messages, **kwargs):
+        answer = await self.async_client.chat.completions.create(
+            model=self.name,
+            messages=self._map_messages(messages),
+            stream=False,
+            **kwargs,
+        )
+        if answer.usage is not None:
+            report_usage(answer.usage.prompt_tokens, answer.usage.completion_tokens)
+        return answer.choices[0].message.content or ""
+
+    async def _astream(self, messages, **kwargs):
+        stream = await self.async_client.chat.completions.create(
+            model=self.name,
+            messages=self._map_messages(messages),
+            stream=True,
+            **self._stream_kwargs(),
+            **kwargs,
         )
+        async with stream:
+            async for chunk in stream:
+                token = self._token(chunk)
+                if token is not None:
+                    yield token
+
+    def _stream_kwargs(self) -> dict:
+        if self.stream_options is None:
+            return {}
+        return {"stream_options": self.stream_options}
+
+    def _token(self, chunk: "ChatCompletionChunk") -> Optional[str]:
+        if chunk.usage is not None:
+            report_usage(chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+        # The chunk with the usage has no choices
+        if len(chunk.choices) == 0:
+            return None
+        return chunk.choices[0].delta.content
 
     def _map_messages(
         self, messages: List[Message]
-    ) -> List[ChatCompletionMessageParam]:
-        result: List[ChatCompletionMessageParam] = []
+    ) -> List["ChatCompletionMessageParam"]:
+        result: List["ChatCompletionMessageParam"] = []
         for m in messages:
             if m["role"] == "system":
                 result.append({"role": "system", "content": m["content"]})
@@ -131,7 +261,7 @@ class OpenAICompatibleModel(Model):
 
 class LangchainModel(Model):
     def __init__(
-        self, name: str, abbr: Optional[str], base_model: BaseChatModel
+        self, name: str, abbr: Optional[str], base_model: "BaseChatModel"
     ) -> None:
         self.name = name
         self.abbr = abbr
@@ -139,14 +269,39 @@ class LangchainModel(Model):
 
     def _complete(self, messages, **kwargs) -> str:
         answer = self.base_model.invoke(self._map_messages(messages), **kwargs)
-        return str(answer.content)
+        return self._content(answer)
 
     def _stream(self, messages, **kwargs) -> Iterable[str]:
         stream = self.base_model.stream(self._map_messages(messages), **kwargs)
-        return (str(chunk.content) for chunk in stream)
-
-    def _map_messages(self, messages: List[Message]) -> LanguageModelInput:
-        result: LanguageModelInput = []
+        return (self._content(chunk) for chunk in stream)
+
+    async def _acomplete(self, messages, **kwargs) -> str:
+        answer = await self.base_model.ainvoke(self._map_messages(messages), **kwargs)
+        return self._content(answer)
+
+    async def _astream(self, messages, **kwargs) -> AsyncIterator[str]:
+        stream = self.base_model.astream(self._map_messages(messages), **kwargs)
+        async for chunk in stream:
+            yield self._content(chunk)
+
+    def _content(self, message: "BaseMessage") -> str:
+        usage = getattr(message, "usage_metadata", None)
+        if usage:
+            report_usage(usage.get("input_tokens"), usage.get("output_tokens"))
+        else:
+            # Older versions of langchain only have the raw metadata of the provider
+            metadata = getattr(message, "response_metadata", None) or {}
+            usage = metadata.get("usage") or {}
+            report_usage(
+                usage.get("input_tokens") or metadata.get("prompt_eval_count"),
+                usage.get("output_tokens") or metadata.get("eval_count"),
+            )
+        return str(message.content)
+
+    def _map_messages(self, messages: List[Message]) -> "LanguageModelInput":
+        from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+        result: "LanguageModelInput" = []
         for m in messages:
             if m["role"] == "system":
                 result.append(SystemMessage(content=m["content"]))
@@ -158,36 +313,59 @@ class LangchainModel(Model):
 
 
 def openai_model(name: str, abbr: Optional[str]) -> Model:
-    return OpenAICompatibleModel(
+    return openai_compatible_model(name, abbr, stream_usage=True)
+
+
+def mistralai_model(name: str, abbr: Optional[str]) -> Model:
+    return openai_compatible_model(
         name,
         abbr,
-        OpenAI(),
+        api_key=os.getenv("MISTRAL_API_KEY"),
+        base_url="https://api.mistral.ai/v1",
     )
 
 
-def mistralai_model(name: str, abbr: Optional[str]) -> Model:
-    return OpenAICompatibleModel(
+def togetherai_model(name: str, abbr: Optional[str]) -> Model:
+    return openai_compatible_model(
         name,
         abbr,
-        OpenAI(
-            api_key=os.getenv("MISTRAL_API_KEY"),
-            base_url="https://api.mistral.ai/v1",
-        ),
+        api_key=os.getenv("TOGETHER_API_KEY"),
+        base_url="https://api.together.xyz/v1",
     )
 
 
-def togetherai_model(name: str, abbr: Optional[str]) -> Model:
+def openai_compatible_model(
+    name: str,
+    abbr: Optional[str],
+    stream_usage: bool = False,
+    **client_options: Optional[str],
+) -> Model:
+    from openai import AsyncOpenAI, OpenAI
+
+    from ai_scripts.lib.transport import async_http_client, http_client
+
+    options = {**client_options, **retry_options()}
     return OpenAICompatibleModel(
         name,
         abbr,
-        OpenAI(
-            api_key=os.getenv("TOGETHER_API_KEY"),
-            base_url="https://api.together.xyz/v1",
-        ),
+        OpenAI(http_client=http_client(), **options),
+        AsyncOpenAI(http_client=async_http_client(), **options),
+        stream_usage,
     )
 
 
+def retry_options() -> Dict[str, int]:
+    """Disables the retries of the SDK clients if the scheduler handles them"""
+    from ai_scripts.lib.scheduler import is_scheduler_enabled
+
+    return {"max_retries": 0} if is_scheduler_enabled() else {}
+
+
 def ollama_model(model: str, name: str, abbr: Optional[str]) -> Model:
+    from langchain_community.chat_models import ChatOllama
+
+    # ChatOllama uses requests instead of httpx, so it can't share the connection
+    # pool. The server usually runs locally anyway.
     ollama_url = os.getenv("OLLAMA_URL") or "http://localhost:11434"
     return LangchainModel(
         name,
@@ -200,74 +378,214 @@ def ollama_model(model: str, name: str, abbr: Optional[str]) -> Model:
 
 
 def anthropic_model(model: str, name: str, abbr: Optional[str]) -> Model:
-    return LangchainModel(
-        name,
-        abbr,
-        ChatAnthropic(
-            model_name=model,
-        ),
+    from langchain_anthropic import ChatAnthropic
+
+    from ai_scripts.lib.transport import async_http_client, http_client
+
+    base_model = ChatAnthropic(model_name=model, **retry_options())
+    client = http_client()
+    if client is None:
+        return LangchainModel(name, abbr, base_model)
+    import anthropic
+
+    # ChatAnthropic has no option for the HTTP client, so its SDK clients are
+    # replaced with ones that use the shared connection pool. If its internals
+    # change, it keeps its own clients.
+    original_client = getattr(base_model, "_client", None)
+    if not isinstance(original_client, anthropic.Client) or not hasattr(
+        base_model, "_async_client"
+    ):
+        if is_debbuging():
+            print_status(f"{name} doesn't use the shared HTTP client")
+        return LangchainModel(name, abbr, base_model)
+    options = {
+        "api_key": base_model.anthropic_api_key.get_secret_value(),
+        "base_url": base_model.anthropic_api_url,
+        # Like the clients created by ChatAnthropic
+        "max_retries": original_client.max_retries,
+        "default_headers": base_model.default_headers,
+        "timeout": original_client.timeout,
+    }
+    object.__setattr__(
+        base_model, "_client", anthropic.Client(http_client=client, **options)
     )
+    object.__setattr__(
+        base_model,
+        "_async_client",
+        anthropic.AsyncClient(http_client=async_http_client(), **options),
+    )
+    return LangchainModel(name, abbr, base_model)
+
+
+# Context size in tokens of the models without a known one
+DEFAULT_CONTEXT_TOKENS = 32_768
+# Default `num_ctx` of ollama
+OLLAMA_CONTEXT_TOKENS = 2048
+
+
+@dataclass(frozen=True)
+class ModelDescriptor:
+    """Cheap description of a model. The client is only created on `load`."""
+
+    name: str
+    abbr: Optional[str]
+    provider: str
+    factory: Callable[[str, Optional[str]], Model]
+    context_tokens: int = DEFAULT_CONTEXT_TOKENS
+
+    def load(self) -> Model:
+        from ai_scripts.lib import daemon
+
+        if daemon.is_available():
+            return daemon.RemoteModel(self)
+        return self.load_local()
+
+    def load_local(self) -> Model:
+        from ai_scripts.lib.scheduler import with_scheduler
+        from ai_scripts.lib.telemetry import with_telemetry
+
+        model = _loaded_models.get(self.name)
+        if model is None:
+            model = with_telemetry(self.factory(self.name, self.abbr))
+            model = with_scheduler(model, self.provider)
+            _loaded_models[self.name] = model
+        return model
+
+    def matches(self, name: str) -> bool:
+        lname = name.lower()
+        return self.name.lower() == lname or (
+            self.abbr is not None and self.abbr.lower() == lname
+        )
+
+
+_loaded_models: Dict[str, Model] = {}
 
 
 class Models(Enum):
-    GPT_4_TURBO = openai_model("gpt-4-1106-preview", "G4")
-    MIXTRAL_8_7B = togetherai_model("mistralai/Mixtral-8x7B-Instruct-v0.1", "M8")
-    MISTRAL_7B = togetherai_model("mistralai/Mistral-7B-Instruct-v0.2", "M7")
-    MISTRAL_TINY = mistralai_model("mistral-tiny", "MT")
-    MISTRAL_SMALL = mistralai_model("mistral-small", "MS")
-    MISTRAL_MEDIUM = mistralai_model("mistral-medium", "MM")
-    CLAUDE_3_OPUS = anthropic_model(
-        "claude-3-opus-20240229",
+    GPT_4_TURBO = ModelDescriptor(
+        "gpt-4-1106-preview", "G4", "openai", openai_model, context_tokens=128_000
+    )
+    MIXTRAL_8_7B = ModelDescriptor(
+        "mistralai/Mixtral-8x7B-Instruct-v0.1", "M8", "togetherai", togetherai_model
+    )
+    MISTRAL_7B = ModelDescriptor(
+        "mistralai/Mistral-7B-Instruct-v0.2", "M7", "togetherai", togetherai_model
+    )
+    MISTRAL_TINY = ModelDescriptor("mistral-tiny", "MT", "mistralai", mistralai_model)
+    MISTRAL_SMALL = ModelDescriptor("mistral-small", "MS", "mistralai", mistralai_model)
+    MISTRAL_MEDIUM = ModelDescriptor(
+        "mistral-medium", "MM", "mistralai", mistralai_model
+    )
+    CLAUDE_3_OPUS = ModelDescriptor(
         "claude-3-opus",
         "C3O",
+        "anthropic",
+        partial(anthropic_model, "claude-3-opus-20240229"),
+        context_tokens=200_000,
     )
-    CLAUDE_3_SONNET = anthropic_model(
-        "claude-3-sonnet-20240229",
+    CLAUDE_3_SONNET = ModelDescriptor(
         "claude-3-sonnet",
         "C3S",
+        "anthropic",
+        partial(anthropic_model, "claude-3-sonnet-20240229"),
+        context_tokens=200_000,
     )
-    CLAUDE_3_HAIKU = anthropic_model(
-        "claude-3-haiku-20240307",
+    CLAUDE_3_HAIKU = ModelDescriptor(
         "claude-3-haiku",
         "C3H",
+        "anthropic",
+        partial(anthropic_model, "claude-3-haiku-20240307"),
+        context_tokens=200_000,
     )
 
-    OLLAMA_MISTRAL_7B = ollama_model(
-        "mistral:7b-instruct",
+    # Ollama truncates the prompt to its default context size, regardless of the model
+    OLLAMA_MISTRAL_7B = ModelDescriptor(
         "ollama/mistral:7b-instruct",
         "OM7",
+        "ollama",
+        partial(ollama_model, "mistral:7b-instruct"),
+        context_tokens=OLLAMA_CONTEXT_TOKENS,
     )
-    OLLAMA_MISTRAL_OPENORCA = ollama_model(
-        "mistral-openorca",
+    OLLAMA_MISTRAL_OPENORCA = ModelDescriptor(
         "ollama/mistral-openorca",
         "OMO",
+        "ollama",
+        partial(ollama_model, "mistral-openorca"),
+        context_tokens=OLLAMA_CONTEXT_TOKENS,
     )
-    OLLAMA_MIXTRAL_8_7B = ollama_model(
-        "mixtral:instruct",
+    OLLAMA_MIXTRAL_8_7B = ModelDescriptor(
         "ollama/mixtral:instruct",
         "OMX",
+        "ollama",
+        partial(ollama_model, "mixtral:instruct"),
+        context_tokens=OLLAMA_CONTEXT_TOKENS,
     )
 
     @classmethod
-    def get_from_env_or_default(cls, default_model: Optional[Model] = None) -> Model:
+    def get_from_env_or_default(cls, default_model: Optional["Models"] = None) -> Model:
+        from ai_scripts.lib.recording import with_recording
+
         name = os.getenv("MODEL", None)
         if name is None or name == "":
-            return default_model or cls.GPT_4_TURBO.value
+            return with_recording((default_model or cls.GPT_4_TURBO).value.load())
         return cls.get_by_name(name)
 
     @classmethod
     def get_by_name(cls, name: str) -> Model:
-        lname = name.lower()
+        from ai_scripts.lib.recording import with_recording
+
+        return with_recording(cls._load_by_name(name))
+
+    @classmethod
+    def _load_by_name(cls, name: str) -> Model:
+        if "," in name:
+            from ai_scripts.lib.hedging import hedged_model
+
+            # Hedged request to multiple models, e.g. "C3H,MS"
+            return hedged_model([cls._load_by_name(n.strip()) for n in name.split(",")])
+        if name.startswith("replay:"):
+            from ai_scripts.lib.recording import replay_model
+
+            # Answers recorded with AI_SCRIPTS_RECORD, e.g. "replay:./cassettes"
+            return replay_model(name.removeprefix("replay:"))
+        if name.startswith("auto:"):
+            from ai_scripts.lib.latency import route
+
+            # Picks a model by its recent latency, e.g. "auto:fast"
+            return route(name.removeprefix("auto:")).load()
+        descriptor = cls.get_descriptor_by_name(name)
+        if descriptor is None:
+            print_step(
+                f'Couldn\'t find model "{name}". Try to access it anyway on TogetherAI.'
+            )
+            descriptor = ModelDescriptor(name, None, "togetherai", togetherai_model)
+        return descriptor.load()
+
+    @classmethod
+    def get_descriptor_by_name(cls, name: str) -> Optional[ModelDescriptor]:
         for enum in cls:
-            m = enum.value
-            if m.name.lower() == lname or (
-                m.abbr is not None and m.abbr.lower() == lname
-            ):
-                return m
-        print_step(
-            f'Couldn\'t find model "{name}". Try to access it anyway on TogetherAI.'
-        )
-        return togetherai_model(name, None)
+            if enum.value.matches(name):
+                return enum.value
+        return None
+
+    @classmethod
+    def context_tokens(cls, name: str) -> int:
+        """Context size of the model, the smallest one for hedged requests"""
+        sizes = []
+        for part in name.split(","):
+            descriptor = cls.get_descriptor_by_name(part.strip())
+            sizes.append(
+                descriptor.context_tokens if descriptor else DEFAULT_CONTEXT_TOKENS
+            )
+        return min(sizes)
+
+
+def print_request(status: str, messages: List[Message]):
+    print_divider()
+    print_status(status)
+    print_messages(messages)
+    print_divider()
+    print()
 
 
 def print_messages(messages: List[Message]):
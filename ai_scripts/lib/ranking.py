@@ -0,0 +1,115 @@
+from dataclasses import dataclass, field
+import math
+from typing import Dict, List, Set
+
+from ai_scripts.lib.fs import FileHits, SearchLine, format_hits
+from ai_scripts.lib.tokenizing import number_of_tokens
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# Score boost for every additional keyword matching the same file
+FILE_KEYWORD_BOOST = 0.5
+
+
+@dataclass
+class Window:
+    """Consecutive lines of a file with search hits"""
+
+    path: str
+    lines: List[SearchLine]
+    keywords: Set[str] = field(default_factory=set)
+    score: float = 0.0
+
+
+def rank_hits(hits: Dict[str, List[FileHits]]) -> List[Window]:
+    """
+    Splits the hits of all keywords into windows and sorts them by relevance.
+    Windows are scored with BM25 over the keywords and boosted if their file
+    matches multiple keywords.
+    """
+    windows = _split_windows(hits)
+    if len(windows) == 0:
+        return []
+    keywords = list(dict.fromkeys(k.lower() for k in hits if k != ""))
+    texts = ["\n".join(l.text for l in w.lines).lower() for w in windows]
+    lengths = [len(text.split()) or 1 for text in texts]
+    avg_length = sum(lengths) / len(lengths)
+    idf = {}
+    for keyword in keywords:
+        n_windows = sum(1 for text in texts if keyword in text)
+        idf[keyword] = math.log(
+            1 + (len(windows) - n_windows + 0.5) / (n_windows + 0.5)
+        )
+    file_keywords: Dict[str, Set[str]] = {}
+    for window in windows:
+        file_keywords.setdefault(window.path, set()).update(window.keywords)
+    for window, text, length in zip(windows, texts, lengths):
+        score = 0.0
+        for keyword in keywords:
+            tf = text.count(keyword)
+            score += idf[keyword] * (
+                tf * (K1 + 1) / (tf + K1 * (1 - B + B * length / avg_length))
+            )
+        boost = 1 + FILE_KEYWORD_BOOST * (len(file_keywords[window.path]) - 1)
+        window.score = score * boost
+    return sorted(windows, key=lambda w: w.score, reverse=True)
+
+
+def pack_windows(windows: List[Window], token_limit: int) -> List[Window]:
+    """Selects the best ranked windows that fit into the token limit"""
+    selected = []
+    used_tokens = 0
+    paths: Set[str] = set()
+    for window in windows:
+        tokens = number_of_tokens(format_hits([FileHits(window.path, window.lines)]))
+        if window.path in paths:
+            # The path is only printed once per file
+            tokens -= number_of_tokens(window.path)
+        if used_tokens + tokens > token_limit:
+            continue
+        selected.append(window)
+        paths.add(window.path)
+        used_tokens += tokens
+    return selected
+
+
+def format_windows(windows: List[Window]) -> str:
+    """Formats the windows grouped by file, starting with the most relevant file"""
+    files: Dict[str, FileHits] = {}
+    for window in windows:
+        files.setdefault(window.path, FileHits(window.path)).lines.extend(window.lines)
+    for file in files.values():
+        file.lines.sort(key=lambda line: line.number)
+    return format_hits(list(files.values()))
+
+
+def _split_windows(hits: Dict[str, List[FileHits]]) -> List[Window]:
+    # Merge the hits of all keywords, as their windows might overlap
+    files: Dict[str, Dict[int, SearchLine]] = {}
+    line_keywords: Dict[str, Dict[int, Set[str]]] = {}
+    for keyword, keyword_hits in hits.items():
+        for file in keyword_hits:
+            lines = files.setdefault(file.path, {})
+            for line in file.lines:
+                existing = lines.get(line.number)
+                if existing is None or existing.kind == "context":
+                    lines[line.number] = line
+                if line.kind == "match":
+                    line_keywords.setdefault(file.path, {}).setdefault(
+                        line.number, set()
+                    ).add(keyword)
+    windows: List[Window] = []
+    for path, lines in files.items():
+        window = None
+        for number in sorted(lines):
+            previous = None if window is None else window.lines[-1]
+            # Function lines belong to the following lines, even if there is a gap
+            if previous is None or (
+                number > previous.number + 1 and previous.kind != "function"
+            ):
+                window = Window(path, [])
+                windows.append(window)
+            window.lines.append(lines[number])
+            window.keywords.update(line_keywords.get(path, {}).get(number, set()))
+    return windows
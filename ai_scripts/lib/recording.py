@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import AsyncIterator, Iterable, List, Optional, Tuple
+
+from ai_scripts.lib.model import ChatOptions, Message, Model
+
+# Chunks of a cassette, as (seconds since the previous chunk or the request, text)
+Chunks = List[Tuple[float, str]]
+
+
+class Cassettes:
+    """
+    Directory with one JSON file per request, containing the streamed chunks of the
+    answer and the time between them
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    def get(self, messages: List[Message], options: ChatOptions) -> Optional[Chunks]:
+        path = self.path / f"{request_key(messages, options)}.json"
+        if not path.exists():
+            return None
+        cassette = json.loads(path.read_text())
+        return [(delay_s, text) for delay_s, text in cassette["chunks"]]
+
+    def put(
+        self,
+        model: str,
+        messages: List[Message],
+        options: ChatOptions,
+        chunks: Chunks,
+    ):
+        self.path.mkdir(parents=True, exist_ok=True)
+        path = self.path / f"{request_key(messages, options)}.json"
+        cassette = {
+            "model": model,
+            "messages": messages,
+            "options": options,
+            "recorded_at": time.time(),
+            "chunks": chunks,
+        }
+        # Written to a temporary file first, so replays never see partial cassettes
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps(cassette, indent=2))
+        tmp_path.replace(path)
+
+
+class RecordingModel(Model):
+    """Writes every fully received answer with its timing to the cassettes"""
+
+    def __init__(self, model: Model, cassettes: Cassettes) -> None:
+        self.model = model
+        self.cassettes = cassettes
+        self.name = model.name
+        self.abbr = model.abbr
+
+    def _complete(self, messages, **kwargs) -> str:
+        start = time.monotonic()
+        answer = self.model._complete(messages, **kwargs)
+        chunks = [(time.monotonic() - start, answer)]
+        self.cassettes.put(self.name, messages, kwargs, chunks)
+        return answer
+
+    def _stream(self, messages, **kwargs) -> Iterable[str]:
+        last = time.monotonic()
+        chunks: Chunks = []
+        for chunk in self.model._stream(messages, **kwargs):
+            now = time.monotonic()
+            chunks.append((now - last, chunk))
+            yield chunk
+            # The time the consumer needs for the chunk is not part of the answer
+            last = time.monotonic()
+        # Only reached if the stream was fully consumed
+        self.cassettes.put(self.name, messages, kwargs, chunks)
+
+    async def _acomplete(self, messages, **kwargs) -> str:
+        start = time.monotonic()
+        answer = await self.model._acomplete(messages, **kwargs)
+        chunks = [(time.monotonic() - start, answer)]
+        self.cassettes.put(self.name, messages, kwargs, chunks)
+        return answer
+
+    async def _astream(self, messages, **kwargs) -> AsyncIterator[str]:
+        last = time.monotonic()
+        chunks: Chunks = []
+        async for chunk in self.model._astream(messages, **kwargs):
+            now = time.monotonic()
+            chunks.append((now - last, chunk))
+            yield chunk
+            last = time.monotonic()
+        self.cassettes.put(self.name, messages, kwargs, chunks)
+
+
+class ReplayModel(Model):
+    """
+    Answers from the cassettes instead of a provider. The chunks are replayed with
+    their recorded timing divided by `speed`, or as fast as possible if it is 0.
+    """
+
+    def __init__(self, cassettes: Cassettes, speed: float) -> None:
+        self.cassettes = cassettes
+        self.speed = speed
+        self.name = f"replay:{cassettes.path}"
+        self.abbr = None
+
+    def _complete(self, messages, **kwargs) -> str:
+        return "".join(self._stream(messages, **kwargs))
+
+    def _stream(self, messages, **kwargs) -> Iterable[str]:
+        # Looked up before the iteration, so missing cassettes fail immediately
+        chunks = self._chunks(messages, kwargs)
+        return self._replay(chunks)
+
+    def _replay(self, chunks: Chunks) -> Iterable[str]:
+        for delay_s, text in chunks:
+            if self.speed > 0:
+                time.sleep(delay_s / self.speed)
+            yield text
+
+    async def _acomplete(self, messages, **kwargs) -> str:
+        return "".join([c async for c in self._astream(messages, **kwargs)])
+
+    async def _astream(self, messages, **kwargs) -> AsyncIterator[str]:
+        import asyncio
+
+        for delay_s, text in self._chunks(messages, kwargs):
+            if self.speed > 0:
+                await asyncio.sleep(delay_s / self.speed)
+            yield text
+
+    def _chunks(self, messages: List[Message], options: ChatOptions) -> Chunks:
+        chunks = self.cassettes.get(messages, options)
+        if chunks is None:
+            raise LookupError(
+                f"No recorded answer for the request in {self.cassettes.path}. "
+                "Record it first with AI_SCRIPTS_RECORD."
+            )
+        return chunks
+
+
+def request_key(messages: List[Message], options: ChatOptions) -> str:
+    # The model is not part of the key, so the replay can stand in for any model
+    request = json.dumps({"messages": messages, "options": options}, sort_keys=True)
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+
+def replay_model(path: str) -> Model:
+    speed = os.getenv("AI_SCRIPTS_REPLAY_SPEED")
+    return ReplayModel(Cassettes(Path(path)), float(speed) if speed else 1.0)
+
+
+def with_recording(model: Model) -> Model:
+    path = os.getenv("AI_SCRIPTS_RECORD")
+    if not path:
+        return model
+    return RecordingModel(model, Cassettes(Path(path)))
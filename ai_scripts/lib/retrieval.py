@@ -0,0 +1,61 @@
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from ai_scripts.lib.index import CHUNK_LINES, WorkspaceIndex, term_regex
+from ai_scripts.lib.logging import print_status
+
+
+def rank_files(index: WorkspaceIndex, query: str, limit: int) -> List[str]:
+    """
+    Returns the paths of the files most relevant to the query, using the updated
+    index. Files are split into chunks, which are ranked by their TF-IDF
+    similarity to the query. A file is as relevant as its best chunk.
+    """
+    import numpy as np
+
+    query_counts = Counter(term_regex.findall(query.lower()))
+    if len(query_counts) == 0:
+        return []
+    try:
+        terms = list(query_counts)
+        postings = index.term_postings(terms)
+        lengths = index.chunk_lengths(terms)
+        n_chunks = index.number_of_chunks()
+    except Exception as e:
+        print_status(f"Search index is not available: {e}")
+        return []
+    if len(postings) == 0:
+        return []
+
+    term_ids = {term: i for i, term in enumerate(terms)}
+    chunk_ids: Dict[Tuple[str, int], int] = {}
+    posting_terms: List[int] = []
+    posting_chunks: List[int] = []
+    for term, path, lines in postings:
+        for number in lines:
+            chunk = (path, (number - 1) // CHUNK_LINES)
+            posting_terms.append(term_ids[term])
+            posting_chunks.append(chunk_ids.setdefault(chunk, len(chunk_ids)))
+
+    # Number of lines containing the term per (term, chunk)
+    keys, tf = np.unique(
+        np.array(posting_terms) * len(chunk_ids) + np.array(posting_chunks),
+        return_counts=True,
+    )
+    term_of, chunk_of = np.divmod(keys, len(chunk_ids))
+    df = np.bincount(term_of, minlength=len(terms))
+    idf = np.log((n_chunks + 1) / (df + 1)) + 1
+    query_tf = np.array([query_counts[term] for term in terms])
+    query_weights = (1 + np.log(query_tf)) * idf
+    weights = (1 + np.log(tf)) * idf[term_of] * query_weights[term_of]
+    chunk_lengths = np.array([lengths.get(chunk, 1) for chunk in chunk_ids])
+    scores = np.bincount(chunk_of, weights, minlength=len(chunk_ids)) / np.sqrt(
+        np.maximum(chunk_lengths, 1)
+    )
+
+    paths = list(dict.fromkeys(path for path, _ in chunk_ids))
+    path_ids = {path: i for i, path in enumerate(paths)}
+    file_scores = np.zeros(len(paths))
+    np.maximum.at(file_scores, [path_ids[path] for path, _ in chunk_ids], scores)
+    best = np.argsort(-file_scores, kind="stable")[:limit]
+    return [paths[i] for i in best if file_scores[i] > 0]
@@ -0,0 +1,304 @@
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+import os
+import random
+import sys
+import threading
+import time
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple, Type
+
+from ai_scripts.lib.logging import print_status
+from ai_scripts.lib.model import ChatOptions, Message, Model
+
+DEFAULT_MAX_RETRIES = 5
+# Exponential backoff: BACKOFF_BASE_S * 2^attempt, at most BACKOFF_MAX_S
+BACKOFF_BASE_S = 0.5
+BACKOFF_MAX_S = 30
+# Longer delays requested by the provider fail the request instead of waiting
+DEFAULT_MAX_RETRY_AFTER_S = 120
+# Status codes of errors which might succeed if the request is repeated
+RETRY_STATUS_CODES = {408, 409, 429}
+# Errors without status code that are worth a retry, as (module, class) of the
+# clients. A module is only checked if it's loaded, which it is if it raised the error.
+RETRY_ERROR_TYPES = [
+    # Includes APITimeoutError
+    ("openai", "APIConnectionError"),
+    ("anthropic", "APIConnectionError"),
+    # E.g. ConnectError, ReadTimeout and RemoteProtocolError
+    ("httpx", "TransportError"),
+    # Used by ChatOllama
+    ("requests.exceptions", "ConnectionError"),
+    ("requests.exceptions", "Timeout"),
+]
+
+
+@dataclass
+class RateLimits:
+    """Limits of a provider. None means unlimited."""
+
+    requests_per_minute: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+    max_retries: int = DEFAULT_MAX_RETRIES
+    max_retry_after_s: float = DEFAULT_MAX_RETRY_AFTER_S
+
+    @classmethod
+    def from_env(cls, provider: str) -> "RateLimits":
+        """
+        Reads the limits from `AI_SCRIPTS_RPM_<PROVIDER>`, `AI_SCRIPTS_TPM_<PROVIDER>`,
+        `AI_SCRIPTS_MAX_RETRIES` and `AI_SCRIPTS_MAX_RETRY_AFTER_S`.
+        """
+        suffix = provider.upper()
+        rpm = os.getenv(f"AI_SCRIPTS_RPM_{suffix}")
+        tpm = os.getenv(f"AI_SCRIPTS_TPM_{suffix}")
+        max_retries = os.getenv("AI_SCRIPTS_MAX_RETRIES")
+        max_retry_after_s = os.getenv("AI_SCRIPTS_MAX_RETRY_AFTER_S")
+        return cls(
+            requests_per_minute=float(rpm) if rpm else None,
+            tokens_per_minute=float(tpm) if tpm else None,
+            max_retries=int(max_retries) if max_retries else DEFAULT_MAX_RETRIES,
+            max_retry_after_s=(
+                float(max_retry_after_s)
+                if max_retry_after_s
+                else DEFAULT_MAX_RETRY_AFTER_S
+            ),
+        )
+
+
+class TokenBucket:
+    """
+    Allows `rate_per_minute` units per minute, with bursts of up to a minute worth
+    of units. Units are reserved upfront, so concurrent callers queue up.
+    """
+
+    def __init__(self, rate_per_minute: float) -> None:
+        self.capacity = rate_per_minute
+        self.rate_per_second = rate_per_minute / 60
+        self.available = rate_per_minute
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """Reserves the units and returns the seconds to wait before using them"""
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(
+                self.capacity,
+                self.available + (now - self.updated_at) * self.rate_per_second,
+            )
+            self.updated_at = now
+            self.available -= min(amount, self.capacity)
+            if self.available >= 0:
+                return 0
+            return -self.available / self.rate_per_second
+
+
+class Scheduler:
+    """Rate limits and retries the requests to a provider"""
+
+    def __init__(self, provider: str, limits: RateLimits) -> None:
+        self.provider = provider
+        self.limits = limits
+        self.requests = None
+        self.tokens = None
+        if limits.requests_per_minute is not None:
+            self.requests = TokenBucket(limits.requests_per_minute)
+        if limits.tokens_per_minute is not None:
+            self.tokens = TokenBucket(limits.tokens_per_minute)
+
+    def reserve(self, messages: List[Message], options: ChatOptions) -> float:
+        """Reserves the capacity for the request and returns the seconds to wait"""
+        delay = 0.0
+        if self.requests is not None:
+            delay = self.requests.reserve(1)
+        if self.tokens is not None:
+            from ai_scripts.lib.tokenizing import number_of_tokens
+
+            # Providers count the maximum number of completion tokens upfront
+            tokens = sum(number_of_tokens(m["content"]) for m in messages)
+            tokens += options.get("max_tokens") or 0
+            delay = max(delay, self.tokens.reserve(tokens))
+        return delay
+
+    def retry_delay(self, attempt: int, error: Exception) -> Optional[float]:
+        """Returns the seconds to wait before the next attempt or None to give up"""
+        if attempt >= self.limits.max_retries or not is_retryable(error):
+            return None
+        delay = retry_after(error)
+        if delay is None:
+            # Full jitter, so concurrent requests don't retry at the same time
+            delay = random.uniform(0, min(BACKOFF_MAX_S, BACKOFF_BASE_S * 2**attempt))
+        elif delay > self.limits.max_retry_after_s:
+            print_status(
+                f"{self.provider} request failed ({describe_error(error)}), "
+                f"the provider asks to retry in {delay:.0f}s"
+            )
+            return None
+        print_status(
+            f"{self.provider} request failed ({describe_error(error)}), "
+            f"retrying in {delay:.1f}s"
+        )
+        return delay
+
+
+_schedulers: Dict[str, Scheduler] = {}
+_schedulers_lock = threading.Lock()
+
+
+def scheduler_for(provider: str) -> Scheduler:
+    """Returns the scheduler of the provider, which is shared by all its models"""
+    with _schedulers_lock:
+        scheduler = _schedulers.get(provider)
+        if scheduler is None:
+            scheduler = Scheduler(provider, RateLimits.from_env(provider))
+            _schedulers[provider] = scheduler
+        return scheduler
+
+
+class ScheduledModel(Model):
+    """
+    Waits for the rate limits of the provider and retries failed requests.
+    Streams are only retried until the first token was received.
+    """
+
+    def __init__(self, model: Model, scheduler: Scheduler) -> None:
+        self.model = model
+        self.scheduler = scheduler
+        self.name = model.name
+        self.abbr = model.abbr
+
+    def _complete(self, messages, **kwargs) -> str:
+        attempt = 0
+        while True:
+            time.sleep(self.scheduler.reserve(messages, kwargs))
+            try:
+                return self.model._complete(messages, **kwargs)
+            except Exception as e:
+                delay = self.scheduler.retry_delay(attempt, e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+
+    def _stream(self, messages, **kwargs) -> Iterable[str]:
+        attempt = 0
+        while True:
+            time.sleep(self.scheduler.reserve(messages, kwargs))
+            try:
+                stream = iter(self.model._stream(messages, **kwargs))
+                first = next(stream)
+            except StopIteration:
+                return
+            except Exception as e:
+                delay = self.scheduler.retry_delay(attempt, e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            yield first
+            yield from stream
+            return
+
+    async def _acomplete(self, messages, **kwargs) -> str:
+        import asyncio
+
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.scheduler.reserve(messages, kwargs))
+            try:
+                return await self.model._acomplete(messages, **kwargs)
+            except Exception as e:
+                delay = self.scheduler.retry_delay(attempt, e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _astream(self, messages, **kwargs) -> AsyncIterator[str]:
+        import asyncio
+
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.scheduler.reserve(messages, kwargs))
+            try:
+                stream = aiter(self.model._astream(messages, **kwargs))
+                first = await anext(stream)
+            except StopAsyncIteration:
+                return
+            except Exception as e:
+                delay = self.scheduler.retry_delay(attempt, e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            yield first
+            async for token in stream:
+                yield token
+            return
+
+
+def is_scheduler_enabled() -> bool:
+    """If disabled, the clients of the models retry failed requests themselves"""
+    return os.getenv("AI_SCRIPTS_SCHEDULER") != "0"
+
+
+def with_scheduler(model: Model, provider: str) -> Model:
+    if not is_scheduler_enabled():
+        return model
+    return ScheduledModel(model, scheduler_for(provider))
+
+
+def is_retryable(error: Exception) -> bool:
+    status_code = status_code_of(error)
+    if status_code is not None:
+        return status_code in RETRY_STATUS_CODES or status_code >= 500
+    return isinstance(error, retry_error_types())
+
+
+def retry_error_types() -> Tuple[Type[BaseException], ...]:
+    error_types: List[Type[BaseException]] = [ConnectionError, TimeoutError]
+    for module_name, class_name in RETRY_ERROR_TYPES:
+        error_type = getattr(sys.modules.get(module_name), class_name, None)
+        if isinstance(error_type, type) and issubclass(error_type, BaseException):
+            error_types.append(error_type)
+    return tuple(error_types)
+
+
+def status_code_of(error: Exception) -> Optional[int]:
+    status_code = getattr(error, "status_code", None)
+    if isinstance(status_code, int):
+        return status_code
+    status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code if isinstance(status_code, int) else None
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Reads the delay from the `Retry-After` header of the response of the error"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers is None:
+        return None
+    milliseconds = headers.get("retry-after-ms")
+    if milliseconds is not None:
+        try:
+            return max(float(milliseconds) / 1000, 0)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return max(seconds, 0)
+
+
+def describe_error(error: Exception) -> str:
+    status_code = status_code_of(error)
+    if status_code is not None:
+        return f"status {status_code}"
+    return type(error).__name__
@@ -1,12 +1,45 @@
 import subprocess
-from typing import List
+from typing import Iterator, List
 
 from ai_scripts.lib.env import is_debbuging
 from ai_scripts.lib.logging import print_status
+from ai_scripts.lib.tracing import span
 
 
 def run_cmd(cmd: List[str]) -> str:
     if is_debbuging():
         cmd_str = " ".join(cmd)
         print_status(f"Run: {cmd_str}")
-    return subprocess.run(cmd, stdout=subprocess.PIPE).stdout.decode("utf-8")
+    with span(_span_name(cmd), "subprocess", cmd=" ".join(cmd)) as args:
+        output = subprocess.run(cmd, stdout=subprocess.PIPE).stdout
+        args["output_bytes"] = len(output)
+    return output.decode("utf-8")
+
+
+def stream_cmd(cmd: List[str]) -> Iterator[str]:
+    """
+    Yields the output of the command line by line. The command is killed if the
+    iteration is stopped early, so it doesn't produce output that isn't read.
+    """
+    if is_debbuging():
+        cmd_str = " ".join(cmd)
+        print_status(f"Run: {cmd_str}")
+    with span(_span_name(cmd), "subprocess", cmd=" ".join(cmd)) as args:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        assert process.stdout is not None
+        output_bytes = 0
+        try:
+            for line in process.stdout:
+                output_bytes += len(line)
+                yield line.decode("utf-8").rstrip("\r\n")
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.stdout.close()
+            process.wait()
+            args["output_bytes"] = output_bytes
+
+
+def _span_name(cmd: List[str]) -> str:
+    # e.g. "git grep" or "eza"
+    return " ".join(arg for arg in cmd[:2] if not arg.startswith("-"))
@@ -1,7 +1,7 @@
 from dataclasses import dataclass
+import json
 import re
-from typing import Optional
-import mdformat
+from typing import List, Optional
 
 
 @dataclass
@@ -11,31 +11,185 @@ class ExtractedCode:
     completed: bool
 
 
-def extract_first_code_snippet_from_markdown(markdown: str) -> ExtractedCode:
-    result = []
-    in_code_block = False
-    number_ticks = 0
-    completed = False
-    language = None
-    for line in markdown.strip().splitlines():
-        if in_code_block:
-            md_end_match = re.match(f"^(`{{{number_ticks}}}) *$", line)
-            if md_end_match:
-                completed = True
+code_start_regex = re.compile(r"^(`{3,})(\w*) *$")
+code_end_candidate_regex = re.compile(r"^(`*)( *)$")
+
+
+class CodeExtractor:
+    """
+    Extracts the first code snippet from streamed markdown.
+    Every token is only processed once, so the cost doesn't grow with the length of
+    the answer.
+    """
+
+    def __init__(self) -> None:
+        self.completed = False
+        self._code = ""
+        self._number_lines = 0
+        self._line = ""
+        self._in_code_block = False
+        self._number_ticks = 0
+        self._code_end_regex: Optional[re.Pattern] = None
+        self._language: Optional[str] = None
+        self._pending_language: Optional[str] = None
+        self._text_started = False
+        self._emitted = 0
+
+    @property
+    def language(self) -> Optional[str]:
+        return self._language if self._in_code_block else self._pending_language
+
+    @property
+    def code(self) -> str:
+        if self.completed or not self._in_code_block:
+            return self._code
+        return self._tail(0, include_line=True).rstrip()
+
+    def extract(self) -> ExtractedCode:
+        return ExtractedCode(
+            code=self.code, language=self.language, completed=self.completed
+        )
+
+    def push(self, token: str) -> str:
+        """
+        Adds the token and returns the code that was added by it.
+        The returned code is not changing anymore, so it can be printed directly.
+        """
+        if self.completed:
+            return ""
+        *lines, self._line = (self._line + token).split("\n")
+        for line in lines:
+            self._add_line(line.removesuffix("\r"))
+            if self.completed:
+                self._line = ""
                 break
+        if not self.completed:
+            self._check_incomplete_line()
+        return self._pop_code(finish=False)
+
+    def finish(self) -> str:
+        """Returns the remaining code that was held back by `push`"""
+        return self._pop_code(finish=True)
+
+    def _add_line(self, line: str):
+        if self._in_code_block:
+            if self._code_end_regex and self._code_end_regex.match(line.rstrip()):
+                self.completed = True
             else:
-                result.append(line)
+                self._code = f"{self._code}\n{line}" if self._number_lines else line
+                self._number_lines += 1
+            return
+        if not self._text_started:
+            # Leading whitespace of the markdown is ignored
+            line = line.lstrip()
+            self._text_started = line != ""
+        md_start_match = code_start_regex.match(line.rstrip())
+        if md_start_match is not None:
+            self._in_code_block = True
+            self._number_ticks = len(md_start_match.group(1))
+            self._code_end_regex = re.compile(f"^(`{{{self._number_ticks}}}) *$")
+            self._language = md_start_match.group(2)
+
+    def _check_incomplete_line(self):
+        line = self._line.rstrip()
+        if self._in_code_block:
+            if self._code_end_regex and self._code_end_regex.match(line):
+                self.completed = True
+            return
+        line = line if self._text_started else line.lstrip()
+        md_start_match = code_start_regex.match(line)
+        self._pending_language = md_start_match.group(2) if md_start_match else None
+
+    def _pop_code(self, finish: bool) -> str:
+        if not self._in_code_block:
+            return ""
+        if self.completed:
+            code = self._tail(self._emitted, include_line=False)
         else:
-            md_start_match = re.match(r"^(`{3,})(\w*) *$", line)
-            if md_start_match is not None:
-                in_code_block = True
-                number_ticks = len(md_start_match.group(1))
-                language = md_start_match.group(2)
-    code = "\n".join(result)
-    return ExtractedCode(code=code, completed=completed, language=language)
+            # Hold back the current line if it might turn into the end of the block
+            include_line = finish or not self._might_be_code_end(self._line)
+            code = self._tail(self._emitted, include_line).rstrip()
+        self._emitted += len(code)
+        return code
+
+    def _might_be_code_end(self, line: str) -> bool:
+        match = code_end_candidate_regex.match(line)
+        if match is None:
+            return False
+        number_ticks = len(match.group(1))
+        if match.group(2) != "":
+            return number_ticks == self._number_ticks
+        return number_ticks <= self._number_ticks
+
+    def _tail(self, start: int, include_line: bool) -> str:
+        """Returns the code starting from `start` without joining the whole code"""
+        tail = self._code[start:]
+        if include_line:
+            line = f"\n{self._line}" if self._number_lines else self._line
+            tail += line[max(0, start - len(self._code)) :]
+        return tail
+
+
+class StringArrayParser:
+    """
+    Extracts the strings of the first JSON array from a streamed answer.
+    Text around the array is ignored and a partial array is returned as far as it
+    was received, so the answer doesn't need to be valid JSON.
+    """
+
+    def __init__(self) -> None:
+        self.found = False
+        self.completed = False
+        self._literal: Optional[str] = None
+        self._escaped = False
+        self._depth = 0
+
+    def push(self, token: str) -> List[str]:
+        """Adds the token and returns the strings that were completed by it"""
+        strings = []
+        for char in token:
+            if self.completed:
+                break
+            if not self.found:
+                self.found = char == "["
+            elif self._literal is None:
+                if char == '"':
+                    self._literal = char
+                elif char in "[{":
+                    self._depth += 1
+                elif char in "]}":
+                    self._depth -= 1
+                    self.completed = self._depth < 0
+            else:
+                self._literal += char
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    # Only the direct elements of the array are relevant
+                    if self._depth == 0:
+                        strings.append(_decode_string(self._literal))
+                    self._literal = None
+        return strings
+
+
+def _decode_string(literal: str) -> str:
+    try:
+        return json.loads(literal)
+    except ValueError:
+        return literal[1:-1]
+
+
+def extract_first_code_snippet_from_markdown(markdown: str) -> ExtractedCode:
+    extractor = CodeExtractor()
+    extractor.push(markdown)
+    return extractor.extract()
 
 
 def format_markdown(md: str) -> str:
+    import mdformat
+
     parts = re.split(r"^---\n", md, flags=re.RegexFlag.MULTILINE)
     parts[-1] = mdformat.text(parts[-1], options={"wrap": 80})
     if len(parts) >= 3:
@@ -0,0 +1,276 @@
+from contextlib import closing
+from contextvars import ContextVar
+from dataclasses import astuple, dataclass, fields
+import math
+import os
+import sys
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, AsyncIterator, Iterable, List, Optional
+
+from ai_scripts.lib.env import cache_dir
+from ai_scripts.lib.model import Model, Usage, current_usage
+
+if TYPE_CHECKING:
+    import sqlite3
+
+# Calls older than this are deleted
+TELEMETRY_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# Command that issued the current request. Set by the daemon for forwarded requests.
+current_command: ContextVar[Optional[str]] = ContextVar("current_command", default=None)
+
+
+def command_name() -> str:
+    command = current_command.get()
+    if command is not None:
+        return command
+    return Path(sys.argv[0]).stem.replace("_", "-") or "python"
+
+
+@dataclass
+class Call:
+    """Performance of a single request to a model"""
+
+    command: str
+    model: str
+    method: str
+    started_at: float
+    duration_s: float = 0.0
+    # None if the request wasn't streamed or didn't produce a token
+    ttft_s: Optional[float] = None
+    chunks: int = 0
+    mean_gap_s: Optional[float] = None
+    max_gap_s: Optional[float] = None
+    # Reported by the provider, None if unknown
+    prompt_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    error: Optional[str] = None
+
+    @property
+    def tokens_per_s(self) -> Optional[float]:
+        """Output tokens per second after the first token"""
+        if self.ttft_s is None or self.duration_s <= self.ttft_s:
+            return None
+        # Chunks of a stream are roughly tokens, if the provider reports no usage
+        tokens = self.completion_tokens or self.chunks
+        if tokens <= 1:
+            return None
+        return (tokens - 1) / (self.duration_s - self.ttft_s)
+
+
+COLUMNS = ", ".join(f.name for f in fields(Call))
+
+
+class Telemetry:
+    """Log of all model calls, stored in SQLite"""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+
+    @classmethod
+    def from_env(cls) -> "Telemetry":
+        return cls(cache_dir() / "telemetry.sqlite")
+
+    def record(self, call: Call):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                f"INSERT INTO calls ({COLUMNS}) VALUES ({', '.join('?' * len(fields(Call)))})",
+                astuple(call),
+            )
+            conn.execute(
+                "DELETE FROM calls WHERE started_at < ?",
+                (time.time() - TELEMETRY_TTL_SECONDS,),
+            )
+
+    def calls(self, since: float) -> List[Call]:
+        """Returns the calls started after `since`, starting with the most recent"""
+        if not self.path.exists():
+            return []
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"SELECT {COLUMNS} FROM calls WHERE started_at >= ? "
+                "ORDER BY started_at DESC",
+                (since,),
+            ).fetchall()
+        return [Call(*row) for row in rows]
+
+    def _connect(self) -> "sqlite3.Connection":
+        import sqlite3
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS calls ("
+            "command TEXT NOT NULL, "
+            "model TEXT NOT NULL, "
+            "method TEXT NOT NULL, "
+            "started_at REAL NOT NULL, "
+            "duration_s REAL NOT NULL, "
+            "ttft_s REAL, "
+            "chunks INTEGER NOT NULL, "
+            "mean_gap_s REAL, "
+            "max_gap_s REAL, "
+            "prompt_tokens INTEGER, "
+            "completion_tokens INTEGER, "
+            "error TEXT)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS calls_started_at ON calls (started_at)"
+        )
+        return conn
+
+
+class CallTimer:
+    """
+    Measures a call. Tokens only cost a clock read and some arithmetic, the call is
+    written once it is finished.
+    """
+
+    def __init__(self, model: str, method: str) -> None:
+        self.call = Call(command_name(), model, method, time.time())
+        self.usage = Usage()
+        self.start = time.monotonic()
+        self.last_token_at: Optional[float] = None
+        self.gaps_s = 0.0
+        self.n_gaps = 0
+
+    def token(self, token: str):
+        now = time.monotonic()
+        call = self.call
+        call.chunks += 1
+        if self.last_token_at is None:
+            if token == "":
+                return
+            call.ttft_s = now - self.start
+        else:
+            gap_s = now - self.last_token_at
+            self.gaps_s += gap_s
+            self.n_gaps += 1
+            if call.max_gap_s is None or gap_s > call.max_gap_s:
+                call.max_gap_s = gap_s
+        self.last_token_at = now
+
+    def finish(self, telemetry: "Telemetry", error: Optional[BaseException] = None):
+        call = self.call
+        call.duration_s = time.monotonic() - self.start
+        if self.n_gaps > 0:
+            call.mean_gap_s = self.gaps_s / self.n_gaps
+        if self.usage.prompt_tokens or self.usage.completion_tokens:
+            call.prompt_tokens = self.usage.prompt_tokens
+            call.completion_tokens = self.usage.completion_tokens
+        if error is not None:
+            call.error = type(error).__name__
+        try:
+            telemetry.record(call)
+        except Exception:
+            # Telemetry is not worth failing the request
+            pass
+
+
+class InstrumentedModel(Model):
+    """Records the performance of every call in the telemetry log"""
+
+    def __init__(self, model: Model, telemetry: Telemetry) -> None:
+        self.model = model
+        self.telemetry = telemetry
+        self.name = model.name
+        self.abbr = model.abbr
+
+    def _complete(self, messages, **kwargs) -> str:
+        timer = CallTimer(self.name, "complete")
+        reset = current_usage.set(timer.usage)
+        try:
+            answer = self.model._complete(messages, **kwargs)
+        except Exception as e:
+            timer.finish(self.telemetry, e)
+            raise
+        finally:
+            current_usage.reset(reset)
+        timer.finish(self.telemetry)
+        return answer
+
+    def _stream(self, messages, **kwargs) -> Iterable[str]:
+        timer = CallTimer(self.name, "stream")
+        reset = current_usage.set(timer.usage)
+        try:
+            stream = iter(self.model._stream(messages, **kwargs))
+        except Exception as e:
+            timer.finish(self.telemetry, e)
+            raise
+        finally:
+            current_usage.reset(reset)
+        return self._measure(timer, stream)
+
+    def _measure(self, timer: CallTimer, stream: Iterable[str]) -> Iterable[str]:
+        error = None
+        try:
+            while True:
+                # The usage is only collected while the provider stream is advanced,
+                # so the consumer of the stream can call other models in between
+                reset = current_usage.set(timer.usage)
+                try:
+                    token = next(stream)
+                except StopIteration:
+                    return
+                finally:
+                    current_usage.reset(reset)
+                timer.token(token)
+                yield token
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+            timer.finish(self.telemetry, error)
+
+    async def _acomplete(self, messages, **kwargs) -> str:
+        timer = CallTimer(self.name, "acomplete")
+        reset = current_usage.set(timer.usage)
+        try:
+            answer = await self.model._acomplete(messages, **kwargs)
+        except Exception as e:
+            timer.finish(self.telemetry, e)
+            raise
+        finally:
+            current_usage.reset(reset)
+        timer.finish(self.telemetry)
+        return answer
+
+    async def _astream(self, messages, **kwargs) -> AsyncIterator[str]:
+        timer = CallTimer(self.name, "astream")
+        stream = aiter(self.model._astream(messages, **kwargs))
+        error = None
+        try:
+            while True:
+                reset = current_usage.set(timer.usage)
+                try:
+                    token = await anext(stream)
+                except StopAsyncIteration:
+                    return
+                finally:
+                    current_usage.reset(reset)
+                timer.token(token)
+                yield token
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            aclose = getattr(stream, "aclose", None)
+            if aclose is not None:
+                await aclose()
+            timer.finish(self.telemetry, error)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest rank percentile"""
+    ordered = sorted(values)
+    return ordered[min(math.ceil(q * len(ordered)), len(ordered)) - 1]
+
+
+def with_telemetry(model: Model) -> Model:
+    if os.getenv("AI_SCRIPTS_TELEMETRY") == "0":
+        return model
+    return InstrumentedModel(model, Telemetry.from_env())
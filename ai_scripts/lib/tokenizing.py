@@ -1,5 +1,70 @@
-import tiktoken
-from tiktoken.core import Encoding
+import base64
+import hashlib
+import os
+import re
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, List, Optional, Protocol
+
+from ai_scripts.lib.env import cache_dir
+from ai_scripts.lib.logging import print_error
+
+if TYPE_CHECKING:
+    from tiktoken.core import Encoding as TiktokenEncoding
+
+# Average number of characters per token, used to guess how much text needs to be encoded
+CHARS_PER_TOKEN = 4
+# Tokens at the end of an encoded prefix might change if more text follows
+PREFIX_MARGIN_TOKENS = 16
+# File of the cl100k_base encoding, which is used by the GPT-4 models
+TOKENIZER_URL = (
+    "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken"
+)
+DOWNLOAD_TIMEOUT_S = 5
+# Split pattern of cl100k_base, as in tiktoken_ext.openai_public
+CL100K_PATTERN = r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"""
+
+
+class Encoding(Protocol):
+    def encode(self, text: str) -> List[Any]:
+        ...
+
+    def decode(self, tokens: List[Any]) -> str:
+        ...
+
+
+class ApproximateEncoding(Encoding):
+    """Fallback if the tokenizer files cannot be loaded (e.g. without internet)"""
+
+    def encode(self, text: str) -> List[str]:
+        return [
+            text[i : i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)
+        ]
+
+    def decode(self, tokens: List[str]) -> str:
+        return "".join(tokens)
+
+
+class TokenCounter:
+    """Counts the tokens of a growing text without encoding it again"""
+
+    def __init__(self) -> None:
+        self.count = 0
+
+    def add(self, text: str) -> int:
+        n = number_of_tokens(text)
+        self.count += n
+        return n
+
+    def add_limited(self, text: str, limit: int) -> str:
+        """Limits the text to the given number of tokens and counts the result"""
+        tokens = encode_prefix(text, limit)
+        self.count += len(tokens)
+        return text if len(tokens) < limit else token_encoding().decode(tokens)
+
+
+_encoding: Optional[Encoding] = None
+_encoding_lock = threading.Lock()
 
 
 def number_of_tokens(text: str) -> int:
@@ -7,11 +72,142 @@ def number_of_tokens(text: str) -> int:
 
 
 def limit_tokens(text: str, limit: int) -> str:
+    tokens = encode_prefix(text, limit)
+    return text if len(tokens) < limit else token_encoding().decode(tokens)
+
+
+def encode_prefix(text: str, limit: int) -> List[Any]:
+    """Returns the first `limit` tokens of the text, without encoding all of it"""
+    encoding = token_encoding()
+    n_chars = (limit + PREFIX_MARGIN_TOKENS) * CHARS_PER_TOKEN
+    while True:
+        prefix = text[:n_chars]
+        tokens = encoding.encode(prefix)
+        if len(prefix) == len(text) or len(tokens) > limit + PREFIX_MARGIN_TOKENS:
+            return tokens[:limit]
+        n_chars *= 2
+
+
+def split_chunks(text: str, limit: int) -> List[str]:
+    """
+    Splits the text into chunks of at most `limit` tokens. Chunks end at paragraph
+    boundaries if possible and new chunks are preferably started at headings.
+    """
+    blocks = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip("\n")
+        if paragraph.strip() == "":
+            continue
+        if number_of_tokens(paragraph) <= limit:
+            blocks.append(paragraph)
+            continue
+        for line in paragraph.splitlines():
+            while line != "":
+                part = _token_prefix(line, limit)
+                blocks.append(part)
+                line = line[len(part) :]
+
+    chunks: List[str] = []
+    current: List[str] = []
+    current_tokens = 0
+    for block in blocks:
+        tokens = number_of_tokens(block)
+        is_heading = block.lstrip().startswith("#")
+        if current and (
+            current_tokens + tokens > limit
+            or (is_heading and current_tokens > limit // 2)
+        ):
+            chunks.append("\n\n".join(current))
+            current = []
+            current_tokens = 0
+        current.append(block)
+        # The separator between the blocks is counted as one token
+        current_tokens += tokens + 1
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def _token_prefix(text: str, limit: int) -> str:
+    """Longest prefix of the text with at most `limit` tokens"""
     encoding = token_encoding()
-    tokens = encoding.encode(text)
-    tokens = tokens[:limit]
-    return encoding.decode(tokens)
+    tokens = encode_prefix(text, limit)
+    # The last token can end within a multibyte character, which is decoded as
+    # U+FFFD and therefore isn't a prefix of the text
+    while tokens:
+        part = encoding.decode(tokens)
+        if text.startswith(part):
+            return part
+        tokens = tokens[:-1]
+    return text[:1]
 
 
 def token_encoding() -> Encoding:
-    return tiktoken.encoding_for_model("gpt-4-1106-preview")
+    global _encoding
+    if _encoding is None:
+        # Concurrent first calls wait for a single load
+        with _encoding_lock:
+            if _encoding is None:
+                _encoding = _load_encoding()
+    return _encoding
+
+
+def _load_encoding() -> Encoding:
+    # Store the tokenizer files persistently instead of in the temp folder, so they
+    # only need to be downloaded once. The path is passed explicitly instead of via
+    # the environment, which would be inherited by the commands that are run.
+    tokenizer_dir = os.getenv("TIKTOKEN_CACHE_DIR") or str(cache_dir() / "tiktoken")
+    try:
+        tokenizer_path = _download_tokenizer(Path(tokenizer_dir))
+        return _cl100k_encoding(tokenizer_path.read_bytes())
+    except Exception as e:
+        print_error(
+            f"Failed to load the tokenizer ({type(e).__name__}), token counts are estimated"
+        )
+        return ApproximateEncoding()
+
+
+def _cl100k_encoding(tokenizer_file: bytes) -> "TiktokenEncoding":
+    """Same as `tiktoken.get_encoding("cl100k_base")`, from the given tokenizer file"""
+    import tiktoken
+    from tiktoken_ext import openai_public
+
+    mergeable_ranks = {
+        base64.b64decode(token): int(rank)
+        for token, rank in (
+            line.split() for line in tokenizer_file.splitlines() if line
+        )
+    }
+    return tiktoken.Encoding(
+        name="cl100k_base",
+        pat_str=CL100K_PATTERN,
+        mergeable_ranks=mergeable_ranks,
+        special_tokens={
+            openai_public.ENDOFTEXT: 100257,
+            openai_public.FIM_PREFIX: 100258,
+            openai_public.FIM_MIDDLE: 100259,
+            openai_public.FIM_SUFFIX: 100260,
+            openai_public.ENDOFPROMPT: 100276,
+        },
+    )
+
+
+def _download_tokenizer(tokenizer_dir: Path) -> Path:
+    """
+    Downloads the tokenizer file into the directory, if it is missing. The file has
+    the same name as in the cache of tiktoken. tiktoken would download it without a
+    timeout, which blocks without internet.
+    """
+    cache_path = tokenizer_dir / hashlib.sha1(TOKENIZER_URL.encode()).hexdigest()
+    if cache_path.exists():
+        return cache_path
+    import requests
+
+    response = requests.get(TOKENIZER_URL, timeout=DOWNLOAD_TIMEOUT_S)
+    response.raise_for_status()
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # Same as tiktoken, so other processes never read a partial file
+    tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+    tmp_path.write_bytes(response.content)
+    tmp_path.replace(cache_path)
+    return cache_path
@@ -0,0 +1,154 @@
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+class Tracer:
+    """
+    Collects spans in the Chrome trace event format, which can be opened in
+    https://ui.perfetto.dev or chrome://tracing. Spans of the same thread are
+    nested by their time.
+    """
+
+    def __init__(self) -> None:
+        self.events: List[Dict[str, Any]] = []
+        self.pid = os.getpid()
+        self.start = time.perf_counter()
+        self.threads: Dict[int, str] = {}
+        # Current step of each thread, as (name, start)
+        self.steps: Dict[int, Tuple[str, float]] = {}
+        self.lock = threading.Lock()
+
+    def now(self) -> float:
+        return time.perf_counter()
+
+    def add(
+        self,
+        name: str,
+        category: str,
+        start: float,
+        end: float,
+        args: Optional[Dict[str, Any]] = None,
+    ):
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (start - self.start) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": self.pid,
+            "tid": thread.ident,
+            "args": args or {},
+        }
+        with self.lock:
+            self.events.append(event)
+            self.threads.setdefault(thread.ident or 0, thread.name)
+
+    def step(self, name: Optional[str]):
+        """Ends the current step of the thread and starts the next one"""
+        tid = threading.get_ident()
+        now = self.now()
+        with self.lock:
+            previous = self.steps.pop(tid, None)
+            if name is not None:
+                self.steps[tid] = (name, now)
+        if previous is not None:
+            self.add(previous[0], "step", previous[1], now)
+
+    def write(self, path: Path):
+        for tid in list(self.steps):
+            name, start = self.steps.pop(tid)
+            self.add(name, "step", start, self.now())
+        metadata = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": self.pid,
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for tid, name in self.threads.items()
+        ]
+        with open(path, "w") as file:
+            json.dump(
+                {"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}, file
+            )
+
+
+_tracer: Optional[Tracer] = None
+
+
+def is_tracing() -> bool:
+    return _tracer is not None
+
+
+@contextmanager
+def tracing(path: Optional[str]) -> Iterator[None]:
+    """Traces the block and writes the trace to the path. Does nothing if it's None."""
+    global _tracer
+    if path is None:
+        yield
+        return
+    _tracer = Tracer()
+    try:
+        yield
+    finally:
+        tracer, _tracer = _tracer, None
+        tracer.write(Path(path))
+
+
+@contextmanager
+def span(name: str, category: str, **args: Any) -> Iterator[Dict[str, Any]]:
+    """
+    Records the block as a span. Arguments that are only known at the end (e.g.
+    the size of the output) can be added to the yielded dict.
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield args
+        return
+    start = tracer.now()
+    try:
+        yield args
+    except BaseException as e:
+        args["error"] = type(e).__name__
+        raise
+    finally:
+        tracer.add(name, category, start, tracer.now(), args)
+
+
+def trace_step(name: str):
+    if _tracer is not None:
+        _tracer.step(name)
+
+
+def trace_stream(
+    name: str, category: str, stream: Iterable[str], **args: Any
+) -> Iterable[str]:
+    """Records a span from the start until the end of the stream"""
+    with span(name, category, **args) as span_args:
+        start = time.perf_counter()
+        output = []
+        try:
+            for token in stream:
+                if len(output) == 0:
+                    span_args["ttft_ms"] = (time.perf_counter() - start) * 1000
+                output.append(token)
+                yield token
+        finally:
+            span_args.update(text_args("output", "".join(output)))
+
+
+def text_args(prefix: str, text: str) -> Dict[str, int]:
+    """Size of the text in bytes and tokens, as arguments of a span"""
+    from ai_scripts.lib.tokenizing import number_of_tokens
+
+    return {
+        f"{prefix}_bytes": len(text.encode("utf-8")),
+        f"{prefix}_tokens": number_of_tokens(text),
+    }
@@ -0,0 +1,134 @@
+import asyncio
+from dataclasses import dataclass
+import os
+import threading
+from typing import Optional
+import weakref
+
+# Only imported by the model factories, together with the provider SDKs
+import httpx
+
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 20
+# Longer than the default of httpx (5s), so the connections of the daemon survive
+# the pauses between requests
+DEFAULT_KEEPALIVE_S = 60.0
+DEFAULT_TIMEOUT_S = 600.0
+DEFAULT_CONNECT_TIMEOUT_S = 5.0
+
+
+@dataclass
+class TransportOptions:
+    max_connections: int = DEFAULT_MAX_CONNECTIONS
+    max_keepalive_connections: int = DEFAULT_MAX_KEEPALIVE_CONNECTIONS
+    keepalive_s: float = DEFAULT_KEEPALIVE_S
+    timeout_s: float = DEFAULT_TIMEOUT_S
+    connect_timeout_s: float = DEFAULT_CONNECT_TIMEOUT_S
+
+    @classmethod
+    def from_env(cls) -> "TransportOptions":
+        """
+        Reads the options from `AI_SCRIPTS_HTTP_MAX_CONNECTIONS`,
+        `AI_SCRIPTS_HTTP_MAX_KEEPALIVE`, `AI_SCRIPTS_HTTP_KEEPALIVE_S`,
+        `AI_SCRIPTS_HTTP_TIMEOUT_S` and `AI_SCRIPTS_HTTP_CONNECT_TIMEOUT_S`.
+        """
+        return cls(
+            max_connections=int(
+                os.getenv("AI_SCRIPTS_HTTP_MAX_CONNECTIONS") or DEFAULT_MAX_CONNECTIONS
+            ),
+            max_keepalive_connections=int(
+                os.getenv("AI_SCRIPTS_HTTP_MAX_KEEPALIVE")
+                or DEFAULT_MAX_KEEPALIVE_CONNECTIONS
+            ),
+            keepalive_s=float(
+                os.getenv("AI_SCRIPTS_HTTP_KEEPALIVE_S") or DEFAULT_KEEPALIVE_S
+            ),
+            timeout_s=float(
+                os.getenv("AI_SCRIPTS_HTTP_TIMEOUT_S") or DEFAULT_TIMEOUT_S
+            ),
+            connect_timeout_s=float(
+                os.getenv("AI_SCRIPTS_HTTP_CONNECT_TIMEOUT_S")
+                or DEFAULT_CONNECT_TIMEOUT_S
+            ),
+        )
+
+    def limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_s,
+        )
+
+    def timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(self.timeout_s, connect=self.connect_timeout_s)
+
+
+class LoopTransport(httpx.AsyncBaseTransport):
+    """
+    Keeps a connection pool per event loop, as connections can't be used from
+    another loop (e.g. after multiple calls of `asyncio.run`)
+    """
+
+    def __init__(self, options: TransportOptions) -> None:
+        self.options = options
+        self.transports: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncHTTPTransport]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        loop = asyncio.get_running_loop()
+        transport = self.transports.get(loop)
+        if transport is None:
+            transport = httpx.AsyncHTTPTransport(limits=self.options.limits())
+            self.transports[loop] = transport
+        return await transport.handle_async_request(request)
+
+    async def aclose(self) -> None:
+        transport = self.transports.pop(asyncio.get_running_loop(), None)
+        if transport is not None:
+            await transport.aclose()
+
+
+_lock = threading.Lock()
+_client: Optional[httpx.Client] = None
+_async_client: Optional[httpx.AsyncClient] = None
+
+
+def is_shared() -> bool:
+    return os.getenv("AI_SCRIPTS_HTTP_SHARED") != "0"
+
+
+def http_client() -> Optional[httpx.Client]:
+    """
+    HTTP client shared by all providers, so connections (and their TLS sessions)
+    are reused across models. None if the SDKs should use their own clients.
+    """
+    global _client
+    if not is_shared():
+        return None
+    with _lock:
+        if _client is None:
+            options = TransportOptions.from_env()
+            _client = httpx.Client(
+                timeout=options.timeout(),
+                limits=options.limits(),
+                # Like the default clients of the SDKs
+                follow_redirects=True,
+            )
+        return _client
+
+
+def async_http_client() -> Optional[httpx.AsyncClient]:
+    """Like `http_client`, but for the async API"""
+    global _async_client
+    if not is_shared():
+        return None
+    with _lock:
+        if _async_client is None:
+            options = TransportOptions.from_env()
+            _async_client = httpx.AsyncClient(
+                timeout=options.timeout(),
+                transport=LoopTransport(options),
+                follow_redirects=True,
+            )
+        return _async_client
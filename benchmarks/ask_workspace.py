@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Measures the wall-clock time of ask-workspace in the current folder with a stubbed
+model, which starts to answer after a fixed latency and then streams word by word.
+The digest of all prompts is printed, to check that changes to the pipeline don't
+change what is sent to the model.
+
+Usage: python benchmarks/ask_workspace.py [--latency-ms 500] [--token-ms 20] [--runs 3] [-- args]
+"""
+import argparse
+import hashlib
+import json
+import re
+import sys
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+from typing import Iterable, List, Unpack
+from unittest.mock import patch
+
+from ai_scripts.bin import ask_workspace
+from ai_scripts.lib.model import ChatOptions, Message, Model, Models
+
+QUESTION = "How are the answers of the models cached?"
+
+
+class StubModel(Model):
+    def __init__(self, latency_s: float, token_s: float) -> None:
+        self.name = "stub"
+        self.abbr = None
+        self.latency_s = latency_s
+        self.token_s = token_s
+        self.prompts = hashlib.sha256()
+
+    def _complete(self, messages: List[Message], **kwargs: Unpack[ChatOptions]):
+        return "".join(self._stream(messages, **kwargs))
+
+    def _stream(
+        self, messages: List[Message], **kwargs: Unpack[ChatOptions]
+    ) -> Iterable[str]:
+        self.prompts.update(json.dumps([messages, kwargs]).encode("utf-8"))
+        time.sleep(self.latency_s)
+        system_prompt = messages[0]["content"]
+        if "search terms" in system_prompt:
+            answer = "model cache stream token answer sqlite"
+        elif "JSON ARRAY" in system_prompt:
+            answer = '["./README.md", "./ai_scripts/lib/cache.py"]'
+        else:
+            answer = "The answers are cached in a sqlite database."
+        for word in re.findall(r"\S+\s*", answer):
+            yield word
+            time.sleep(self.token_s)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="ask_workspace",
+        description="Benchmark ask-workspace with a stubbed model",
+    )
+    parser.add_argument("--latency-ms", type=int, default=500)
+    parser.add_argument("--token-ms", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument(
+        "args", nargs="*", help="Additional arguments for ask-workspace"
+    )
+    args = parser.parse_args()
+
+    durations = []
+    for _ in range(args.runs):
+        model = StubModel(args.latency_ms / 1000, args.token_ms / 1000)
+        argv = ["ask-workspace", QUESTION, "--no-cache", *args.args]
+        with patch.object(
+            Models, "get_from_env_or_default", lambda *_: model
+        ), patch.object(sys, "argv", argv), redirect_stdout(StringIO()):
+            start = time.perf_counter()
+            ask_workspace.main()
+            durations.append(time.perf_counter() - start)
+    print(f"latency per model call  {args.latency_ms}ms + {args.token_ms}ms per word")
+    print(f"wall-clock (best)       {min(durations) * 1000:.0f}ms")
+    print(f"wall-clock (mean)       {sum(durations) / len(durations) * 1000:.0f}ms")
+    print(f"prompt digest           {model.prompts.hexdigest()[:16]}")
+
+
+if __name__ == "__main__":
+    main()
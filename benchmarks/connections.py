@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Sends requests to several models of the same provider, like the daemon or a batch
+with changing models, and compares the number of opened connections and the time
+with a client per model against the shared transport. Every new connection of the
+fake server is delayed, to simulate the TCP and TLS handshake.
+
+Usage: python benchmarks/connections.py [--requests 30] [--models 3] [--connect-ms 50]
+       [--idle-ms 0] [--concurrency 4]
+"""
+import argparse
+import asyncio
+import os
+import time
+from typing import List
+
+from benchmarks.fake_openai import FakeOptions, start_server
+from ai_scripts.lib.model import Model, openai_compatible_model
+
+MESSAGES = [{"role": "user", "content": "How are the answers cached?"}]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="connections",
+        description="Benchmark the connection reuse of the shared HTTP transport",
+    )
+    parser.add_argument("--requests", type=int, default=30)
+    parser.add_argument("--models", type=int, default=3)
+    parser.add_argument("--connect-ms", type=int, default=50)
+    parser.add_argument(
+        "--idle-ms",
+        type=int,
+        default=0,
+        help="Pause between the sequential requests, e.g. 6000 to exceed the "
+        "default keep-alive of httpx",
+    )
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    server = start_server(
+        FakeOptions(latency_s=0.02, token_s=0.001, connect_s=args.connect_ms / 1000)
+    )
+    print(
+        f"{args.requests} requests to {args.models} models, "
+        f"{args.connect_ms}ms per new connection"
+    )
+    for label, shared in [("client per model", False), ("shared transport", True)]:
+        models = load_models(server.base_url, args.models, shared)
+        for mode in ["sequential", "concurrent"]:
+            server.stats.connections = 0
+            start = time.perf_counter()
+            if mode == "sequential":
+                run_sequential(models, args.requests, args.idle_ms / 1000)
+            else:
+                asyncio.run(run_concurrent(models, args.requests, args.concurrency))
+            duration_s = time.perf_counter() - start
+            print(
+                f"{label:<18} {mode:<11} {duration_s:>6.2f}s  "
+                f"{server.stats.connections:>4} connections"
+            )
+    server.shutdown()
+
+
+def load_models(base_url: str, n_models: int, shared: bool) -> List[Model]:
+    # The option is read when the clients are created
+    os.environ["AI_SCRIPTS_HTTP_SHARED"] = "1" if shared else "0"
+    return [
+        openai_compatible_model(f"fake-{i}", None, api_key="fake", base_url=base_url)
+        for i in range(n_models)
+    ]
+
+
+def run_sequential(models: List[Model], n_requests: int, idle_s: float):
+    for i in range(n_requests):
+        "".join(models[i % len(models)]._stream(MESSAGES))
+        time.sleep(idle_s)
+
+
+async def run_concurrent(models: List[Model], n_requests: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request(i: int):
+        async with semaphore:
+            model = models[i % len(models)]
+            "".join([t async for t in model._astream(MESSAGES)])
+
+    await asyncio.gather(*(request(i) for i in range(n_requests)))
+
+
+if __name__ == "__main__":
+    main()
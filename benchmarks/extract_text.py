@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Measures the time and peak memory of extracting the text of a generated HTML
+document from stdin, comparing the streaming extractor of summarize against a full
+BeautifulSoup tree. Every method runs in its own process, so the peak RSS is not
+shared.
+
+Usage: python benchmarks/extract_text.py [--size-mb 20] [--max-tokens 100000]
+"""
+import argparse
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import IO
+
+METHODS = ["bs4", "stream", "stream-limited"]
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="extract_text",
+        description="Benchmark the text extraction of summarize",
+    )
+    parser.add_argument("--size-mb", type=float, default=20)
+    parser.add_argument("--max-tokens", type=int, default=100_000)
+    parser.add_argument("--method", choices=METHODS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.method is not None:
+        run_method(args.method, args.max_tokens)
+        return
+
+    with tempfile.NamedTemporaryFile("w", suffix=".html") as file:
+        # Written in parts, as the peak RSS of this process is inherited by the
+        # benchmarked processes
+        generate_html(file, int(args.size_mb * 1024 * 1024))
+        file.flush()
+        print(f"document        {args.size_mb:.0f}MB of HTML")
+        print(f"baseline RSS    {measure_baseline():>8.1f}MB")
+        for method in METHODS:
+            with open(file.name) as stdin:
+                output = subprocess.run(
+                    [sys.executable, __file__, "--method", method]
+                    + ["--max-tokens", str(args.max_tokens)],
+                    stdin=stdin,
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                ).stdout
+            duration_s, rss_mb, n_chars = output.split()
+            print(
+                f"{method:<15} {float(duration_s):>8.2f}s  "
+                f"peak RSS {float(rss_mb):>7.1f}MB  ({int(n_chars)} chars)"
+            )
+
+
+def run_method(method: str, max_tokens: int):
+    # Import everything upfront, so only the extraction is measured
+    from bs4 import BeautifulSoup
+
+    from ai_scripts.lib.html import read_chunks, read_text
+    from ai_scripts.lib.tokenizing import token_encoding
+
+    token_encoding()
+    start = time.perf_counter()
+    if method == "bs4":
+        text = BeautifulSoup(sys.stdin.read(), "html.parser").get_text()
+    elif method == "stream":
+        text = read_text(read_chunks(sys.stdin))
+    else:
+        text = read_text(read_chunks(sys.stdin), max_tokens)
+    duration_s = time.perf_counter() - start
+    print(duration_s, peak_rss_mb(), len(text))
+
+
+def measure_baseline() -> float:
+    code = (
+        "import bs4, ai_scripts.lib.html, benchmarks.extract_text as b; "
+        "from ai_scripts.lib.tokenizing import token_encoding; "
+        "token_encoding(); print(b.peak_rss_mb())"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=Path(__file__).parent.parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return float(output)
+
+
+def peak_rss_mb() -> float:
+    # Kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+def generate_html(file: IO[str], size: int):
+    random.seed(0)
+    length = 0
+    for part in [
+        "<html><head><title>Benchmark</title>",
+        f"<style>{'.a { color: red; } ' * 200}</style></head><body>",
+        f"<nav>{'<a href=/>Link</a> ' * 100}</nav>",
+    ]:
+        file.write(part)
+        length += len(part)
+    i = 0
+    while length < size:
+        words = " ".join(random.choices(WORDS, k=80))
+        if i % 20 == 0:
+            part = f"<h2>Section {i}</h2><script>var x = {i}; // {words}</script>"
+        else:
+            part = f'<div class="c"><p>{words} <b>{i}</b> &amp; <a href="#">{words[:20]}</a></p></div>\n'
+        file.write(part)
+        length += len(part)
+        i += 1
+    file.write("</body></html>")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Fake OpenAI compatible chat completions server with a fixed time to first token
+and throughput, which rejects a share of the requests with errors (429 by
+default). Point a model at it with
+`OPENAI_BASE_URL=http://127.0.0.1:<port>/v1 OPENAI_API_KEY=fake`.
+
+Usage: python benchmarks/fake_openai.py [--port 8700] [--error-rate 0.3] [--answer-tokens 1000]
+"""
+import argparse
+from dataclasses import dataclass
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+ANSWER = "The answers are cached in a sqlite database."
+
+WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing"]
+
+
+@dataclass
+class FakeOptions:
+    # Time to the first token
+    latency_s: float = 0.2
+    # Time per token after the first one
+    token_s: float = 0.01
+    # Share of requests that are rejected with `error_status`
+    error_rate: float = 0.0
+    # Value of the Retry-After header of the errors, not sent if None
+    retry_after_s: Optional[float] = None
+    error_status: int = 429
+    # Tokens (words) per streamed chunk
+    chunk_tokens: int = 1
+    # Length of a generated answer, the fixed ANSWER is used if None
+    answer_tokens: Optional[int] = None
+    # Delay of every new connection, e.g. to simulate a TLS handshake
+    connect_s: float = 0.0
+
+
+@dataclass
+class FakeStats:
+    requests: int = 0
+    rejected: int = 0
+    connections: int = 0
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, options: FakeOptions) -> None:
+        super().__init__(("127.0.0.1", port), FakeHandler)
+        self.options = options
+        self.stats = FakeStats()
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    server: FakeServer
+    # Keeps the connections open between requests
+    protocol_version = "HTTP/1.1"
+    # Sends the small chunks of the stream immediately, like real servers
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.stats.connections += 1
+        time.sleep(self.server.options.connect_s)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        options = self.server.options
+        with self.server.lock:
+            self.server.stats.requests += 1
+            rejected = random.random() < options.error_rate
+            if rejected:
+                self.server.stats.rejected += 1
+        if rejected:
+            self._send_error()
+            return
+        time.sleep(options.latency_s)
+        words = answer_words(options.answer_tokens)
+        if request.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            size = max(options.chunk_tokens, 1)
+            for i in range(0, len(words), size):
+                content = "".join(words[i : i + size])
+                self._send_event(_chunk(request["model"], {"content": content}))
+                time.sleep(options.token_s * size)
+            self._send_event(_chunk(request["model"], {}, "stop"))
+            if (request.get("stream_options") or {}).get("include_usage"):
+                usage = _chunk(request["model"], {})
+                usage["choices"] = []
+                usage["usage"] = _usage(request, words)
+                self._send_event(usage)
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        else:
+            time.sleep(options.token_s * len(words))
+            self._send_json(
+                200,
+                {
+                    "id": "fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request["model"],
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {
+                                "role": "assistant",
+                                "content": "".join(words),
+                            },
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": _usage(request, words),
+                },
+            )
+
+    def _send_error(self):
+        options = self.server.options
+        headers = {}
+        if options.retry_after_s is not None:
+            headers["Retry-After"] = str(options.retry_after_s)
+        if options.error_status == 429:
+            error = {"message": "Rate limit reached", "type": "rate_limit_exceeded"}
+        else:
+            error = {"message": "Injected error", "type": "server_error"}
+        self._send_json(options.error_status, {"error": error}, headers)
+
+    def _send_json(self, status: int, body: dict, headers: Optional[dict] = None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_event(self, body: dict):
+        self._write_chunk(f"data: {json.dumps(body)}\n\n".encode("utf-8"))
+
+    def _write_chunk(self, data: bytes):
+        """Writes a chunk of the chunked transfer encoding, an empty one ends it"""
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _chunk(model: str, delta: dict, finish_reason: Optional[str] = None) -> dict:
+    return {
+        "id": "fake",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def answer_words(n_tokens: Optional[int]) -> List[str]:
+    """Words of the answer including their trailing whitespace"""
+    if n_tokens is None:
+        return [w + " " for w in ANSWER.split(" ")]
+    # Paragraphs of 50 words, so renderers see some structure
+    return [
+        WORDS[i % len(WORDS)] + ("\n\n" if i % 50 == 49 else " ")
+        for i in range(n_tokens)
+    ]
+
+
+def _usage(request: dict, words: list) -> dict:
+    prompt_tokens = sum(len(m["content"].split()) for m in request["messages"])
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": len(words),
+        "total_tokens": prompt_tokens + len(words),
+    }
+
+
+def start_server(options: FakeOptions, port: int = 0) -> FakeServer:
+    """Starts the server in a background thread. Port 0 picks a free port."""
+    server = FakeServer(port, options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="fake_openai",
+        description="Run a fake OpenAI compatible server",
+    )
+    parser.add_argument("--port", type=int, default=8700)
+    parser.add_argument("--latency-ms", type=int, default=200)
+    parser.add_argument("--token-ms", type=int, default=10)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=None)
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--chunk-tokens", type=int, default=1)
+    parser.add_argument("--answer-tokens", type=int, default=None)
+    parser.add_argument("--connect-ms", type=int, default=0)
+    args = parser.parse_args()
+    options = FakeOptions(
+        args.latency_ms / 1000,
+        args.token_ms / 1000,
+        args.error_rate,
+        args.retry_after,
+        args.error_status,
+        args.chunk_tokens,
+        args.answer_tokens,
+        args.connect_ms / 1000,
+    )
+    server = FakeServer(args.port, options)
+    print(f"Listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
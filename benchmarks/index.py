@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Measures the size and throughput of the search index on a generated workspace and
+compares the search with the index against a live `git grep`.
+
+Usage: python benchmarks/index.py [--files 5000] [--lines 200]
+"""
+import argparse
+from itertools import accumulate
+import os
+import random
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List
+
+from ai_scripts.lib.fs import search_keywords
+from ai_scripts.lib.index import WorkspaceIndex
+
+# Identifiers with a zipf-like frequency, like in real code bases
+WORDS = [f"word{i}" for i in range(20000)]
+CUM_WEIGHTS = list(accumulate(1 / (i + 1) for i in range(len(WORDS))))
+# From a keyword within many terms to a term that doesn't exist
+KEYWORDS = ["word1", "Word50", "word1234", "word19999", "xyzzy"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="index",
+        description="Benchmark the search index on a generated workspace",
+    )
+    parser.add_argument("--files", type=int, default=5000, help="Number of files")
+    parser.add_argument("--lines", type=int, default=200, help="Lines per file")
+    parser.add_argument("--changed", type=int, default=20, help="Files to modify")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workspace:
+        os.chdir(workspace)
+        size_mb = generate_workspace(args.files, args.lines)
+        print(f"workspace      {args.files} files, {size_mb:.1f}MB")
+
+        index = WorkspaceIndex.for_workspace()
+        build_s = measure(index.rebuild)
+        index_mb = index.path.stat().st_size / 1024 / 1024
+        print(f"build          {build_s:>8.2f}s  ({size_mb / build_s:.1f}MB/s)")
+        print(f"index size     {index_mb:>8.1f}MB")
+        print(f"no-op update   {measure(index.update) * 1000:>8.1f}ms")
+
+        for path in random.sample(sorted(Path("src").iterdir()), args.changed):
+            with path.open("a") as f:
+                f.write(f"{random_line()}\n")
+        update_s = measure(index.update)
+        print(f"update         {update_s * 1000:>8.1f}ms  ({args.changed} files)")
+
+        for keyword in KEYWORDS:
+            indexed_s = measure(lambda: search_keywords([keyword], index))
+            live_s = measure(lambda: search_keywords([keyword]))
+            print(
+                f"search {keyword:<10} {indexed_s * 1000:>8.1f}ms  "
+                f"(live: {live_s * 1000:.1f}ms)"
+            )
+
+
+def generate_workspace(n_files: int, n_lines: int) -> float:
+    random.seed(0)
+    source = Path("src")
+    source.mkdir()
+    size = 0
+    for i in range(n_files):
+        content = "\n".join(random_line() for _ in range(n_lines)) + "\n"
+        (source / f"module_{i}.py").write_text(content)
+        size += len(content)
+    subprocess.run(["git", "init", "-q"], check=True)
+    subprocess.run(["git", "add", "."], check=True)
+    return size / 1024 / 1024
+
+
+def random_line() -> str:
+    words: List[str] = random.choices(WORDS, cum_weights=CUM_WEIGHTS, k=5)
+    return f"    {words[0]}_{words[1]} = {words[2].title()}({', '.join(words[3:])})"
+
+
+def measure(fn: Callable[[], object]) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Sends concurrent requests to a fake OpenAI server that rejects a share of them
+with 429 errors, with and without the scheduler, and reports how many requests
+succeeded.
+
+Usage: python benchmarks/retries.py [--requests 50] [--concurrency 10] [--error-rate 0.3]
+"""
+import argparse
+import asyncio
+import time
+from typing import Tuple
+
+from benchmarks.fake_openai import FakeOptions, start_server
+from ai_scripts.lib.model import Model, openai_compatible_model
+from ai_scripts.lib.scheduler import RateLimits, ScheduledModel, Scheduler
+
+MESSAGES = [{"role": "user", "content": "How are the answers cached?"}]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="retries",
+        description="Benchmark the scheduler against a fake server returning 429s",
+    )
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--error-rate", type=float, default=0.3)
+    parser.add_argument("--retry-after", type=float, default=None)
+    parser.add_argument("--rpm", type=float, default=None, help="Requests per minute")
+    args = parser.parse_args()
+
+    server = start_server(
+        FakeOptions(error_rate=args.error_rate, retry_after_s=args.retry_after)
+    )
+    model = openai_compatible_model(
+        "fake", None, api_key="fake", base_url=server.base_url
+    )
+    scheduled = ScheduledModel(
+        model, Scheduler("fake", RateLimits(requests_per_minute=args.rpm))
+    )
+    print(f"{args.requests} requests, {args.error_rate:.0%} rejected with 429")
+    for label, m in [("without scheduler", model), ("with scheduler", scheduled)]:
+        server.stats.requests = server.stats.rejected = 0
+        start = time.perf_counter()
+        succeeded, failed = asyncio.run(run(m, args.requests, args.concurrency))
+        duration_s = time.perf_counter() - start
+        print(
+            f"{label:<18} {succeeded:>4} ok  {failed:>4} failed  "
+            f"{server.stats.requests:>4} sent  {duration_s:>6.2f}s"
+        )
+    server.shutdown()
+
+
+async def run(model: Model, n_requests: int, concurrency: int) -> Tuple[int, int]:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request(i: int) -> bool:
+        async with semaphore:
+            try:
+                # Half of the requests are streamed
+                if i % 2 == 0:
+                    answer = "".join([t async for t in model._astream(MESSAGES)])
+                else:
+                    answer = await model._acomplete(MESSAGES)
+                return answer != ""
+            except Exception:
+                return False
+
+    results = await asyncio.gather(*(request(i) for i in range(n_requests)))
+    return sum(results), len(results) - sum(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Measures the cold start import time of every console script and fails if one of
+them exceeds its budget.
+
+Usage: python benchmarks/startup.py [--budget-ms 250] [--runs 5]
+"""
+import argparse
+import re
+import subprocess
+import sys
+import tomllib
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+ROOT = Path(__file__).parent.parent
+
+DEFAULT_BUDGET_MS = 250
+# Scripts that need more than the default budget
+BUDGETS_MS: Dict[str, int] = {}
+
+import_time_regex = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="startup",
+        description="Check the import time of all console scripts against a budget",
+    )
+    parser.add_argument(
+        "--budget-ms",
+        type=int,
+        default=DEFAULT_BUDGET_MS,
+        help="The default budget per script in milliseconds",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=5,
+        help="Number of runs per script. The fastest one is used.",
+    )
+    args = parser.parse_args()
+    budget_ms: int = args.budget_ms
+    runs: int = args.runs
+
+    failed = False
+    for script, module in console_scripts().items():
+        best_ms, imports = min(
+            (measure_import(module) for _ in range(runs)), key=lambda r: r[0]
+        )
+        budget = BUDGETS_MS.get(script, budget_ms)
+        status = "ok" if best_ms <= budget else "OVER BUDGET"
+        print(f"{script:<16} {best_ms:>8.1f}ms / {budget}ms  {status}")
+        if best_ms > budget:
+            failed = True
+            for name, ms in slowest_imports(imports):
+                print(f"    {ms:>8.1f}ms  {name}")
+    sys.exit(1 if failed else 0)
+
+
+def console_scripts() -> Dict[str, str]:
+    pyproject = tomllib.loads((ROOT / "pyproject.toml").read_text())
+    scripts: Dict[str, str] = pyproject["tool"]["poetry"]["scripts"]
+    return {name: entry.split(":")[0] for name, entry in scripts.items()}
+
+
+def measure_import(module: str) -> Tuple[float, List[Tuple[str, float]]]:
+    """Returns the cumulative import time of the module and all its nested imports"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    # Nested imports are logged before the module that imports them
+    imports: List[Tuple[str, float]] = []
+    for line in result.stderr.decode("utf-8").splitlines():
+        match = import_time_regex.match(line)
+        if match is None:
+            continue
+        cumulative_ms = int(match.group(2)) / 1000
+        is_top_level = len(match.group(3)) == 1
+        name = match.group(4)
+        if is_top_level and name == module:
+            return cumulative_ms, imports
+        if is_top_level:
+            # Imported during interpreter startup, not by the module
+            imports = []
+        else:
+            imports.append((name, cumulative_ms))
+    raise RuntimeError(f"Failed to measure import time of {module}")
+
+
+def slowest_imports(
+    imports: List[Tuple[str, float]], n: int = 10
+) -> List[Tuple[str, float]]:
+    """Returns the slowest third party packages imported by the module"""
+    by_package: Dict[str, Tuple[str, float]] = {}
+    for name, ms in imports:
+        if name.startswith("ai_scripts"):
+            continue
+        package = name.split(".")[0]
+        if package not in by_package or by_package[package][1] < ms:
+            by_package[package] = (name, ms)
+    return sorted(by_package.values(), key=lambda i: i[1], reverse=True)[:n]
+
+
+if __name__ == "__main__":
+    main()
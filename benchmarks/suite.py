@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Runs the console scripts end to end against a fake OpenAI server and measures their
+wall time, CPU time and peak memory, plus micro benchmarks of `print_stream` in tty
+and non-tty mode. The results are saved as JSON, so they can be compared between
+commits.
+
+Usage: python benchmarks/suite.py [--runs 3] [--ttft-ms 200] [--tokens-per-s 100]
+       [--chunk-tokens 1] [--answer-tokens 200] [--error-rate 0] [--compare old.json]
+"""
+import argparse
+import json
+import os
+import pty
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from benchmarks.fake_openai import WORDS, FakeOptions, start_server
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = ROOT / "benchmarks" / "results"
+
+# Arguments of each script, `{tmp}` is replaced by a temporary directory
+SCRIPTS: Dict[str, List[str]] = {
+    "how": ["how", "list all python files"],
+    "rewrite": ["rewrite", "Use single quotes", "-f", "ai_scripts/lib/env.py"],
+    "ask-workspace": ["ask_workspace", "How are the answers of the models cached?"],
+    # Fixed chunk size, as the context of the model would fit the whole document
+    "summarize": ["summarize", "--chunk-tokens", "6000"],
+    "ai-chat": ["ai_chat", "--no-editor", "-p", "How are you?", "{tmp}/chat.md"],
+}
+
+# Size of the document that is summarized, large enough for multiple chunks
+SUMMARIZE_WORDS = 20_000
+
+PRINT_STREAM_TOKENS = 10_000
+PRINT_STREAM_MODES = ["non-tty", "tty"]
+
+# Stand-ins for the clipboard tools, so the benchmark doesn't overwrite the clipboard
+CLIPBOARD_SCRIPT = """#!/bin/sh
+case "$*" in
+  *-o*) cat "$AI_SCRIPTS_BENCHMARK_CLIPBOARD" 2>/dev/null ;;
+  *) cat > "$AI_SCRIPTS_BENCHMARK_CLIPBOARD" ;;
+esac
+"""
+CLIPBOARD_TOOLS = ["xsel", "pbcopy", "pbpaste"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="suite",
+        description="Benchmark the console scripts against a fake OpenAI server",
+    )
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--ttft-ms", type=int, default=200)
+    parser.add_argument("--tokens-per-s", type=float, default=100)
+    parser.add_argument("--chunk-tokens", type=int, default=1)
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument(
+        "--scripts",
+        nargs="*",
+        choices=list(SCRIPTS),
+        default=list(SCRIPTS),
+        help="Scripts to benchmark. Defaults to all.",
+    )
+    parser.add_argument(
+        "--output",
+        type=Path,
+        help="Where to save the results. Defaults to benchmarks/results/<commit>.json",
+    )
+    parser.add_argument("--compare", type=Path, help="Results of an earlier run")
+    parser.add_argument(
+        "--print-stream", choices=PRINT_STREAM_MODES, help=argparse.SUPPRESS
+    )
+    args = parser.parse_args()
+
+    if args.print_stream is not None:
+        run_print_stream(args.print_stream)
+        return
+
+    options = FakeOptions(
+        latency_s=args.ttft_ms / 1000,
+        token_s=1 / args.tokens_per_s,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        chunk_tokens=args.chunk_tokens,
+        answer_tokens=args.answer_tokens,
+    )
+    server = start_server(options)
+    results: Dict[str, Any] = {
+        "commit": git_commit(),
+        "created_at": time.time(),
+        "options": {k: v for k, v in vars(args).items() if k in OPTION_KEYS},
+        "scripts": {},
+        "print_stream": {},
+    }
+    print(f"{'script':<16} {'wall':>8} {'cpu':>8} {'peak RSS':>10}  requests")
+    baseline = measure([sys.executable, "-c", "pass"], {}, None)
+    print_row("python", baseline, None)
+    results["scripts"]["python"] = baseline
+    with tempfile.TemporaryDirectory() as tmp:
+        env = script_env(Path(tmp), server.base_url)
+        document = Path(tmp) / "document.txt"
+        document.write_text(generate_document(SUMMARIZE_WORDS))
+        for name in args.scripts:
+            runs = []
+            requests = server.stats.requests
+            for _ in range(args.runs):
+                # Start without cached answers or chats of previous runs
+                shutil.rmtree(Path(tmp) / "cache", ignore_errors=True)
+                (Path(tmp) / "chat.md").unlink(missing_ok=True)
+                cmd = [sys.executable, "-m", f"ai_scripts.bin.{SCRIPTS[name][0]}"]
+                cmd += [a.replace("{tmp}", tmp) for a in SCRIPTS[name][1:]]
+                stdin = document if name == "summarize" else None
+                runs.append(measure(cmd, env, stdin))
+            n_requests = (server.stats.requests - requests) / args.runs
+            result = summarize_runs(runs)
+            result["requests"] = n_requests
+            results["scripts"][name] = result
+            print_row(name, result, n_requests)
+    server.shutdown()
+
+    print()
+    print(f"print_stream    {PRINT_STREAM_TOKENS} tokens")
+    for mode in PRINT_STREAM_MODES:
+        result = measure_print_stream(mode)
+        results["print_stream"][mode] = result
+        print_row(mode, result, None)
+
+    output = args.output or RESULTS_DIR / f"{results['commit'] or 'unknown'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f"\nSaved the results to {output}")
+    if args.compare is not None:
+        compare(json.loads(args.compare.read_text()), results)
+
+
+OPTION_KEYS = [
+    "runs",
+    "ttft_ms",
+    "tokens_per_s",
+    "chunk_tokens",
+    "answer_tokens",
+    "error_rate",
+    "error_status",
+]
+
+
+def script_env(tmp: Path, base_url: str) -> Dict[str, str]:
+    bin_dir = tmp / "bin"
+    bin_dir.mkdir()
+    for tool in CLIPBOARD_TOOLS:
+        path = bin_dir / tool
+        path.write_text(CLIPBOARD_SCRIPT)
+        path.chmod(0o755)
+    return {
+        **os.environ,
+        "PATH": f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}",
+        # Required by pyperclip to look for xsel
+        "DISPLAY": os.environ.get("DISPLAY", ":0"),
+        "AI_SCRIPTS_BENCHMARK_CLIPBOARD": str(tmp / "clipboard"),
+        "OPENAI_BASE_URL": base_url,
+        "OPENAI_API_KEY": "fake",
+        "MODEL": "G4",
+        "AI_SCRIPTS_CACHE_DIR": str(tmp / "cache"),
+        "AI_SCRIPTS_DAEMON": "0",
+    }
+
+
+def measure(cmd: List[str], env: Dict[str, str], stdin: Optional[Path]) -> Dict:
+    """Runs the command and returns its wall time, CPU time and peak RSS"""
+    with tempfile.TemporaryFile() as stderr, open(stdin or os.devnull) as stdin_file:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            cmd,
+            cwd=ROOT,
+            env=env or None,
+            stdin=stdin_file,
+            stdout=subprocess.DEVNULL,
+            stderr=stderr,
+        )
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_s = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            stderr.seek(0)
+            output = stderr.read().decode("utf-8", errors="replace")
+            lines = output.strip().splitlines()
+            return {"error": lines[-1] if lines else f"exit {process.returncode}"}
+    return {
+        "wall_s": wall_s,
+        "cpu_s": usage.ru_utime + usage.ru_stime,
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+    }
+
+
+def summarize_runs(runs: List[Dict]) -> Dict:
+    """Median of the times and maximum of the memory of all runs"""
+    errors = [r["error"] for r in runs if "error" in r]
+    if errors:
+        return {"error": errors[0]}
+    return {
+        "wall_s": statistics.median(r["wall_s"] for r in runs),
+        "cpu_s": statistics.median(r["cpu_s"] for r in runs),
+        "peak_rss_mb": max(r["peak_rss_mb"] for r in runs),
+    }
+
+
+def measure_print_stream(mode: str) -> Dict:
+    """Runs the micro benchmark in a subprocess, with a pseudo terminal for tty mode"""
+    cmd = [sys.executable, __file__, "--print-stream", mode]
+    env = {**os.environ, "COLUMNS": "120", "LINES": "40"}
+    if mode == "non-tty":
+        output = subprocess.run(
+            cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        return json.loads(output.stderr)
+    master, slave = pty.openpty()
+    # The terminal has to be read, otherwise the process blocks once it is full
+    drain = threading.Thread(target=drain_fd, args=(master,), daemon=True)
+    drain.start()
+    try:
+        output = subprocess.run(
+            cmd, cwd=ROOT, env=env, stdout=slave, stderr=subprocess.PIPE
+        )
+    finally:
+        os.close(slave)
+        drain.join(timeout=5)
+        os.close(master)
+    return json.loads(output.stderr)
+
+
+def drain_fd(fd: int):
+    try:
+        while os.read(fd, 65536):
+            pass
+    except OSError:
+        # Raised once the other side of the pseudo terminal is closed
+        pass
+
+
+def run_print_stream(mode: str):
+    # Import everything upfront, so only the printing is measured
+    from ai_scripts.lib.logging import print_stream, render_markdown
+
+    render_markdown("")
+    tokens = [
+        WORDS[i % len(WORDS)] + ("\n\n" if i % 50 == 49 else " ")
+        for i in range(PRINT_STREAM_TOKENS)
+    ]
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    print_stream(tokens, render_markdown)
+    result = {
+        "wall_s": time.perf_counter() - start,
+        "cpu_s": time.process_time() - start_cpu,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    assert sys.stdout.isatty() == (mode == "tty")
+    sys.stderr.write(json.dumps(result))
+
+
+def generate_document(n_words: int) -> str:
+    words = [WORDS[i % len(WORDS)] for i in range(n_words)]
+    return "\n\n".join(" ".join(words[i : i + 100]) for i in range(0, n_words, 100))
+
+
+def print_row(name: str, result: Dict, n_requests: Optional[float]):
+    if "error" in result:
+        print(f"{name:<16} failed: {result['error']}")
+        return
+    requests = f"{n_requests:.0f}" if n_requests is not None else ""
+    print(
+        f"{name:<16} {result['wall_s']:>7.2f}s {result['cpu_s']:>7.2f}s "
+        f"{result['peak_rss_mb']:>8.1f}MB  {requests}"
+    )
+
+
+def compare(old: Dict, new: Dict):
+    print(f"\nCompared to {old.get('commit')}")
+    if old.get("options") != new.get("options"):
+        print("Warning: the results were measured with different options")
+    for group in ["scripts", "print_stream"]:
+        for name, result in new[group].items():
+            old_result = old.get(group, {}).get(name)
+            if old_result is None or "error" in old_result or "error" in result:
+                continue
+            changes = [
+                f"{key} {change(old_result[key], result[key]):>7}"
+                for key in ["wall_s", "cpu_s", "peak_rss_mb"]
+            ]
+            print(f"{name:<16} {'  '.join(changes)}")
+
+
+def change(old: float, new: float) -> str:
+    if old == 0:
+        return "-"
+    return f"{(new - old) / old:+.0%}"
+
+
+def git_commit() -> Optional[str]:
+    output = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    return output.stdout.strip() or None
+
+
+if __name__ == "__main__":
+    main()